@@ -0,0 +1,293 @@
+"""Certificate PDF rendering.
+
+Runs inside the render worker processes started by server.py, so it only
+depends on ReportLab, qrcode and the certificate/template fields passed in.
+
+A template is compiled once per process into a CertificatePlan: colours are
+parsed, logo and signature images fetched and decoded, and every static
+element turned into a drawing step. Rendering a certificate then replays the
+static steps and stamps the per-certificate fields and QR code.
+"""
+import io
+import logging
+import urllib.parse
+import urllib.request
+from collections import OrderedDict
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+import qrcode
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import A4, landscape
+from reportlab.lib.utils import ImageReader, simpleSplit
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from reportlab.pdfgen import canvas
+
+logger = logging.getLogger(__name__)
+
+PAGE_WIDTH, PAGE_HEIGHT = landscape(A4)
+MARGIN = 36
+CONTENT_WIDTH = PAGE_WIDTH - 2 * MARGIN - 80
+IMAGE_FETCH_TIMEOUT_SECONDS = 5
+IMAGE_URL_SCHEMES = ("http", "https", "data")
+PLAN_CACHE_SIZE = 64
+
+# Used for certifications without a default template; matches the model defaults
+DEFAULT_TEMPLATE = {
+    "template_id": "builtin",
+    "version": 0,
+    "background_color": "#ffffff",
+    "accent_color": "#1e40af",
+    "logo_url": "",
+    "signature_url": "",
+    "signatory_name": "Platform Director",
+    "signatory_title": "SkillTrack365",
+    "include_badge": True,
+    "include_qr": True,
+    "custom_text": ""
+}
+
+class TemplateAssetError(Exception):
+    """A template's logo or signature could not be fetched; the render should be retried later"""
+
+def parse_color(value: Optional[str], fallback: str) -> colors.Color:
+    try:
+        return colors.HexColor(value or fallback)
+    except (ValueError, TypeError):
+        return colors.HexColor(fallback)
+
+def is_dark(color: colors.Color) -> bool:
+    return 0.299 * color.red + 0.587 * color.green + 0.114 * color.blue < 0.5
+
+def fetch_image(url: str) -> Optional[ImageReader]:
+    """Download and decode a template image (http(s) or data: URL); None if the template has none"""
+    if not url:
+        return None
+    if urllib.parse.urlsplit(url).scheme.lower() not in IMAGE_URL_SCHEMES:
+        raise TemplateAssetError(f"Certificate template image {url[:80]} must be an http(s) or data: URL")
+    try:
+        with urllib.request.urlopen(url, timeout=IMAGE_FETCH_TIMEOUT_SECONDS) as response:
+            image = ImageReader(io.BytesIO(response.read()))
+        image.getSize()
+        return image
+    except Exception as e:
+        logger.warning(f"Certificate template image {url[:80]} not usable: {e}")
+        raise TemplateAssetError(f"Certificate template image {url[:80]} not usable: {e}") from None
+
+def fit_font_size(text: str, font: str, size: float, width: float, minimum: float = 12) -> float:
+    """Largest size up to `size` at which `text` fits in `width`"""
+    text_width = stringWidth(text, font, size)
+    if text_width <= width:
+        return size
+    return max(minimum, size * width / text_width)
+
+def draw_image(c: canvas.Canvas, image: ImageReader, x: float, y: float, max_width: float, max_height: float, anchor: str = "c"):
+    image_width, image_height = image.getSize()
+    scale = min(max_width / image_width, max_height / image_height)
+    width, height = image_width * scale, image_height * scale
+    left = {"l": x, "c": x - width / 2, "r": x - width}[anchor]
+    c.drawImage(image, left, y, width, height, mask="auto")
+
+def draw_qr(c: canvas.Canvas, url: str, x: float, y: float, size: float):
+    """Draw the QR code as vector modules, one rectangle per run of dark modules, on a white quiet zone"""
+    qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_M, border=0)
+    qr.add_data(url)
+    qr.make(fit=True)
+    matrix = qr.get_matrix()
+    module = size / len(matrix)
+    c.setFillColor(colors.white)
+    c.rect(x - 2 * module, y - 2 * module, size + 4 * module, size + 4 * module, stroke=0, fill=1)
+    path = c.beginPath()
+    for row_index, row in enumerate(matrix):
+        top = y + size - (row_index + 1) * module
+        start = None
+        for col_index, dark in enumerate(row + [False]):
+            if dark and start is None:
+                start = col_index
+            elif not dark and start is not None:
+                path.rect(x + start * module, top, (col_index - start) * module, module)
+                start = None
+    c.setFillColor(colors.black)
+    c.drawPath(path, stroke=0, fill=1)
+
+class CertificatePlan:
+    """A compiled template: static drawing steps plus steps that stamp certificate fields"""
+
+    def __init__(self, template: Dict):
+        self.static: List[Callable[[canvas.Canvas], None]] = []
+        self.fields: List[Callable[[canvas.Canvas, Dict], None]] = []
+        self.compile(template)
+
+    def compile(self, template: Dict):
+        background = parse_color(template.get("background_color"), DEFAULT_TEMPLATE["background_color"])
+        accent = parse_color(template.get("accent_color"), DEFAULT_TEMPLATE["accent_color"])
+        text = colors.HexColor("#F4F4F5") if is_dark(background) else colors.HexColor("#18181B")
+        muted = colors.HexColor("#A1A1AA") if is_dark(background) else colors.HexColor("#71717A")
+        logo = fetch_image(template.get("logo_url"))
+        signature = fetch_image(template.get("signature_url"))
+        center = PAGE_WIDTH / 2
+
+        def frame(c):
+            c.setFillColor(background)
+            c.rect(0, 0, PAGE_WIDTH, PAGE_HEIGHT, stroke=0, fill=1)
+            c.setStrokeColor(accent)
+            c.setLineWidth(3)
+            c.rect(MARGIN / 2, MARGIN / 2, PAGE_WIDTH - MARGIN, PAGE_HEIGHT - MARGIN)
+            c.setLineWidth(0.75)
+            c.rect(MARGIN / 2 + 6, MARGIN / 2 + 6, PAGE_WIDTH - MARGIN - 12, PAGE_HEIGHT - MARGIN - 12)
+        self.static.append(frame)
+
+        if logo:
+            self.static.append(lambda c: draw_image(c, logo, center, PAGE_HEIGHT - 110, 220, 54))
+        else:
+            def brand(c):
+                c.setFillColor(accent)
+                c.setFont("Helvetica-Bold", 30)
+                c.drawCentredString(center, PAGE_HEIGHT - 95, "SKILLTRACK365")
+            self.static.append(brand)
+
+        custom_lines = simpleSplit(template.get("custom_text") or "", "Helvetica-Oblique", 11, CONTENT_WIDTH)[:3]
+
+        def headings(c):
+            c.setFillColor(muted)
+            c.setFont("Helvetica", 14)
+            c.drawCentredString(center, PAGE_HEIGHT - 135, "CERTIFICATE OF COMPLETION")
+            c.setFont("Helvetica", 16)
+            c.drawCentredString(center, PAGE_HEIGHT - 180, "This certifies that")
+            c.drawCentredString(center, PAGE_HEIGHT - 265, "has successfully completed the certification path for")
+            c.setFont("Helvetica-Oblique", 11)
+            for index, line in enumerate(custom_lines):
+                c.drawCentredString(center, PAGE_HEIGHT - 372 - index * 14, line)
+        self.static.append(headings)
+
+        signatory_name = template.get("signatory_name") or ""
+        signatory_title = template.get("signatory_title") or ""
+
+        def signatory(c):
+            left = MARGIN + 60
+            if signature:
+                draw_image(c, signature, left + 90, 112, 180, 44)
+            c.setStrokeColor(muted)
+            c.setLineWidth(0.75)
+            c.line(left, 106, left + 180, 106)
+            c.setFillColor(text)
+            c.setFont("Helvetica-Bold", 11)
+            c.drawCentredString(left + 90, 92, signatory_name)
+            c.setFillColor(muted)
+            c.setFont("Helvetica", 10)
+            c.drawCentredString(left + 90, 78, signatory_title)
+        self.static.append(signatory)
+
+        if template.get("include_badge", True):
+            def badge(c):
+                c.setStrokeColor(accent)
+                c.setFillColor(accent)
+                c.setLineWidth(2)
+                c.circle(center, 110, 36, stroke=1, fill=0)
+                c.circle(center, 110, 30, stroke=1, fill=0)
+                c.setFont("Helvetica-Bold", 9)
+                c.drawCentredString(center, 113, "VERIFIED")
+                c.setFont("Helvetica", 6)
+                c.drawCentredString(center, 102, "SKILLTRACK365")
+            self.static.append(badge)
+
+        def name(c, cert):
+            c.setFillColor(text)
+            size = fit_font_size(cert["user_name"], "Helvetica-Bold", 34, CONTENT_WIDTH)
+            c.setFont("Helvetica-Bold", size)
+            c.drawCentredString(center, PAGE_HEIGHT - 230, cert["user_name"])
+
+        def certification(c, cert):
+            title = f"{cert['vendor']} {cert['cert_name']}"
+            c.setFillColor(accent)
+            size = fit_font_size(title, "Helvetica-Bold", 26, CONTENT_WIDTH)
+            c.setFont("Helvetica-Bold", size)
+            c.drawCentredString(center, PAGE_HEIGHT - 305, title)
+            c.setFillColor(muted)
+            c.setFont("Helvetica", 14)
+            c.drawCentredString(center, PAGE_HEIGHT - 328, f"({cert['cert_code']})")
+
+        def stats(c, cert):
+            c.setFillColor(muted)
+            c.setFont("Helvetica", 11)
+            c.drawCentredString(
+                center, PAGE_HEIGHT - 352,
+                f"Readiness: {cert['readiness_percentage']}% | Labs: {cert['labs_completed']} | "
+                f"Assessments: {cert['assessments_passed']} | Projects: {cert['projects_completed']}"
+            )
+
+        self.fields.extend([name, certification, stats])
+
+        include_qr = template.get("include_qr", True)
+
+        def verification(c, cert):
+            right = PAGE_WIDTH - MARGIN - 60
+            issued = datetime.fromisoformat(cert["issued_at"].replace('Z', '+00:00')).strftime("%B %d, %Y")
+            text_right = right - 86 if include_qr and cert.get("verify_url") else right
+            c.setFillColor(muted)
+            c.setFont("Helvetica", 10)
+            c.drawRightString(text_right, 106, f"Certificate ID: {cert['certificate_id']}")
+            c.drawRightString(text_right, 92, f"Issued: {issued}")
+            if include_qr and cert.get("verify_url"):
+                draw_qr(c, cert["verify_url"], right - 72, 70, 72)
+                c.setFillColor(muted)
+                c.setFont("Helvetica", 8)
+                c.drawRightString(text_right, 78, "Scan to verify")
+        self.fields.append(verification)
+
+    def render(self, certificate: Dict) -> bytes:
+        buffer = io.BytesIO()
+        c = canvas.Canvas(buffer, pagesize=(PAGE_WIDTH, PAGE_HEIGHT))
+        c.setTitle(f"SkillTrack365 Certificate {certificate['certificate_id']}")
+        for step in self.static:
+            step(c)
+        for step in self.fields:
+            step(c, certificate)
+        c.showPage()
+        c.save()
+        return buffer.getvalue()
+
+_plans: "OrderedDict[tuple, CertificatePlan]" = OrderedDict()
+
+def certificate_plan(template: Optional[Dict]) -> CertificatePlan:
+    """Compiled plan for a template, cached per process by template id and version
+
+    Raises TemplateAssetError (and caches nothing) if the template's images cannot be fetched.
+    """
+    template = template or DEFAULT_TEMPLATE
+    key = (template.get("template_id"), template.get("version", 0))
+    plan = _plans.get(key)
+    if plan is None:
+        plan = CertificatePlan(template)
+        _plans[key] = plan
+        # Older versions of an updated template are never requested again
+        for stale in [k for k in _plans if k[0] == key[0] and k != key]:
+            del _plans[stale]
+        while len(_plans) > PLAN_CACHE_SIZE:
+            _plans.popitem(last=False)
+    else:
+        _plans.move_to_end(key)
+    return plan
+
+def render_certificate_pdf(certificate: Dict, template: Optional[Dict] = None) -> bytes:
+    """Render a certificate with its template's compiled plan"""
+    return certificate_plan(template).render(certificate)
+
+def render_certificate_batch(certificates: List[Dict], template: Optional[Dict] = None) -> List[bytes]:
+    """Render several certificates sharing a template in one worker call"""
+    plan = certificate_plan(template)
+    return [plan.render(certificate) for certificate in certificates]
+
+WARMUP_CERTIFICATE = {
+    "certificate_id": "ST365-WARMUP", "user_name": "Warm Up", "vendor": "AWS", "cert_name": "Warm Up",
+    "cert_code": "WARM-01", "readiness_percentage": 100, "labs_completed": 0, "assessments_passed": 0,
+    "projects_completed": 0, "issued_at": "2026-01-01T00:00:00+00:00",
+    "verify_url": "https://skilltrack365.com/certificate/ST365-WARMUP"
+}
+
+def warm_renderer():
+    """Process pool initializer: load fonts and compile the built-in plan before the first real render"""
+    render_certificate_pdf(WARMUP_CERTIFICATE)
+
+def ping() -> bool:
+    return True
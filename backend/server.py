@@ -1,25 +1,46 @@
 from fastapi import FastAPI, APIRouter, HTTPException, Request, Response, Depends
-from fastapi.responses import StreamingResponse
+from fastapi.responses import FileResponse, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReadPreference, ReplaceOne, UpdateOne, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 import os
+import asyncio
+import heapq
 import logging
+import math
+import random
 import uuid
 import httpx
 import io
-import qrcode
+import csv
+import json
+import re
+import zlib
+import hashlib
+import hmac
+import codecs
+import itertools
+import numpy as np
+from abc import ABC, abstractmethod
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict
+from urllib.parse import urlsplit
+from collections import OrderedDict
+from pydantic import BaseModel, Field, ConfigDict, ValidationError
 from typing import List, Optional, Dict, Any
 from datetime import datetime, timezone, timedelta
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+import stripe
 from emergentintegrations.payments.stripe.checkout import StripeCheckout, CheckoutSessionResponse, CheckoutStatusResponse, CheckoutSessionRequest
-from reportlab.lib import colors
-from reportlab.lib.pagesizes import A4, landscape
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import inch
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image, Table, TableStyle
-from reportlab.lib.enums import TA_CENTER, TA_LEFT
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import zipfile
+from certificate_render import render_certificate_pdf, render_certificate_batch, warm_renderer, ping as ping_renderer, TemplateAssetError
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pyarrow import fs as pafs
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -31,6 +52,9 @@ db = client[os.environ['DB_NAME']]
 
 # Stripe initialization
 stripe_api_key = os.environ.get('STRIPE_API_KEY')
+# STRIPE_STUB=true swaps Stripe for an in-process stub (local development and tests)
+stripe_stub_enabled = os.environ.get('STRIPE_STUB', '').lower() in ("1", "true", "yes")
+stripe_webhook_secret = os.environ.get('STRIPE_WEBHOOK_SECRET') or ("whsec_local_stub" if stripe_stub_enabled else None)
 
 # Create the main app
 app = FastAPI()
@@ -153,6 +177,10 @@ class NoteRequest(BaseModel):
 class CertificateRequest(BaseModel):
     cert_id: str
 
+class BulkCertificateRequest(BaseModel):
+    cert_id: str
+    user_ids: List[str]
+
 class DiscussionPostCreate(BaseModel):
     cert_id: str
     title: str
@@ -229,10 +257,32 @@ class ResourceQuota(BaseModel):
     updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class LabInstanceCreate(BaseModel):
+    lab_id: str
+    # Leave unset to let the placement engine choose
+    provider: Optional[str] = None
+    region: Optional[str] = None
+    instance_type: Optional[str] = None
+
+class WarmPoolWindow(BaseModel):
+    start_at: datetime
+    end_at: datetime
+    size: int = Field(ge=0)
+
+class WarmPoolTargetUpdate(BaseModel):
     lab_id: str
     provider: str = "aws"
-    region: str = "us-east-1"
     instance_type: str = "small"
+    min_size: int = Field(default=0, ge=0)
+    max_size: int = Field(default=50, ge=0)
+    demand_factor: float = Field(default=1.0, ge=0)  # Warm instances per launch in the last demand window
+    schedule: List[WarmPoolWindow] = []
+
+class CapacityForecastRequest(BaseModel):
+    start_at: datetime
+    instance_count: int = Field(gt=0, le=10000)
+    lab_id: Optional[str] = None
+    instance_type: Optional[str] = None
+    providers: Optional[List[str]] = None
 
 class LabInstanceAction(BaseModel):
     action: str  # suspend, resume, terminate, extend
@@ -744,6 +794,465 @@ SUBSCRIPTION_PLANS = {
     "yearly": 199.99
 }
 
+STRIPE_SIGNATURE_TOLERANCE_SECONDS = 300
+STRIPE_EVENT_LEASE_SECONDS = 60
+STRIPE_EVENT_MAX_ATTEMPTS = 5
+STRIPE_EVENT_POLL_SECONDS = 5.0
+# Local transaction states that no longer need Stripe to be asked
+PAYMENT_TERMINAL_STATUSES = ["paid", "failed", "cancelled"]
+
+stripe_event_wakeup = asyncio.Event()
+
+class LocalStripeCheckout:
+    """In-process stand-in for StripeCheckout used when STRIPE_STUB is enabled.
+
+    Sessions stay open until completed through POST /api/stripe-stub/sessions/{id}/complete,
+    which also delivers a signed checkout.session.completed webhook.
+    """
+    sessions: Dict[str, Dict] = {}
+    
+    def __init__(self, api_key: Optional[str] = None, webhook_url: Optional[str] = None):
+        self.webhook_url = webhook_url
+    
+    async def create_checkout_session(self, checkout_request: CheckoutSessionRequest) -> CheckoutSessionResponse:
+        session_id = f"cs_test_{uuid.uuid4().hex}"
+        self.sessions[session_id] = {
+            "id": session_id,
+            "object": "checkout.session",
+            "status": "open",
+            "payment_status": "unpaid",
+            "amount_total": int(round(checkout_request.amount * 100)),
+            "currency": checkout_request.currency,
+            "metadata": checkout_request.metadata or {}
+        }
+        url = checkout_request.success_url.replace("{CHECKOUT_SESSION_ID}", session_id)
+        return CheckoutSessionResponse(url=url, session_id=session_id)
+    
+    async def get_checkout_status(self, session_id: str) -> CheckoutStatusResponse:
+        session = self.sessions.get(session_id)
+        if not session:
+            raise HTTPException(status_code=404, detail="Checkout session not found")
+        return CheckoutStatusResponse(
+            status=session["status"],
+            payment_status=session["payment_status"],
+            amount_total=session["amount_total"],
+            currency=session["currency"],
+            metadata=session["metadata"]
+        )
+
+PAYMENT_STATUS_CACHE_SECONDS = 5.0
+PAYMENT_STATUS_CACHE_SIZE = 10000
+PAYMENT_CLIENT_CACHE_SIZE = 16
+STRIPE_HTTP_TIMEOUT_SECONDS = 30
+
+class PaymentClient:
+    """App-lifetime Stripe checkout client.
+
+    StripeCheckout reaches the Stripe API through the stripe SDK, which sends
+    every request through stripe.default_http_client. One HTTPX client (sync
+    and async, keep-alive connection pool) is installed there for the life of
+    the app, so all checkout clients share pooled connections; it is closed on
+    shutdown. Checkout clients are created once per webhook URL and reused
+    instead of being rebuilt for every request. Session statuses are cached
+    (PAYMENT_STATUS_CACHE_SECONDS until the session is paid or expired, then
+    indefinitely, LRU bounded) and concurrent lookups for the same session
+    share one upstream call.
+    """
+    
+    def __init__(self):
+        self.clients = OrderedDict()  # webhook_url -> checkout client
+        self.status_cache = OrderedDict()  # session_id -> (expires_at or None, status)
+        self.inflight: Dict[str, asyncio.Future] = {}
+        self.http_client = None
+        if not stripe_stub_enabled:
+            self.http_client = stripe.HTTPXClient(timeout=STRIPE_HTTP_TIMEOUT_SECONDS, allow_sync_methods=True)
+            stripe.default_http_client = self.http_client
+    
+    async def close(self):
+        if self.http_client is not None:
+            await self.http_client.close_async()
+            self.http_client.close()
+    
+    def checkout(self, webhook_url: str):
+        client = self.clients.get(webhook_url)
+        if client is None:
+            if stripe_stub_enabled:
+                client = LocalStripeCheckout(webhook_url=webhook_url)
+            else:
+                client = StripeCheckout(api_key=stripe_api_key, webhook_url=webhook_url)
+            self.clients[webhook_url] = client
+            if len(self.clients) > PAYMENT_CLIENT_CACHE_SIZE:
+                self.clients.popitem(last=False)
+        else:
+            self.clients.move_to_end(webhook_url)
+        return client
+    
+    async def create_checkout_session(self, webhook_url: str, checkout_request: CheckoutSessionRequest) -> CheckoutSessionResponse:
+        return await self.checkout(webhook_url).create_checkout_session(checkout_request)
+    
+    async def get_checkout_status(self, session_id: str, webhook_url: str) -> CheckoutStatusResponse:
+        cached = self.status_cache.get(session_id)
+        if cached and (cached[0] is None or cached[0] > asyncio.get_running_loop().time()):
+            self.status_cache.move_to_end(session_id)
+            return cached[1]
+        
+        future = self.inflight.get(session_id)
+        if future is None:
+            future = asyncio.ensure_future(self._fetch_status(session_id, webhook_url))
+            self.inflight[session_id] = future
+            future.add_done_callback(lambda _: self.inflight.pop(session_id, None))
+        # Shielded so one caller disconnecting does not cancel the shared lookup
+        return await asyncio.shield(future)
+    
+    async def _fetch_status(self, session_id: str, webhook_url: str) -> CheckoutStatusResponse:
+        status = await self.checkout(webhook_url).get_checkout_status(session_id)
+        # A complete but unpaid session (delayed payment method) can still become paid
+        terminal = status.status == "expired" or status.payment_status in ("paid", "no_payment_required")
+        expires = None if terminal else asyncio.get_running_loop().time() + PAYMENT_STATUS_CACHE_SECONDS
+        self.status_cache[session_id] = (expires, status)
+        self.status_cache.move_to_end(session_id)
+        if len(self.status_cache) > PAYMENT_STATUS_CACHE_SIZE:
+            self.status_cache.popitem(last=False)
+        return status
+    
+    def invalidate(self, session_id: str):
+        self.status_cache.pop(session_id, None)
+
+payment_client = PaymentClient()
+
+def sign_stripe_payload(payload: bytes, secret: str, timestamp: Optional[int] = None) -> str:
+    """Build a Stripe-Signature header value (t=...,v1=...) for a payload"""
+    timestamp = timestamp or int(datetime.now(timezone.utc).timestamp())
+    digest = hmac.new(secret.encode(), f"{timestamp}.".encode() + payload, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={digest}"
+
+def verify_stripe_signature(payload: bytes, header: Optional[str], secret: str) -> bool:
+    """Check a Stripe-Signature header against the raw request body"""
+    if not header:
+        return False
+    timestamp = None
+    signatures = []
+    for part in header.split(","):
+        key, _, value = part.strip().partition("=")
+        if key == "t":
+            timestamp = value
+        elif key == "v1":
+            signatures.append(value)
+    if not timestamp or not timestamp.isdigit() or not signatures:
+        return False
+    if abs(datetime.now(timezone.utc).timestamp() - int(timestamp)) > STRIPE_SIGNATURE_TOLERANCE_SECONDS:
+        return False
+    expected = hmac.new(secret.encode(), f"{timestamp}.".encode() + payload, hashlib.sha256).hexdigest()
+    return any(hmac.compare_digest(expected, sig) for sig in signatures)
+
+# === Revenue Rollups ===
+# Daily totals per (UTC day, plan, payment status, currency), kept in step with every
+# transaction change so billing analytics never scan payment_transactions.
+# Transactions carry created_on (BSON date) next to the ISO created_at string, and
+# rollup rows store day as a BSON date, so analytics can bucket with $dateTrunc.
+
+REVENUE_BACKFILL_BATCH_SIZE = 1000
+# Held by a rebuild while it recomputes the rollups; transaction writes wait for it
+REVENUE_ROLLUP_LOCK = "revenue_rollup_rebuild"
+REVENUE_ROLLUP_LOCK_SECONDS = 300
+REVENUE_ROLLUP_SETTLE_SECONDS = 2.0  # Lets writes that passed the gate just before the lock record their change
+REVENUE_ROLLUP_WAIT_POLL_SECONDS = 0.5
+
+def transaction_created_on(transaction: Dict) -> datetime:
+    return parse_timestamp(transaction.get("created_on") or transaction["created_at"])
+
+def revenue_rollup_contribution(transaction: Dict) -> tuple:
+    """The rollup row a transaction counts towards, and what it adds there"""
+    day = transaction_created_on(transaction).replace(hour=0, minute=0, second=0, microsecond=0)
+    plan = transaction.get("plan") or "unknown"
+    status = transaction.get("payment_status", "pending")
+    currency = transaction.get("currency", "usd")
+    refunded = transaction.get("refund_status") == "refunded"
+    return f"{day:%Y-%m-%d}|{plan}|{status}|{currency}", {"day": day, "plan": plan, "status": status, "currency": currency}, {
+        "count": 1,
+        "amount": transaction.get("amount", 0),
+        "refunds": 1 if refunded else 0,
+        "refunded_amount": (transaction.get("refund_amount") or 0) if refunded else 0
+    }
+
+async def wait_for_revenue_rebuild():
+    """Hold off a transaction write while a rebuild recomputes the rollups.
+
+    Call before changing a transaction that will be passed to record_revenue_change:
+    a change landing while the rebuild aggregates would be counted twice or lost.
+    """
+    while await db.scheduler_locks.find_one(
+        {"_id": REVENUE_ROLLUP_LOCK, "expires_at": {"$gt": datetime.now(timezone.utc).isoformat()}}, {"_id": 1}
+    ):
+        await asyncio.sleep(REVENUE_ROLLUP_WAIT_POLL_SECONDS)
+
+async def record_revenue_change(before: Optional[Dict], after: Optional[Dict]):
+    """Move a transaction's contribution from its old rollup row to its new one"""
+    await record_revenue_changes([(before, after)])
+
+async def record_revenue_changes(pairs: List[tuple]):
+    """Apply several (before, after) transaction changes to the rollups in one bulk write"""
+    changes = {}
+    for before, after in pairs:
+        for transaction, sign in ((before, -1), (after, 1)):
+            if not transaction:
+                continue
+            row_id, fields, values = revenue_rollup_contribution(transaction)
+            row = changes.setdefault(row_id, (fields, {}))[1]
+            for key, value in values.items():
+                row[key] = row.get(key, 0) + sign * value
+    now = datetime.now(timezone.utc).isoformat()
+    ops = [
+        UpdateOne({"_id": row_id}, {"$inc": increments, "$set": {"updated_at": now}, "$setOnInsert": fields}, upsert=True)
+        for row_id, (fields, increments) in changes.items()
+        if any(increments.values())
+    ]
+    if ops:
+        await db.revenue_rollups.bulk_write(ops, ordered=False)
+
+async def run_revenue_rollup_rebuild(job: Dict, lease_lost: asyncio.Event):
+    """Recompute every rollup row from payment_transactions, e.g. after a crash or bulk deletion"""
+    # Backfill created_on for transactions written before it existed
+    while True:
+        if lease_lost.is_set():
+            raise JobLeaseLost(job["job_id"])
+        missing = await db.payment_transactions.find(
+            {"created_on": {"$exists": False}}, {"_id": 1, "created_at": 1}
+        ).limit(REVENUE_BACKFILL_BATCH_SIZE).to_list(REVENUE_BACKFILL_BATCH_SIZE)
+        if not missing:
+            break
+        await db.payment_transactions.bulk_write(
+            [UpdateOne({"_id": t["_id"]}, {"$set": {"created_on": parse_timestamp(t["created_at"])}}) for t in missing],
+            ordered=False
+        )
+    
+    # Hold off transaction writes until the rebuilt rows are in place
+    while not await acquire_lock(REVENUE_ROLLUP_LOCK, REVENUE_ROLLUP_LOCK_SECONDS):
+        if lease_lost.is_set():
+            raise JobLeaseLost(job["job_id"])
+        await asyncio.sleep(REVENUE_ROLLUP_WAIT_POLL_SECONDS)
+    try:
+        await asyncio.sleep(REVENUE_ROLLUP_SETTLE_SECONDS)
+        rows = await rebuild_revenue_rollup_rows(job, lease_lost)
+    finally:
+        await release_lock(REVENUE_ROLLUP_LOCK)
+    logger.info(f"Rebuilt {len(rows)} revenue rollup rows from payment_transactions")
+
+async def rebuild_revenue_rollup_rows(job: Dict, lease_lost: asyncio.Event) -> Dict[str, Dict]:
+    """Replace every rollup row with totals aggregated from payment_transactions"""
+    groups = await db.payment_transactions.aggregate([
+        {"$group": {
+            "_id": {
+                "day": {"$dateTrunc": {"date": "$created_on", "unit": "day", "timezone": "UTC"}},
+                "plan": {"$ifNull": ["$plan", "unknown"]},
+                "status": {"$ifNull": ["$payment_status", "pending"]},
+                "currency": {"$ifNull": ["$currency", "usd"]}
+            },
+            "count": {"$sum": 1},
+            "amount": {"$sum": {"$ifNull": ["$amount", 0]}},
+            "refunds": {"$sum": {"$cond": [{"$eq": ["$refund_status", "refunded"]}, 1, 0]}},
+            "refunded_amount": {"$sum": {"$cond": [
+                {"$eq": ["$refund_status", "refunded"]}, {"$ifNull": ["$refund_amount", 0]}, 0
+            ]}}
+        }}
+    ]).to_list(None)
+    if lease_lost.is_set():
+        raise JobLeaseLost(job["job_id"])
+    
+    now = datetime.now(timezone.utc).isoformat()
+    rows = {}
+    for group in groups:
+        key = group.pop("_id")
+        row_id = f"{key['day']:%Y-%m-%d}|{key['plan']}|{key['status']}|{key['currency']}"
+        rows[row_id] = {**key, **group, "updated_at": now}
+    if rows:
+        await db.revenue_rollups.bulk_write(
+            [ReplaceOne({"_id": row_id}, row, upsert=True) for row_id, row in rows.items()],
+            ordered=False
+        )
+    stale = await db.revenue_rollups.delete_many({"_id": {"$nin": list(rows)}})
+    await db.background_jobs.update_one(
+        {"job_id": job["job_id"]},
+        {"$set": {"steps.0.total": len(rows), "steps.0.deleted": stale.deleted_count, "steps.0.done": True}}
+    )
+    return rows
+
+async def remove_revenue_contributions(ids: List[Any]):
+    """Cascade hook: take transactions out of the rollups before they are deleted"""
+    await wait_for_revenue_rebuild()
+    transactions = await db.payment_transactions.find({"_id": {"$in": ids}}, {"_id": 0}).to_list(len(ids))
+    await record_revenue_changes([(transaction, None) for transaction in transactions])
+
+async def fulfill_checkout_session(session_id: str, source: str) -> Optional[Dict]:
+    """Mark a checkout transaction paid and grant the subscription; safe to repeat.
+
+    The transaction flips to paid once. The subscription grant is derived from
+    paid_at and applied with $max, so re-running after a crash (or from both the
+    webhook and a status poll) never extends a subscription twice.
+    """
+    now = datetime.now(timezone.utc)
+    paid = {
+        "payment_status": "paid",
+        "paid_at": now.isoformat(),
+        "fulfilled_by": source,
+        "updated_at": now.isoformat()
+    }
+    await wait_for_revenue_rebuild()
+    before = await db.payment_transactions.find_one_and_update(
+        {"session_id": session_id, "payment_status": {"$ne": "paid"}},
+        {"$set": paid}
+    )
+    if before:
+        before.pop("_id", None)
+        transaction = {**before, **paid}
+        await record_revenue_change(before, transaction)
+    else:
+        transaction = await db.payment_transactions.find_one({"session_id": session_id}, {"_id": 0})
+        if not transaction:
+            return None
+    
+    if not transaction.get("subscription_applied"):
+        days = 365 if transaction.get("plan") == "yearly" else 30
+        expires_at = parse_timestamp(transaction["paid_at"]) + timedelta(days=days)
+        await db.users.update_one(
+            {"user_id": transaction["user_id"]},
+            {
+                "$set": {"subscription_status": "premium"},
+                "$max": {"subscription_expires_at": expires_at.isoformat()}
+            }
+        )
+        await db.payment_transactions.update_one(
+            {"session_id": session_id},
+            {"$set": {"subscription_applied": True}}
+        )
+        transaction["subscription_applied"] = True
+        logger.info(f"Subscription granted to {transaction['user_id']} for session {session_id} via {source}")
+    return transaction
+
+async def close_checkout_session(session_id: str, payment_status: str):
+    """Record a session that ended without payment (expired or failed)"""
+    closed = {"payment_status": payment_status, "updated_at": datetime.now(timezone.utc).isoformat()}
+    await wait_for_revenue_rebuild()
+    before = await db.payment_transactions.find_one_and_update(
+        {"session_id": session_id, "payment_status": "pending"},
+        {"$set": closed}
+    )
+    if before:
+        await record_revenue_change(before, {**before, **closed})
+
+async def apply_stripe_event(event: Dict) -> str:
+    """Apply one inbox event; returns the status to store on it"""
+    session = event.get("object", {})
+    session_id = session.get("id")
+    event_type = event["type"]
+    if not session_id or session.get("object", "checkout.session") != "checkout.session":
+        return "ignored"
+    if event_type in ("checkout.session.completed", "checkout.session.async_payment_succeeded"):
+        if event_type == "checkout.session.completed" and session.get("payment_status") != "paid":
+            return "processed"  # Delayed payment method; fulfilled by async_payment_succeeded
+        if not await fulfill_checkout_session(session_id, "webhook"):
+            raise ValueError(f"No transaction for checkout session {session_id}")
+        return "processed"
+    if event_type == "checkout.session.expired":
+        await close_checkout_session(session_id, "cancelled")
+        return "processed"
+    if event_type == "checkout.session.async_payment_failed":
+        await close_checkout_session(session_id, "failed")
+        return "processed"
+    return "ignored"
+
+async def claim_stripe_event() -> Optional[Dict]:
+    now = datetime.now(timezone.utc)
+    event = await db.stripe_events.find_one_and_update(
+        {"$or": [
+            {"status": "pending", "next_attempt_at": {"$lte": now.isoformat()}},
+            {"status": "processing", "lease_expires_at": {"$lt": now.isoformat()}}
+        ]},
+        {
+            "$set": {
+                "status": "processing",
+                "worker_id": WORKER_ID,
+                "lease_expires_at": (now + timedelta(seconds=STRIPE_EVENT_LEASE_SECONDS)).isoformat()
+            },
+            "$inc": {"attempts": 1}
+        },
+        sort=[("received_at", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+    if event:
+        event.pop("_id", None)
+    return event
+
+async def process_stripe_event(event: Dict):
+    now = datetime.now(timezone.utc)
+    try:
+        status = await apply_stripe_event(event)
+        update = {"status": status, "processed_at": now.isoformat(), "error": None}
+    except Exception as e:
+        logger.error(f"Stripe event {event['event_id']} failed (attempt {event['attempts']}): {e}")
+        if event["attempts"] >= STRIPE_EVENT_MAX_ATTEMPTS:
+            update = {"status": "failed", "error": str(e)}
+        else:
+            retry_at = now + timedelta(seconds=2 ** event["attempts"])
+            update = {"status": "pending", "error": str(e), "next_attempt_at": retry_at.isoformat()}
+    await db.stripe_events.update_one(
+        {"event_id": event["event_id"], "worker_id": WORKER_ID},
+        {"$set": update, "$unset": {"lease_expires_at": ""}}
+    )
+
+async def stripe_event_worker():
+    """Drain the Stripe event inbox"""
+    while True:
+        try:
+            event = await claim_stripe_event()
+            if event:
+                await process_stripe_event(event)
+                continue
+            stripe_event_wakeup.clear()
+            try:
+                await asyncio.wait_for(stripe_event_wakeup.wait(), timeout=STRIPE_EVENT_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Stripe event worker error: {e}")
+            await asyncio.sleep(STRIPE_EVENT_POLL_SECONDS)
+
+async def record_stripe_event(payload: bytes) -> Dict:
+    """Store a verified webhook payload in the inbox, once per Stripe event id"""
+    try:
+        event = json.loads(payload)
+        event_id = event["id"]
+        event_type = event["type"]
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Malformed event payload")
+    
+    now = datetime.now(timezone.utc).isoformat()
+    try:
+        await db.stripe_events.insert_one({
+            "event_id": event_id,
+            "type": event_type,
+            "object": (event.get("data") or {}).get("object", {}),
+            "status": "pending",
+            "attempts": 0,
+            "error": None,
+            "received_at": now,
+            "next_attempt_at": now
+        })
+    except DuplicateKeyError:
+        return {"received": True, "duplicate": True}
+    stripe_event_wakeup.set()
+    return {"received": True}
+
+async def receive_stripe_webhook(body: bytes, signature: Optional[str]) -> Dict:
+    if not stripe_webhook_secret:
+        logger.error("Stripe webhook received but STRIPE_WEBHOOK_SECRET is not configured")
+        raise HTTPException(status_code=503, detail="Webhook not configured")
+    if not verify_stripe_signature(body, signature, stripe_webhook_secret):
+        raise HTTPException(status_code=400, detail="Invalid signature")
+    return await record_stripe_event(body)
+
 @api_router.post("/checkout/create")
 async def create_checkout(data: CheckoutRequest, request: Request, user: Dict = Depends(require_auth)):
     if data.plan not in SUBSCRIPTION_PLANS:
@@ -754,8 +1263,6 @@ async def create_checkout(data: CheckoutRequest, request: Request, user: Dict =
     host_url = data.origin_url
     webhook_url = f"{host_url}/api/webhook/stripe"
     
-    stripe_checkout = StripeCheckout(api_key=stripe_api_key, webhook_url=webhook_url)
-    
     success_url = f"{host_url}/checkout/success?session_id={{CHECKOUT_SESSION_ID}}"
     cancel_url = f"{host_url}/checkout"
     
@@ -770,10 +1277,11 @@ async def create_checkout(data: CheckoutRequest, request: Request, user: Dict =
         }
     )
     
-    session = await stripe_checkout.create_checkout_session(checkout_request)
+    session = await payment_client.create_checkout_session(webhook_url, checkout_request)
     
     # Create payment transaction record
-    await db.payment_transactions.insert_one({
+    now = datetime.now(timezone.utc)
+    transaction = {
         "transaction_id": f"txn_{uuid.uuid4().hex[:12]}",
         "user_id": user["user_id"],
         "session_id": session.session_id,
@@ -781,45 +1289,42 @@ async def create_checkout(data: CheckoutRequest, request: Request, user: Dict =
         "currency": "usd",
         "plan": data.plan,
         "payment_status": "pending",
-        "created_at": datetime.now(timezone.utc).isoformat()
-    })
+        "created_at": now.isoformat(),
+        "created_on": now
+    }
+    await wait_for_revenue_rebuild()
+    await db.payment_transactions.insert_one(transaction)
+    await record_revenue_change(None, transaction)
     
     return {"url": session.url, "session_id": session.session_id}
 
 @api_router.get("/checkout/status/{session_id}")
 async def check_payment_status(session_id: str, user: Dict = Depends(require_auth)):
-    host_url = str(os.environ['REACT_APP_BACKEND_URL'])
-    webhook_url = f"{host_url}/api/webhook/stripe"
+    transaction = await db.payment_transactions.find_one(
+        {"session_id": session_id, "user_id": user["user_id"]}, {"_id": 0}
+    )
+    if not transaction:
+        raise HTTPException(status_code=404, detail="Checkout session not found")
     
-    stripe_checkout = StripeCheckout(api_key=stripe_api_key, webhook_url=webhook_url)
+    # Settled locally (usually by the webhook): no need to ask Stripe
+    if transaction["payment_status"] in PAYMENT_TERMINAL_STATUSES:
+        return {
+            "status": "complete" if transaction["payment_status"] == "paid" else "expired",
+            "payment_status": transaction["payment_status"],
+            "amount_total": int(round(transaction["amount"] * 100)),
+            "currency": transaction.get("currency", "usd")
+        }
     
-    status = await stripe_checkout.get_checkout_status(session_id)
+    host_url = str(os.environ['REACT_APP_BACKEND_URL'])
+    webhook_url = f"{host_url}/api/webhook/stripe"
     
-    # Update transaction
-    transaction = await db.payment_transactions.find_one({"session_id": session_id}, {"_id": 0})
+    status = await payment_client.get_checkout_status(session_id, webhook_url)
     
-    if transaction and transaction.get("payment_status") != "paid" and status.payment_status == "paid":
-        # Update transaction status
-        await db.payment_transactions.update_one(
-            {"session_id": session_id},
-            {"$set": {
-                "payment_status": status.payment_status,
-                "updated_at": datetime.now(timezone.utc).isoformat()
-            }}
-        )
-        
-        # Update user subscription
-        plan = transaction.get("plan", "monthly")
-        days = 365 if plan == "yearly" else 30
-        expires_at = datetime.now(timezone.utc) + timedelta(days=days)
-        
-        await db.users.update_one(
-            {"user_id": user["user_id"]},
-            {"$set": {
-                "subscription_status": "premium",
-                "subscription_expires_at": expires_at.isoformat()
-            }}
-        )
+    if status.payment_status == "paid":
+        # Webhook not processed yet; fulfil here, the webhook then finds it done
+        await fulfill_checkout_session(session_id, "status_poll")
+    elif status.status == "expired":
+        await close_checkout_session(session_id, "cancelled")
     
     return {
         "status": status.status,
@@ -830,10 +1335,110 @@ async def check_payment_status(session_id: str, user: Dict = Depends(require_aut
 
 @api_router.post("/webhook/stripe")
 async def stripe_webhook(request: Request):
-    # Webhook handling for Stripe events
+    """Verify a Stripe webhook and queue it for fulfilment"""
     body = await request.body()
-    logger.info("Received Stripe webhook")
-    return {"received": True}
+    return await receive_stripe_webhook(body, request.headers.get("Stripe-Signature"))
+
+@api_router.post("/stripe-stub/sessions/{session_id}/complete")
+async def complete_stub_checkout_session(session_id: str, payment_status: str = "paid"):
+    """Local Stripe stub: settle a checkout session and deliver its signed webhook"""
+    if not stripe_stub_enabled:
+        raise HTTPException(status_code=404, detail="Not found")
+    session = LocalStripeCheckout.sessions.get(session_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="Checkout session not found")
+    
+    payment_client.invalidate(session_id)
+    if payment_status == "paid":
+        session.update(status="complete", payment_status="paid")
+        event_type = "checkout.session.completed"
+    else:
+        session.update(status="expired", payment_status="unpaid")
+        event_type = "checkout.session.expired"
+    payload = json.dumps({
+        "id": f"evt_test_{uuid.uuid4().hex}",
+        "object": "event",
+        "type": event_type,
+        "data": {"object": session}
+    }).encode()
+    result = await receive_stripe_webhook(payload, sign_stripe_payload(payload, stripe_webhook_secret))
+    return {**result, "event_type": event_type}
+
+# === Subscription Expiry ===
+
+SUBSCRIPTION_SWEEP_LOCK = "subscription_expiry"
+SUBSCRIPTION_SWEEP_INTERVAL_SECONDS = 60
+SUBSCRIPTION_SWEEP_BATCH_SIZE = 500
+
+def has_premium_access(user: Optional[Dict], now_iso: str) -> bool:
+    """Premium check on stored ISO strings; covers the window until the sweeper marks a lapsed user expired"""
+    if not user or user.get("subscription_status") != "premium":
+        return False
+    expires_at = user.get("subscription_expires_at")
+    return not expires_at or expires_at > now_iso
+
+def churn_event_id(user_id: str, expires_at: str) -> str:
+    """One churn event per subscription term, however many sweeps see it"""
+    return f"churn_{hashlib.sha1(f'{user_id}|{expires_at}'.encode()).hexdigest()[:16]}"
+
+async def expire_subscriptions_batch(now: datetime) -> int:
+    """Expire one batch of lapsed premium subscriptions and record a churn event for each"""
+    now_iso = now.isoformat()
+    lapsed = await db.users.find(
+        {"subscription_status": "premium", "subscription_expires_at": {"$lte": now_iso}},
+        {"_id": 0, "user_id": 1, "subscription_expires_at": 1}
+    ).sort("subscription_expires_at", 1).limit(SUBSCRIPTION_SWEEP_BATCH_SIZE).to_list(SUBSCRIPTION_SWEEP_BATCH_SIZE)
+    if not lapsed:
+        return 0
+    
+    # Re-check the expiry in the update so a renewal that lands mid-sweep is left alone
+    await db.users.update_many(
+        {
+            "user_id": {"$in": [u["user_id"] for u in lapsed]},
+            "subscription_status": "premium",
+            "subscription_expires_at": {"$lte": now_iso}
+        },
+        {"$set": {"subscription_status": "expired", "subscription_expired_at": now_iso}}
+    )
+    expired = await db.users.find(
+        {
+            "user_id": {"$in": [u["user_id"] for u in lapsed]},
+            "subscription_status": "expired",
+            "subscription_expired_at": now_iso
+        },
+        {"_id": 0, "user_id": 1, "subscription_expires_at": 1}
+    ).to_list(len(lapsed))
+    if expired:
+        events = [{
+            "event_id": churn_event_id(u["user_id"], u["subscription_expires_at"]),
+            "user_id": u["user_id"],
+            "type": "expired",
+            "previous_status": "premium",
+            "subscription_expires_at": u["subscription_expires_at"],
+            "created_at": now_iso
+        } for u in expired]
+        try:
+            await db.subscription_events.insert_many(events, ordered=False)
+        except BulkWriteError as e:
+            # Events already written by an earlier, interrupted sweep
+            if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+                raise
+        logger.info(f"Expired {len(expired)} subscriptions")
+    return len(lapsed)
+
+async def subscription_sweeper():
+    """Leader-elected loop that moves lapsed premium users to expired"""
+    while True:
+        try:
+            if await acquire_lock(SUBSCRIPTION_SWEEP_LOCK, SUBSCRIPTION_SWEEP_INTERVAL_SECONDS * 2):
+                now = datetime.now(timezone.utc)
+                while await expire_subscriptions_batch(now) >= SUBSCRIPTION_SWEEP_BATCH_SIZE:
+                    pass
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Subscription sweeper error: {e}")
+        await asyncio.sleep(SUBSCRIPTION_SWEEP_INTERVAL_SECONDS)
 
 # ============== HELPER FUNCTIONS ==============
 
@@ -871,7 +1476,7 @@ async def recalculate_readiness(user_id: str, cert_id: str):
     
     await db.user_progress.update_one(
         {"user_id": user_id, "cert_id": cert_id},
-        {"$set": {"readiness_percentage": readiness}}
+        {"$set": {"readiness_percentage": readiness, "updated_at": datetime.now(timezone.utc).isoformat()}}
     )
 
 # ============== SEED DATA ==============
@@ -1959,6 +2564,28 @@ async def get_assessment_review(assessment_id: str, user: Dict = Depends(require
 
 # ============== CERTIFICATE ROUTES ==============
 
+CERTIFICATE_MIN_READINESS = 80
+
+def build_certificate(user: Dict, cert: Dict, readiness: float, labs: int, assessments: int, projects: int) -> Dict:
+    """New certificate record for a learner who reached the readiness threshold"""
+    cert_number = f"ST365-{uuid.uuid4().hex[:8].upper()}"
+    return {
+        "certificate_id": cert_number,
+        "user_id": user["user_id"],
+        "user_name": user["name"],
+        "user_email": user["email"],
+        "cert_id": cert["cert_id"],
+        "cert_name": cert["name"],
+        "cert_code": cert["code"],
+        "vendor": cert["vendor"],
+        "readiness_percentage": readiness,
+        "labs_completed": labs,
+        "assessments_passed": assessments,
+        "projects_completed": projects,
+        "issued_at": datetime.now(timezone.utc).isoformat(),
+        "share_url": f"/certificate/{cert_number}"
+    }
+
 @api_router.get("/certificates")
 async def get_certificates(user: Dict = Depends(require_auth)):
     """Get all earned certificates for the user"""
@@ -1977,8 +2604,8 @@ async def generate_certificate(data: CertificateRequest, user: Dict = Depends(re
         {"_id": 0}
     )
     
-    if not progress or progress.get("readiness_percentage", 0) < 80:
-        raise HTTPException(status_code=400, detail="Need 80%+ readiness to earn certificate")
+    if not progress or progress.get("readiness_percentage", 0) < CERTIFICATE_MIN_READINESS:
+        raise HTTPException(status_code=400, detail=f"Need {CERTIFICATE_MIN_READINESS}%+ readiness to earn certificate")
     
     # Get certification details
     cert = await db.certifications.find_one({"cert_id": data.cert_id}, {"_id": 0})
@@ -1994,34 +2621,152 @@ async def generate_certificate(data: CertificateRequest, user: Dict = Depends(re
     if existing:
         return existing
     
-    # Generate certificate ID
-    cert_number = f"ST365-{uuid.uuid4().hex[:8].upper()}"
-    
-    # Create certificate record
-    certificate = {
-        "certificate_id": cert_number,
-        "user_id": user["user_id"],
-        "user_name": user["name"],
-        "user_email": user["email"],
-        "cert_id": data.cert_id,
-        "cert_name": cert["name"],
-        "cert_code": cert["code"],
-        "vendor": cert["vendor"],
-        "readiness_percentage": progress["readiness_percentage"],
-        "labs_completed": len(progress.get("labs_completed", [])),
-        "assessments_passed": len([a for a in progress.get("assessments_completed", []) if a.get("passed")]),
-        "projects_completed": len(progress.get("projects_completed", [])),
-        "issued_at": datetime.now(timezone.utc).isoformat(),
-        "share_url": f"/certificate/{cert_number}"
-    }
+    certificate = build_certificate(
+        user, cert, progress["readiness_percentage"],
+        labs=len(progress.get("labs_completed", [])),
+        assessments=len([a for a in progress.get("assessments_completed", []) if a.get("passed")]),
+        projects=len(progress.get("projects_completed", []))
+    )
     
     await db.user_certificates.insert_one(certificate)
     
     return certificate
 
+# Bump when the PDF layout changes so cached renders are not served for the old design
+CERTIFICATE_RENDER_VERSION = "2"
+CERTIFICATE_CACHE_DIR = Path(os.environ.get('CERTIFICATE_CACHE_DIR', str(ROOT_DIR / "cache" / "certificates")))
+# Certificate fields that appear on the PDF; any change produces a new cache key
+CERTIFICATE_RENDER_FIELDS = [
+    "certificate_id", "user_name", "vendor", "cert_name", "cert_code", "readiness_percentage",
+    "labs_completed", "assessments_passed", "projects_completed", "issued_at"
+]
+# Template fields the renderer compiles; template_id + version identify a compiled plan
+CERTIFICATE_TEMPLATE_RENDER_FIELDS = [
+    "template_id", "version", "background_color", "accent_color", "logo_url", "signature_url",
+    "signatory_name", "signatory_title", "include_badge", "include_qr", "custom_text"
+]
+# Absolute origin of the frontend's public verification page (/certificate/{id}) encoded in the QR code
+CERTIFICATE_VERIFY_BASE_URL = os.environ.get('CERTIFICATE_VERIFY_BASE_URL', '').rstrip('/')
+if urlsplit(CERTIFICATE_VERIFY_BASE_URL).scheme not in ("http", "https") or not urlsplit(CERTIFICATE_VERIFY_BASE_URL).netloc:
+    logger.warning("CERTIFICATE_VERIFY_BASE_URL is not an absolute http(s) URL; certificates are rendered without a QR code")
+    CERTIFICATE_VERIFY_BASE_URL = ""
+
+CERTIFICATE_RENDER_WORKERS = int(os.environ.get('CERTIFICATE_RENDER_WORKERS', str(min(4, os.cpu_count() or 1))))
+CERTIFICATE_RENDER_QUEUE_SIZE = int(os.environ.get('CERTIFICATE_RENDER_QUEUE_SIZE', '32'))  # Waiting renders beyond busy workers
+CERTIFICATE_RENDER_TIMEOUT_SECONDS = 20
+CERTIFICATE_RENDER_RETRY_AFTER_SECONDS = 5
+
+class RenderPoolBusy(Exception):
+    pass
+
+class CertificateRenderPool:
+    """Renders certificate PDFs in worker processes so ReportLab never blocks the event loop.
+
+    Workers are spawned (not forked from the threaded server) and warmed with the
+    stylesheet and fonts at startup. At most workers + queue size renders are in flight;
+    beyond that, and on timeout, callers get RenderPoolBusy and should answer 503.
+    """
+    
+    def __init__(self, workers: int, queue_size: int):
+        self.workers = workers
+        self.capacity = workers + queue_size
+        self.in_flight = 0
+        self.executor = None
+    
+    def get_executor(self) -> ProcessPoolExecutor:
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=warm_renderer
+            )
+        return self.executor
+    
+    async def start(self):
+        """Start every worker process now rather than on the first download"""
+        loop = asyncio.get_running_loop()
+        executor = self.get_executor()
+        try:
+            await asyncio.gather(*(loop.run_in_executor(executor, ping_renderer) for _ in range(self.workers)))
+            logger.info(f"Certificate render pool ready with {self.workers} workers")
+        except Exception as e:
+            logger.error(f"Certificate render pool failed to start: {e}")
+            self.shutdown()
+    
+    def release(self, _future=None):
+        self.in_flight -= 1
+    
+    async def run(self, func, *args):
+        if self.in_flight >= self.capacity:
+            raise RenderPoolBusy("Certificate rendering is at capacity")
+        loop = asyncio.get_running_loop()
+        try:
+            future = loop.run_in_executor(self.get_executor(), func, *args)
+        except BrokenProcessPool:
+            self.executor = None
+            future = loop.run_in_executor(self.get_executor(), func, *args)
+        # The slot is held until the worker actually finishes, even if the caller gave up
+        self.in_flight += 1
+        future.add_done_callback(self.release)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout=CERTIFICATE_RENDER_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            raise RenderPoolBusy("Certificate rendering timed out")
+        except BrokenProcessPool:
+            # A worker died; start a fresh pool for the next request
+            self.executor = None
+            raise RenderPoolBusy("Certificate renderer restarted")
+    
+    async def render(self, certificate: Dict, template: Optional[Dict]) -> bytes:
+        return await self.run(render_certificate_pdf, certificate_render_payload(certificate), template)
+    
+    def shutdown(self):
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+certificate_render_pool = CertificateRenderPool(CERTIFICATE_RENDER_WORKERS, CERTIFICATE_RENDER_QUEUE_SIZE)
+
+async def get_certificate_template(cert_id: str) -> Optional[Dict]:
+    """The certification's default template, or None for the built-in design"""
+    return await db.certificate_templates.find_one(
+        {"cert_id": cert_id, "is_default": True},
+        {"_id": 0, **{f: 1 for f in CERTIFICATE_TEMPLATE_RENDER_FIELDS}}
+    )
+
+def certificate_render_payload(certificate: Dict) -> Dict:
+    payload = {f: certificate.get(f) for f in CERTIFICATE_RENDER_FIELDS}
+    payload["verify_url"] = f"{CERTIFICATE_VERIFY_BASE_URL}/certificate/{certificate['certificate_id']}" if CERTIFICATE_VERIFY_BASE_URL else None
+    return payload
+
+def certificate_render_key(certificate: Dict, template: Optional[Dict]) -> str:
+    content = json.dumps(
+        {
+            "render_version": CERTIFICATE_RENDER_VERSION,
+            "template": [template["template_id"], template.get("version", 0)] if template else None,
+            **certificate_render_payload(certificate)
+        },
+        sort_keys=True, default=str
+    )
+    return hashlib.sha256(content.encode()).hexdigest()[:32]
+
+def certificate_cache_path(certificate_id: str, render_key: str) -> Path:
+    return CERTIFICATE_CACHE_DIR / f"{re.sub(r'[^A-Za-z0-9_-]', '_', certificate_id)}-{render_key}.pdf"
+
+def store_certificate_pdf(path: Path, pdf: bytes):
+    """Write atomically, then drop renders of the same certificate under older keys"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f".{uuid.uuid4().hex[:8]}.tmp")
+    tmp_path.write_bytes(pdf)
+    os.replace(tmp_path, path)
+    prefix = path.name.rsplit("-", 1)[0]
+    for stale in path.parent.glob(f"{prefix}-*.pdf"):
+        if stale != path:
+            stale.unlink(missing_ok=True)
+
 @api_router.get("/certificates/{certificate_id}/download")
-async def download_certificate(certificate_id: str, user: Dict = Depends(require_auth)):
-    """Download certificate as PDF"""
+async def download_certificate(certificate_id: str, request: Request, user: Dict = Depends(require_auth)):
+    """Download certificate as PDF, served from the render cache when possible"""
     certificate = await db.user_certificates.find_one(
         {"certificate_id": certificate_id, "user_id": user["user_id"]},
         {"_id": 0}
@@ -2030,96 +2775,43 @@ async def download_certificate(certificate_id: str, user: Dict = Depends(require
     if not certificate:
         raise HTTPException(status_code=404, detail="Certificate not found")
     
-    # Generate PDF
-    buffer = io.BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=landscape(A4), 
-                           rightMargin=50, leftMargin=50, 
-                           topMargin=50, bottomMargin=50)
-    
-    elements = []
-    styles = getSampleStyleSheet()
-    
-    # Custom styles
-    title_style = ParagraphStyle(
-        'CustomTitle',
-        parent=styles['Title'],
-        fontSize=36,
-        textColor=colors.HexColor('#06B6D4'),
-        spaceAfter=20,
-        alignment=TA_CENTER
-    )
-    
-    subtitle_style = ParagraphStyle(
-        'CustomSubtitle',
-        parent=styles['Normal'],
-        fontSize=14,
-        textColor=colors.HexColor('#71717A'),
-        spaceAfter=30,
-        alignment=TA_CENTER
-    )
-    
-    name_style = ParagraphStyle(
-        'NameStyle',
-        parent=styles['Title'],
-        fontSize=28,
-        textColor=colors.HexColor('#FFFFFF'),
-        spaceAfter=20,
-        alignment=TA_CENTER
-    )
-    
-    cert_style = ParagraphStyle(
-        'CertStyle',
-        parent=styles['Normal'],
-        fontSize=18,
-        textColor=colors.HexColor('#A1A1AA'),
-        spaceAfter=10,
-        alignment=TA_CENTER
-    )
-    
-    detail_style = ParagraphStyle(
-        'DetailStyle',
-        parent=styles['Normal'],
-        fontSize=12,
-        textColor=colors.HexColor('#71717A'),
-        alignment=TA_CENTER
-    )
-    
-    # Certificate content
-    elements.append(Spacer(1, 30))
-    elements.append(Paragraph("SKILLTRACK365", title_style))
-    elements.append(Paragraph("Certificate of Completion", subtitle_style))
-    elements.append(Spacer(1, 20))
-    elements.append(Paragraph("This certifies that", cert_style))
-    elements.append(Spacer(1, 10))
-    elements.append(Paragraph(certificate["user_name"], name_style))
-    elements.append(Spacer(1, 20))
-    elements.append(Paragraph("has successfully completed the certification path for", cert_style))
-    elements.append(Spacer(1, 10))
-    elements.append(Paragraph(f"{certificate['vendor']} {certificate['cert_name']}", name_style))
-    elements.append(Paragraph(f"({certificate['cert_code']})", cert_style))
-    elements.append(Spacer(1, 30))
-    
-    # Stats
-    stats_text = f"Readiness: {certificate['readiness_percentage']}% | Labs: {certificate['labs_completed']} | Assessments: {certificate['assessments_passed']} | Projects: {certificate['projects_completed']}"
-    elements.append(Paragraph(stats_text, detail_style))
-    elements.append(Spacer(1, 20))
-    
-    # Certificate ID and Date
-    issued_date = datetime.fromisoformat(certificate["issued_at"].replace('Z', '+00:00')).strftime("%B %d, %Y")
-    elements.append(Paragraph(f"Certificate ID: {certificate['certificate_id']}", detail_style))
-    elements.append(Paragraph(f"Issued: {issued_date}", detail_style))
-    
-    # Build PDF
-    doc.build(elements)
-    buffer.seek(0)
-    
+    template = await get_certificate_template(certificate["cert_id"])
+    render_key = certificate_render_key(certificate, template)
+    etag = f'"{render_key}"'
     filename = f"SkillTrack365_{certificate['cert_code']}_{certificate['certificate_id']}.pdf"
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "private, no-cache",
+        "Content-Disposition": f"attachment; filename={filename}"
+    }
+    if etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": headers["Cache-Control"]})
     
-    return StreamingResponse(
-        buffer,
-        media_type="application/pdf",
-        headers={"Content-Disposition": f"attachment; filename={filename}"}
-    )
+    path = certificate_cache_path(certificate_id, render_key)
+    if not await asyncio.to_thread(path.exists):
+        try:
+            pdf = await certificate_render_pool.render(certificate, template)
+        except RenderPoolBusy as e:
+            logger.warning(f"Certificate {certificate_id} not rendered: {e}")
+            raise HTTPException(
+                status_code=503,
+                detail="Certificate rendering is busy, please retry shortly",
+                headers={"Retry-After": str(CERTIFICATE_RENDER_RETRY_AFTER_SECONDS)}
+            )
+        except TemplateAssetError as e:
+            logger.warning(f"Certificate {certificate_id} not rendered: {e}")
+            raise HTTPException(
+                status_code=503,
+                detail="Certificate template images are unavailable, please retry shortly",
+                headers={"Retry-After": str(CERTIFICATE_RENDER_RETRY_AFTER_SECONDS)}
+            )
+        try:
+            await asyncio.to_thread(store_certificate_pdf, path, pdf)
+        except OSError as e:
+            logger.warning(f"Could not cache certificate {certificate_id}: {e}")
+            return Response(content=pdf, media_type="application/pdf", headers=headers)
+    
+    return FileResponse(path, media_type="application/pdf", headers=headers)
 
 @api_router.get("/certificates/public/{certificate_id}")
 async def get_public_certificate(certificate_id: str):
@@ -2874,13 +3566,14 @@ async def get_labs_catalog(
             user_completed_labs.update(progress.get("labs_completed", []))
     
     # Enrich labs with certification info and status
+    is_premium = has_premium_access(user, datetime.now(timezone.utc).isoformat())
     enriched_labs = []
     for lab in all_labs:
         cert = cert_map.get(lab["cert_id"], {})
         lab["certification_name"] = cert.get("name", "Unknown")
         lab["vendor"] = cert.get("vendor", "Unknown")
         lab["status"] = "completed" if lab["lab_id"] in user_completed_labs else "not_started"
-        lab["is_locked"] = user is None or (user.get("subscription_status") != "premium" and lab.get("difficulty") == "Advanced")
+        lab["is_locked"] = user is None or (not is_premium and lab.get("difficulty") == "Advanced")
         enriched_labs.append(lab)
     
     # Get unique filter options
@@ -2956,6 +3649,7 @@ async def get_projects_catalog(
             user_completed_projects.update(progress.get("projects_completed", []))
     
     # Enrich projects with certification info and status
+    is_premium = has_premium_access(user, datetime.now(timezone.utc).isoformat())
     enriched_projects = []
     all_technologies = set()
     for proj in all_projects:
@@ -2963,7 +3657,7 @@ async def get_projects_catalog(
         proj["certification_name"] = cert.get("name", "Unknown")
         proj["vendor"] = cert.get("vendor", "Unknown")
         proj["status"] = "completed" if proj["project_id"] in user_completed_projects else "not_started"
-        proj["is_locked"] = user is None or (user.get("subscription_status") != "premium" and proj.get("difficulty") == "Advanced")
+        proj["is_locked"] = user is None or (not is_premium and proj.get("difficulty") == "Advanced")
         enriched_projects.append(proj)
         if proj.get("technologies"):
             all_technologies.update(proj["technologies"])
@@ -3040,6 +3734,7 @@ async def get_assessments_catalog(
                 user_completed_assessments.add(assessment.get("assessment_id"))
     
     # Enrich assessments with certification info and status
+    is_premium = has_premium_access(user, datetime.now(timezone.utc).isoformat())
     enriched_assessments = []
     all_topics = set()
     for assess in all_assessments:
@@ -3047,7 +3742,7 @@ async def get_assessments_catalog(
         assess["certification_name"] = cert.get("name", "Unknown")
         assess["vendor"] = cert.get("vendor", "Unknown")
         assess["status"] = "completed" if assess["assessment_id"] in user_completed_assessments else "not_started"
-        assess["is_locked"] = user is None or (user.get("subscription_status") != "premium" and assess.get("type") == "full_exam")
+        assess["is_locked"] = user is None or (not is_premium and assess.get("type") == "full_exam")
         enriched_assessments.append(assess)
         if assess.get("topics"):
             all_topics.update(assess["topics"])
@@ -3078,6 +3773,321 @@ async def get_assessments_catalog(
 
 
 
+# ============== BACKGROUND JOBS ==============
+
+# Jobs live in db.background_jobs so any API worker can pick them up and a job
+# interrupted by a restart is reclaimed once its lease expires.
+JOB_WORKER_COUNT = int(os.environ.get("JOB_WORKER_COUNT", "2"))
+JOB_POLL_SECONDS = 2.0
+JOB_LEASE_SECONDS = 60
+JOB_MAX_ATTEMPTS = 5
+JOB_RETRY_BASE_SECONDS = 30  # Failed attempt n waits base * 2**(n-1) before it can be claimed again
+CASCADE_DELETE_BATCH_SIZE = 1000
+CASCADE_DELETE_CONCURRENCY = 4  # Collections cleared in parallel per job
+CASCADE_DELETE_PAUSE_SECONDS = 0.05  # Throttle between batches to spare the primary
+
+WORKER_ID = f"worker_{uuid.uuid4().hex[:8]}"
+background_tasks: List[asyncio.Task] = []
+job_wakeup = asyncio.Event()
+
+class JobLeaseLost(Exception):
+    """Raised when another worker has taken over a job"""
+
+class DeprovisionPending(Exception):
+    """Raised by a cascade step whose lab instances are still being released; the job is retried"""
+
+# Collections holding a user's data, with the field that references the user
+USER_CASCADE = [
+    ("user_progress", "user_id"),
+    ("user_badges", "user_id"),
+    ("user_bookmarks", "user_id"),
+    ("user_notes", "user_id"),
+    ("user_videos", "user_id"),
+    ("user_certificates", "user_id"),
+    ("profile_settings", "user_id"),
+    ("bookmarks", "user_id"),
+    ("notes", "user_id"),
+    ("certificates", "user_id"),
+    ("discussions", "author_id"),
+    ("discussion_posts", "user_id"),
+    ("discussion_replies", "user_id"),
+    ("discussion_votes", "user_id"),
+    ("forum_posts", "user_id"),
+    ("forum_replies", "user_id"),
+    ("exam_attempts", "user_id"),
+    ("lab_instances", "user_id"),
+    ("lab_usage_ledger", "user_id"),
+    ("lab_usage_counters", "user_id"),
+    ("resource_quotas", "user_id"),
+    ("payment_transactions", "user_id"),
+]
+
+# Collections whose documents need work before they are deleted; each hook gets a batch of _ids
+CASCADE_DELETE_HOOKS = {
+    "payment_transactions": remove_revenue_contributions,
+}
+
+# Collections holding a certification's content and learner activity
+CERTIFICATION_CASCADE = [
+    "labs",
+    "assessments",
+    "projects",
+    "videos",
+    "discussions",
+    "discussion_posts",
+    "forum_posts",
+    "user_progress",
+    "user_videos",
+    "lab_instances",
+    "exam_attempts",
+    "admin_exams",
+    "certificate_templates",
+    "question_bank",
+    "question_signatures",
+]
+
+async def enqueue_job(job_type: str, target: Dict, steps: List[Dict], admin: Dict) -> Dict:
+    """Persist a job and wake an idle worker"""
+    now = datetime.now(timezone.utc).isoformat()
+    job = {
+        "job_id": f"job_{uuid.uuid4().hex[:12]}",
+        "job_type": job_type,
+        "target": target,
+        "status": "queued",
+        "steps": [{**step, "total": None, "deleted": 0, "done": False} for step in steps],
+        "attempts": 0,
+        "not_before": None,
+        "error": None,
+        "created_by": admin["user_id"],
+        "created_at": now,
+        "updated_at": now,
+        "started_at": None,
+        "finished_at": None
+    }
+    await db.background_jobs.insert_one(job)
+    job.pop("_id", None)
+    job_wakeup.set()
+    return job
+
+async def enqueue_cascade_delete(target_type: str, target_id: str, steps: List[Dict], admin: Dict) -> Dict:
+    return await enqueue_job("cascade_delete", {"type": target_type, "id": target_id}, steps, admin)
+
+async def claim_job() -> Optional[Dict]:
+    """Atomically take the oldest queued job due to run, or a running job whose lease has expired"""
+    now = datetime.now(timezone.utc)
+    job = await db.background_jobs.find_one_and_update(
+        {"$or": [
+            {"status": "queued", "not_before": {"$not": {"$gt": now.isoformat()}}},
+            {"status": "running", "lease_expires_at": {"$lt": now.isoformat()}}
+        ]},
+        {
+            "$set": {
+                "status": "running",
+                "worker_id": WORKER_ID,
+                "lease_expires_at": (now + timedelta(seconds=JOB_LEASE_SECONDS)).isoformat(),
+                "updated_at": now.isoformat()
+            },
+            "$inc": {"attempts": 1}
+        },
+        sort=[("created_at", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+    if job:
+        job.pop("_id", None)
+    return job
+
+async def run_cascade_delete(job: Dict, lease_lost: asyncio.Event):
+    """Delete each step's documents in throttled batches, several collections at a time"""
+    semaphore = asyncio.Semaphore(CASCADE_DELETE_CONCURRENCY)
+    
+    async def run_step(index: int, step: Dict):
+        if step.get("done"):
+            return
+        collection = db[step["collection"]]
+        async with semaphore:
+            if step.get("total") is None:
+                total = await collection.count_documents(step["filter"])
+                await db.background_jobs.update_one(
+                    {"job_id": job["job_id"]},
+                    {"$set": {f"steps.{index}.total": step.get("deleted", 0) + total}}
+                )
+            while True:
+                if lease_lost.is_set():
+                    raise JobLeaseLost(job["job_id"])
+                docs = await collection.find(step["filter"], {"_id": 1}).limit(CASCADE_DELETE_BATCH_SIZE).to_list(CASCADE_DELETE_BATCH_SIZE)
+                if not docs:
+                    break
+                if step["collection"] in CASCADE_DELETE_HOOKS:
+                    await CASCADE_DELETE_HOOKS[step["collection"]]([d["_id"] for d in docs])
+                result = await collection.delete_many({"_id": {"$in": [d["_id"] for d in docs]}})
+                await db.background_jobs.update_one(
+                    {"job_id": job["job_id"]},
+                    {
+                        "$inc": {f"steps.{index}.deleted": result.deleted_count},
+                        "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}
+                    }
+                )
+                if len(docs) < CASCADE_DELETE_BATCH_SIZE:
+                    break
+                await asyncio.sleep(CASCADE_DELETE_PAUSE_SECONDS)
+            await db.background_jobs.update_one(
+                {"job_id": job["job_id"]},
+                {"$set": {f"steps.{index}.done": True}}
+            )
+    
+    # Hooked steps may write to collections other steps clear (e.g. the usage ledger), so they go first
+    steps = list(enumerate(job["steps"]))
+    hooked = {i for i, step in steps if step["collection"] in CASCADE_DELETE_HOOKS}
+    await asyncio.gather(*(run_step(i, step) for i, step in steps if i in hooked))
+    await asyncio.gather(*(run_step(i, step) for i, step in steps if i not in hooked))
+
+JOB_HANDLERS = {
+    "cascade_delete": run_cascade_delete,
+    "revenue_rollup_rebuild": run_revenue_rollup_rebuild,
+}
+
+async def run_job(job: Dict):
+    """Run a claimed job while renewing its lease; failed jobs are retried up to JOB_MAX_ATTEMPTS"""
+    lease_lost = asyncio.Event()
+    owned = {"job_id": job["job_id"], "worker_id": WORKER_ID}
+    
+    async def heartbeat():
+        while True:
+            await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+            result = await db.background_jobs.update_one(owned, {"$set": {
+                "lease_expires_at": (datetime.now(timezone.utc) + timedelta(seconds=JOB_LEASE_SECONDS)).isoformat()
+            }})
+            if result.matched_count == 0:
+                lease_lost.set()
+                return
+    
+    if not job.get("started_at"):
+        await db.background_jobs.update_one(owned, {"$set": {"started_at": datetime.now(timezone.utc).isoformat()}})
+    
+    heartbeat_task = asyncio.create_task(heartbeat())
+    try:
+        await JOB_HANDLERS[job["job_type"]](job, lease_lost)
+        await db.background_jobs.update_one(owned, {"$set": {
+            "status": "completed",
+            "error": None,
+            "finished_at": datetime.now(timezone.utc).isoformat(),
+            "updated_at": datetime.now(timezone.utc).isoformat()
+        }})
+        logger.info(f"Job {job['job_id']} ({job['job_type']}) completed")
+    except JobLeaseLost:
+        logger.warning(f"Job {job['job_id']} was taken over by another worker")
+    except Exception as e:
+        attempts = job.get("attempts", 1)
+        status = "failed" if attempts >= JOB_MAX_ATTEMPTS else "queued"
+        now = datetime.now(timezone.utc)
+        await db.background_jobs.update_one(owned, {"$set": {
+            "status": status,
+            "error": str(e),
+            "updated_at": now.isoformat(),
+            **({"finished_at": now.isoformat()} if status == "failed" else {
+                "not_before": (now + timedelta(seconds=JOB_RETRY_BASE_SECONDS * 2 ** (attempts - 1))).isoformat()
+            })
+        }})
+        # Waiting on deprovisioning is an expected retry, not a failure
+        log = logger.warning if isinstance(e, DeprovisionPending) and status == "queued" else logger.error
+        log(f"Job {job['job_id']} ({job['job_type']}) attempt {job.get('attempts')} failed: {e}")
+    finally:
+        heartbeat_task.cancel()
+
+async def job_worker():
+    while True:
+        try:
+            job = await claim_job()
+            if job:
+                await run_job(job)
+                continue
+            job_wakeup.clear()
+            try:
+                await asyncio.wait_for(job_wakeup.wait(), timeout=JOB_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Job worker error: {e}")
+            await asyncio.sleep(JOB_POLL_SECONDS)
+
+async def acquire_lock(name: str, ttl_seconds: int) -> bool:
+    """Take or renew a cluster-wide lock document; False while another worker holds it"""
+    now = datetime.now(timezone.utc)
+    try:
+        await db.scheduler_locks.update_one(
+            {"_id": name, "$or": [{"owner": WORKER_ID}, {"expires_at": {"$lt": now.isoformat()}}]},
+            {"$set": {
+                "owner": WORKER_ID,
+                "expires_at": (now + timedelta(seconds=ttl_seconds)).isoformat(),
+                "renewed_at": now.isoformat()
+            }},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        return False
+
+async def release_lock(name: str):
+    await db.scheduler_locks.delete_one({"_id": name, "owner": WORKER_ID})
+
+def job_progress(job: Dict) -> Dict:
+    """Add aggregate progress fields to a job document"""
+    steps = job.get("steps", [])
+    deleted = sum(s.get("deleted", 0) for s in steps)
+    known_total = sum(s["total"] for s in steps if s.get("total") is not None)
+    return {
+        **job,
+        "progress": {
+            "steps_done": len([s for s in steps if s.get("done")]),
+            "steps_total": len(steps),
+            "deleted": deleted,
+            "total": known_total if all(s.get("total") is not None for s in steps) else None
+        }
+    }
+
+@api_router.get("/admin/jobs")
+async def admin_list_jobs(
+    status: Optional[str] = None,
+    job_type: Optional[str] = None,
+    limit: int = 50,
+    admin: Dict = Depends(get_admin)
+):
+    """List background jobs, newest first"""
+    query = {}
+    if status:
+        query["status"] = status
+    if job_type:
+        query["job_type"] = job_type
+    jobs = await db.background_jobs.find(query, {"_id": 0}).sort("created_at", -1).limit(limit).to_list(limit)
+    return [job_progress(job) for job in jobs]
+
+@api_router.get("/admin/jobs/{job_id}")
+async def admin_get_job(job_id: str, admin: Dict = Depends(get_admin)):
+    """Get status and progress of a background job"""
+    job = await db.background_jobs.find_one({"job_id": job_id}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job_progress(job)
+
+@api_router.post("/admin/jobs/{job_id}/retry")
+async def admin_retry_job(job_id: str, admin: Dict = Depends(get_super_admin)):
+    """Requeue a failed job; completed steps are not repeated (super_admin only)"""
+    result = await db.background_jobs.update_one(
+        {"job_id": job_id, "status": "failed"},
+        {"$set": {
+            "status": "queued", "attempts": 0, "not_before": None, "finished_at": None,
+            "updated_at": datetime.now(timezone.utc).isoformat()
+        }}
+    )
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="Failed job not found")
+    job_wakeup.set()
+    logger.info(f"Super admin {admin['email']} requeued job {job_id}")
+    return {"message": "Job requeued", "job_id": job_id}
+
+
 # ============== ADMIN ROUTES ==============
 
 @api_router.get("/admin/dashboard")
@@ -3126,16 +4136,13 @@ async def get_admin_dashboard(admin: Dict = Depends(get_admin)):
     # Revenue statistics (if finance admin or super admin)
     revenue_stats = {}
     if admin.get("role") in ["super_admin", "finance_admin"]:
-        total_transactions = await db.payment_transactions.count_documents({})
-        paid_transactions = await db.payment_transactions.count_documents({"payment_status": "paid"})
-        
-        # Calculate total revenue (assuming $29 monthly, $290 yearly)
-        revenue_pipeline = [
-            {"$match": {"payment_status": "paid"}},
-            {"$group": {"_id": None, "total": {"$sum": "$amount"}}}
-        ]
-        revenue_result = await db.payment_transactions.aggregate(revenue_pipeline).to_list(length=1)
-        total_revenue = revenue_result[0]["total"] if revenue_result else 0
+        by_status = await db.revenue_rollups.aggregate([
+            {"$group": {"_id": "$status", "count": {"$sum": "$count"}, "total": {"$sum": "$amount"}}}
+        ]).to_list(length=None)
+        total_transactions = sum(row["count"] for row in by_status)
+        paid = next((row for row in by_status if row["_id"] == "paid"), {})
+        paid_transactions = paid.get("count", 0)
+        total_revenue = paid.get("total", 0)
         
         revenue_stats = {
             "total_transactions": total_transactions,
@@ -3173,17 +4180,7 @@ async def get_admin_dashboard(admin: Dict = Depends(get_admin)):
         "revenue": revenue_stats
     }
 
-@api_router.get("/admin/users")
-async def get_admin_users(
-    page: int = 1,
-    limit: int = 20,
-    search: Optional[str] = None,
-    role: Optional[str] = None,
-    status: Optional[str] = None,  # active, suspended, premium
-    admin: Dict = Depends(get_admin)
-):
-    """Get paginated list of users with filters"""
-    
+def admin_user_filter(search: Optional[str], role: Optional[str], status: Optional[str]) -> Dict:
     query = {}
     
     # Search filter
@@ -3205,6 +4202,28 @@ async def get_admin_users(
         query["is_suspended"] = {"$ne": True}
     elif status == "premium":
         query["subscription_status"] = "premium"
+    return query
+
+async def users_by_id(user_ids: List[str], projection: Dict) -> Dict[str, Dict]:
+    """Look up many users in one query, keyed by user_id"""
+    ids = list({user_id for user_id in user_ids if user_id})
+    if not ids:
+        return {}
+    users = await db.users.find({"user_id": {"$in": ids}}, {"_id": 0, "user_id": 1, **projection}).to_list(len(ids))
+    return {user.pop("user_id"): user for user in users}
+
+@api_router.get("/admin/users")
+async def get_admin_users(
+    page: int = 1,
+    limit: int = 20,
+    search: Optional[str] = None,
+    role: Optional[str] = None,
+    status: Optional[str] = None,  # active, suspended, premium
+    admin: Dict = Depends(get_admin)
+):
+    """Get paginated list of users with filters"""
+    
+    query = admin_user_filter(search, role, status)
     
     # Get total count
     total = await db.users.count_documents(query)
@@ -3353,22 +4372,24 @@ async def delete_user(
     if user_id == admin["user_id"]:
         raise HTTPException(status_code=400, detail="Cannot delete your own account")
     
-    # Delete user and all related data
-    await db.users.delete_one({"user_id": user_id})
+    # Remove the account and its sessions now; related data is cleared by a background job
+    result = await db.users.delete_one({"user_id": user_id})
+    if result.deleted_count == 0:
+        raise HTTPException(status_code=404, detail="User not found")
     await db.user_sessions.delete_many({"user_id": user_id})
-    await db.user_progress.delete_many({"user_id": user_id})
-    await db.user_badges.delete_many({"user_id": user_id})
-    await db.bookmarks.delete_many({"user_id": user_id})
-    await db.notes.delete_many({"user_id": user_id})
-    await db.certificates.delete_many({"user_id": user_id})
-    await db.discussions.delete_many({"author_id": user_id})
-    await db.payment_transactions.delete_many({"user_id": user_id})
     
-    logger.warning(f"Admin {admin['email']} DELETED user {user_id}")
+    job = await enqueue_cascade_delete(
+        "user", user_id,
+        [{"collection": collection, "filter": {field: user_id}} for collection, field in USER_CASCADE],
+        admin
+    )
+    
+    logger.warning(f"Admin {admin['email']} DELETED user {user_id} (cascade job {job['job_id']})")
     
     return {
-        "message": "User deleted successfully",
-        "user_id": user_id
+        "message": "User deleted; related data is being removed",
+        "user_id": user_id,
+        "job_id": job["job_id"]
     }
 
 @api_router.get("/admin/analytics/overview")
@@ -3660,19 +4681,18 @@ async def admin_delete_certification(cert_id: str, admin: Dict = Depends(get_adm
     if not existing:
         raise HTTPException(status_code=404, detail="Certification not found")
     
-    # Delete related content
-    await db.labs.delete_many({"cert_id": cert_id})
-    await db.assessments.delete_many({"cert_id": cert_id})
-    await db.projects.delete_many({"cert_id": cert_id})
-    await db.videos.delete_many({"cert_id": cert_id})
-    await db.discussions.delete_many({"cert_id": cert_id})
-    
-    # Delete certification
+    # Delete certification now; related content is cleared by a background job
     await db.certifications.delete_one({"cert_id": cert_id})
     
-    logger.warning(f"Admin {admin['email']} DELETED certification: {cert_id} and all related content")
+    job = await enqueue_cascade_delete(
+        "certification", cert_id,
+        [{"collection": collection, "filter": {"cert_id": cert_id}} for collection in CERTIFICATION_CASCADE],
+        admin
+    )
+    
+    logger.warning(f"Admin {admin['email']} DELETED certification: {cert_id} (cascade job {job['job_id']})")
     
-    return {"message": "Certification and related content deleted successfully"}
+    return {"message": "Certification deleted; related content is being removed", "job_id": job["job_id"]}
 
 
 # ===== LAB CRUD =====
@@ -3988,45 +5008,52 @@ async def admin_delete_project(project_id: str, admin: Dict = Depends(get_admin)
 
 # ===== CONTENT REORDERING =====
 
+async def reorder_content(collection, id_field: str, items: List[Dict[str, Any]], label: str) -> Dict:
+    """Validate ids with one query and apply all order changes in a single unordered bulk_write"""
+    orders = {}
+    for item in items:
+        if "id" not in item or not isinstance(item.get("order"), int):
+            raise HTTPException(status_code=400, detail="Each item needs an id and an integer order")
+        orders[item["id"]] = item["order"]
+    
+    if not orders:
+        return {"message": f"{label} reordered successfully", "matched": 0, "modified": 0}
+    
+    found = set(await collection.distinct(id_field, {id_field: {"$in": list(orders)}}))
+    missing = [item_id for item_id in orders if item_id not in found]
+    if missing:
+        shown = ", ".join(missing[:20]) + (f" (+{len(missing) - 20} more)" if len(missing) > 20 else "")
+        raise HTTPException(status_code=404, detail=f"{label} not found: {shown}")
+    
+    result = await collection.bulk_write(
+        [UpdateOne({id_field: item_id}, {"$set": {"order": order}}) for item_id, order in orders.items()],
+        ordered=False
+    )
+    return {
+        "message": f"{label} reordered successfully",
+        "matched": result.matched_count,
+        "modified": result.modified_count
+    }
+
 @api_router.post("/admin/certifications/reorder")
 async def admin_reorder_certifications(data: ContentReorderRequest, admin: Dict = Depends(get_admin)):
     """Reorder certifications"""
-    for item in data.items:
-        await db.certifications.update_one(
-            {"cert_id": item["id"]},
-            {"$set": {"order": item["order"]}}
-        )
-    return {"message": "Certifications reordered successfully"}
+    return await reorder_content(db.certifications, "cert_id", data.items, "Certifications")
 
 @api_router.post("/admin/labs/reorder")
 async def admin_reorder_labs(data: ContentReorderRequest, admin: Dict = Depends(get_admin)):
     """Reorder labs within a certification"""
-    for item in data.items:
-        await db.labs.update_one(
-            {"lab_id": item["id"]},
-            {"$set": {"order": item["order"]}}
-        )
-    return {"message": "Labs reordered successfully"}
+    return await reorder_content(db.labs, "lab_id", data.items, "Labs")
 
 @api_router.post("/admin/assessments/reorder")
 async def admin_reorder_assessments(data: ContentReorderRequest, admin: Dict = Depends(get_admin)):
     """Reorder assessments within a certification"""
-    for item in data.items:
-        await db.assessments.update_one(
-            {"assessment_id": item["id"]},
-            {"$set": {"order": item["order"]}}
-        )
-    return {"message": "Assessments reordered successfully"}
+    return await reorder_content(db.assessments, "assessment_id", data.items, "Assessments")
 
 @api_router.post("/admin/projects/reorder")
 async def admin_reorder_projects(data: ContentReorderRequest, admin: Dict = Depends(get_admin)):
     """Reorder projects within a certification"""
-    for item in data.items:
-        await db.projects.update_one(
-            {"project_id": item["id"]},
-            {"$set": {"order": item["order"]}}
-        )
-    return {"message": "Projects reordered successfully"}
+    return await reorder_content(db.projects, "project_id", data.items, "Projects")
 
 
 # ============== LAB ORCHESTRATION ROUTES ==============
@@ -4039,6 +5066,8 @@ CLOUD_PROVIDERS = {
         "is_enabled": True,
         "regions": ["us-east-1", "us-west-2", "eu-west-1", "ap-southeast-1"],
         "resource_types": ["EC2", "Lambda", "S3", "RDS", "EKS"],
+        "max_concurrent_provisions": 10,
+        "region_vcpu_capacity": 2000,
         "instance_types": {
             "small": {"vcpu": 2, "memory_gb": 4, "cost_per_hour": 0.05},
             "medium": {"vcpu": 4, "memory_gb": 8, "cost_per_hour": 0.10},
@@ -4051,6 +5080,8 @@ CLOUD_PROVIDERS = {
         "is_enabled": True,
         "regions": ["us-central1", "us-east4", "europe-west1", "asia-east1"],
         "resource_types": ["Compute Engine", "Cloud Functions", "Cloud Storage", "Cloud SQL", "GKE"],
+        "max_concurrent_provisions": 10,
+        "region_vcpu_capacity": 2000,
         "instance_types": {
             "small": {"vcpu": 2, "memory_gb": 4, "cost_per_hour": 0.04},
             "medium": {"vcpu": 4, "memory_gb": 8, "cost_per_hour": 0.09},
@@ -4063,6 +5094,8 @@ CLOUD_PROVIDERS = {
         "is_enabled": True,
         "regions": ["eastus", "westus2", "northeurope", "southeastasia"],
         "resource_types": ["Virtual Machines", "Functions", "Blob Storage", "SQL Database", "AKS"],
+        "max_concurrent_provisions": 10,
+        "region_vcpu_capacity": 2000,
         "instance_types": {
             "small": {"vcpu": 2, "memory_gb": 4, "cost_per_hour": 0.045},
             "medium": {"vcpu": 4, "memory_gb": 8, "cost_per_hour": 0.095},
@@ -4081,6 +5114,1233 @@ DEFAULT_QUOTA = {
 }
 
 
+# === Provider Registry ===
+
+PROVIDER_REGISTRY_TTL_SECONDS = 60  # Picks up overrides changed on other API workers
+
+class ProviderRegistry:
+    """CLOUD_PROVIDERS merged with the admin overrides in db.cloud_providers, held in memory.
+
+    Overrides are loaded once and reloaded after admin_update_provider (and at
+    most every PROVIDER_REGISTRY_TTL_SECONDS otherwise), so launch and placement
+    paths never query cloud_providers.
+    """
+    
+    def __init__(self):
+        self.providers: Dict[str, Dict] = {pid: dict(config) for pid, config in CLOUD_PROVIDERS.items()}
+        self.loaded_at = None
+        self.lock = asyncio.Lock()
+    
+    async def refresh(self):
+        overrides = await db.cloud_providers.find({}, {"_id": 0}).to_list(100)
+        override_map = {p["provider_id"]: p for p in overrides}
+        self.providers = {pid: {**config, **override_map.get(pid, {})} for pid, config in CLOUD_PROVIDERS.items()}
+        self.loaded_at = asyncio.get_running_loop().time()
+    
+    async def get_all(self) -> Dict[str, Dict]:
+        if self.loaded_at is None or asyncio.get_running_loop().time() - self.loaded_at >= PROVIDER_REGISTRY_TTL_SECONDS:
+            async with self.lock:
+                if self.loaded_at is None or asyncio.get_running_loop().time() - self.loaded_at >= PROVIDER_REGISTRY_TTL_SECONDS:
+                    await self.refresh()
+        return self.providers
+    
+    def get(self, provider_id: str) -> Dict:
+        """Last loaded configuration for a provider (for synchronous callers)"""
+        return self.providers.get(provider_id, {})
+
+provider_registry = ProviderRegistry()
+
+
+# === Lab Placement ===
+
+LAB_CAPACITY_REFRESH_SECONDS = 15
+LAB_PLACEMENT_LOAD_WEIGHT = 1.0  # Price multiplier applied at 100% region utilisation
+
+class CapacityTracker:
+    """Cached active vCPU and instance counts per (provider, region).
+
+    Refreshed from $group aggregations over active lab instances and unclaimed
+    warm pool environments at most every LAB_CAPACITY_REFRESH_SECONDS;
+    placements made in between are added locally so bursts of launches on this
+    worker see each other.
+    """
+    
+    def __init__(self):
+        self.usage: Dict[tuple, Dict[str, float]] = {}
+        self.refreshed_at = 0.0
+        self.lock = asyncio.Lock()
+    
+    async def refresh(self):
+        pipeline = [
+            {"$match": {"status": {"$in": LAB_ACTIVE_STATUSES}}},
+            {"$group": {
+                "_id": {"provider": "$provider", "region": "$region"},
+                "vcpu": {"$sum": "$resources.vcpu"},
+                "instances": {"$sum": 1}
+            }}
+        ]
+        usage = {}
+        async for row in db.lab_instances.aggregate(pipeline):
+            usage[(row["_id"]["provider"], row["_id"]["region"])] = {
+                "vcpu": row["vcpu"], "instances": row["instances"], "warm": 0
+            }
+        # Warm environments hold their vCPUs until claimed (then the instance counts them)
+        pipeline[0] = {"$match": {"status": {"$in": ["provisioning", "ready"]}}}
+        async for row in db.lab_warm_pool.aggregate(pipeline):
+            slot = usage.setdefault((row["_id"]["provider"], row["_id"]["region"]), {"vcpu": 0, "instances": 0, "warm": 0})
+            slot["vcpu"] += row["vcpu"]
+            slot["warm"] += row["instances"]
+        self.usage = usage
+        self.refreshed_at = asyncio.get_running_loop().time()
+    
+    async def snapshot(self) -> Dict[tuple, Dict[str, float]]:
+        if asyncio.get_running_loop().time() - self.refreshed_at >= LAB_CAPACITY_REFRESH_SECONDS:
+            async with self.lock:
+                if asyncio.get_running_loop().time() - self.refreshed_at >= LAB_CAPACITY_REFRESH_SECONDS:
+                    await self.refresh()
+        return self.usage
+    
+    def reserve(self, provider: str, region: str, vcpu: float, warm: bool = False):
+        slot = self.usage.setdefault((provider, region), {"vcpu": 0, "instances": 0, "warm": 0})
+        slot["vcpu"] += vcpu
+        slot["warm" if warm else "instances"] += 1
+
+capacity_tracker = CapacityTracker()
+
+
+def rank_placements(
+    providers: Dict[str, Dict],
+    usage: Dict[tuple, Dict[str, float]],
+    allowed_providers: List[str],
+    allowed_instance_types: List[str],
+    provider: Optional[str] = None,
+    region: Optional[str] = None,
+    instance_type: Optional[str] = None
+) -> List[Dict]:
+    """Candidate (provider, region, instance type) placements with room left, best first.
+
+    Without an explicit instance type the smallest allowed one is used. Each
+    candidate is scored by its hourly price scaled up by how full the region
+    would be after placing it, so cheap regions fill first until load evens out.
+    """
+    options = []
+    for pid, config in providers.items():
+        if not config.get("is_enabled", True) or pid not in allowed_providers:
+            continue
+        if provider and pid != provider:
+            continue
+        types = config["instance_types"]
+        if instance_type:
+            candidates = [instance_type] if instance_type in types else []
+        else:
+            candidates = sorted((t for t in allowed_instance_types if t in types), key=lambda t: types[t]["vcpu"])[:1]
+        for itype in candidates:
+            spec = types[itype]
+            capacity = config.get("region_vcpu_capacity", 0)
+            for r in config.get("regions", []):
+                if region and r != region:
+                    continue
+                used = usage.get((pid, r), {}).get("vcpu", 0)
+                if used + spec["vcpu"] > capacity:
+                    continue
+                load = (used + spec["vcpu"]) / capacity
+                options.append({
+                    "provider": pid,
+                    "region": r,
+                    "instance_type": itype,
+                    "vcpu": spec["vcpu"],
+                    "memory_gb": spec["memory_gb"],
+                    "cost_per_hour": spec["cost_per_hour"],
+                    "utilization": round(load, 4),
+                    "score": spec["cost_per_hour"] * (1 + LAB_PLACEMENT_LOAD_WEIGHT * load)
+                })
+    return sorted(options, key=lambda o: o["score"])
+
+
+# === Lab Usage Metering ===
+
+# Running time is metered: an interval opens when an instance reaches running
+# (running_since) and closes when it is suspended, terminated or expires. Every
+# transition is appended to lab_usage_ledger, and closed intervals are rolled up
+# with $inc into per-user day/month documents in lab_usage_counters, so quota
+# checks read two small documents instead of the user's session history.
+
+def usage_counter_id(user_id: str, period: str, key: str) -> str:
+    return f"{user_id}|{period}|{key}"
+
+def split_hours_by_day(start: datetime, end: datetime) -> Dict[str, float]:
+    """Hours between start and end, keyed by UTC day (YYYY-MM-DD)"""
+    days = {}
+    cursor = start
+    while cursor < end:
+        next_day = (cursor + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+        chunk_end = min(end, next_day)
+        day = cursor.strftime("%Y-%m-%d")
+        days[day] = days.get(day, 0.0) + (chunk_end - cursor).total_seconds() / 3600
+        cursor = chunk_end
+    return days
+
+def split_hours_by_hour(start: datetime, end: datetime) -> Dict[str, float]:
+    """Hours between start and end, keyed by the UTC hour bucket they fall in"""
+    hours = {}
+    cursor = start
+    while cursor < end:
+        bucket = cursor.replace(minute=0, second=0, microsecond=0)
+        chunk_end = min(end, bucket + timedelta(hours=1))
+        key = bucket.isoformat()
+        hours[key] = hours.get(key, 0.0) + (chunk_end - cursor).total_seconds() / 3600
+        cursor = chunk_end
+    return hours
+
+def lab_metrics_hour(moment: datetime) -> str:
+    return moment.astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0).isoformat()
+
+async def record_lab_metrics(buckets: Dict[str, Dict[str, float]]):
+    """$inc counters in the hourly lab_metrics_hourly documents (one per UTC hour)"""
+    if not buckets:
+        return
+    await db.lab_metrics_hourly.bulk_write([
+        UpdateOne({"_id": hour}, {"$inc": increments, "$setOnInsert": {"hour": hour}}, upsert=True)
+        for hour, increments in buckets.items()
+    ], ordered=False)
+
+def lab_cost_per_hour(instance: Dict) -> float:
+    provider = provider_registry.get(instance.get("provider"))
+    return provider.get("instance_types", {}).get(instance.get("instance_type"), {}).get("cost_per_hour", 0.0)
+
+async def append_lab_usage(instances: List[Dict], event: str, now: datetime):
+    """Append ledger entries for a lifecycle event and roll closed intervals into the counters"""
+    entries = []
+    intervals = {}
+    for inst in instances:
+        entry = {
+            "entry_id": f"usage_{uuid.uuid4().hex[:12]}",
+            "user_id": inst["user_id"],
+            "instance_id": inst["instance_id"],
+            "lab_id": inst.get("lab_id"),
+            "provider": inst.get("provider"),
+            "instance_type": inst.get("instance_type"),
+            "event": event,
+            "at": now.isoformat()
+        }
+        if inst.get("running_since"):
+            start = parse_timestamp(inst["running_since"])
+            # Deterministic id for the closing entry: if two paths race to close the
+            # same interval (e.g. suspend vs. the expiry reaper) only one is counted
+            interval_key = f"{inst['instance_id']}|{inst['running_since']}"
+            entry["entry_id"] = f"usage_{hashlib.sha1(interval_key.encode()).hexdigest()[:16]}"
+            entry["interval_start"] = start.isoformat()
+            entry["interval_end"] = now.isoformat()
+            entry["hours"] = round(max(0.0, (now - start).total_seconds()) / 3600, 4)
+            intervals[len(entries)] = start
+        entries.append(entry)
+    if not entries:
+        return
+    
+    duplicates = set()
+    try:
+        await db.lab_usage_ledger.insert_many(entries, ordered=False)
+    except BulkWriteError as e:
+        for err in e.details.get("writeErrors", []):
+            if err.get("code") == 11000:
+                duplicates.add(err["index"])
+            else:
+                logger.error(f"Usage ledger write failed for {entries[err['index']]['instance_id']}: {err.get('errmsg')}")
+                duplicates.add(err["index"])
+    
+    increments = {}
+    metrics = {}
+    for index, start in intervals.items():
+        if index in duplicates:
+            continue
+        user_id = entries[index]["user_id"]
+        for day, hours in split_hours_by_day(start, now).items():
+            for period, key in (("day", day), ("month", day[:7])):
+                counter = (user_id, period, key)
+                increments[counter] = increments.get(counter, 0.0) + hours
+        
+        inst = instances[index]
+        vcpu = inst.get("resources", {}).get("vcpu", 0)
+        cost_per_hour = lab_cost_per_hour(inst)
+        for hour, hours in split_hours_by_hour(start, now).items():
+            bucket = metrics.setdefault(hour, {"lab_hours": 0.0, "vcpu_hours": 0.0, "cost": 0.0})
+            bucket["lab_hours"] += hours
+            bucket["vcpu_hours"] += hours * vcpu
+            bucket["cost"] += hours * cost_per_hour
+    await record_lab_metrics(metrics)
+    if increments:
+        await db.lab_usage_counters.bulk_write([
+            UpdateOne(
+                {"_id": usage_counter_id(user_id, period, key)},
+                {
+                    "$inc": {"lab_hours": hours},
+                    "$setOnInsert": {"user_id": user_id, "period": period, "key": key}
+                },
+                upsert=True
+            )
+            for (user_id, period, key), hours in increments.items()
+        ], ordered=False)
+
+async def get_active_lab_instances(user_id: str) -> List[Dict]:
+    return await db.lab_instances.find(
+        {"user_id": user_id, "status": {"$in": LAB_ACTIVE_STATUSES}},
+        {"_id": 0, "instance_id": 1, "status": 1, "running_since": 1}
+    ).to_list(100)
+
+async def get_lab_usage(user_id: str, active_instances: List[Dict], now: datetime) -> Dict:
+    """Today's and this month's lab hours: rolled-up counters plus still-open intervals"""
+    day_key = now.strftime("%Y-%m-%d")
+    month_key = now.strftime("%Y-%m")
+    counters = await db.lab_usage_counters.find(
+        {"_id": {"$in": [usage_counter_id(user_id, "day", day_key), usage_counter_id(user_id, "month", month_key)]}}
+    ).to_list(2)
+    hours = {c["period"]: c.get("lab_hours", 0.0) for c in counters}
+    daily = hours.get("day", 0.0)
+    monthly = hours.get("month", 0.0)
+    
+    for inst in active_instances:
+        if not inst.get("running_since"):
+            continue
+        for day, open_hours in split_hours_by_day(parse_timestamp(inst["running_since"]), now).items():
+            if day == day_key:
+                daily += open_hours
+            if day.startswith(month_key):
+                monthly += open_hours
+    
+    return {
+        "date": day_key,
+        "month": month_key,
+        "daily_lab_hours": round(daily, 2),
+        "monthly_lab_hours": round(monthly, 2),
+        "active_labs": len(active_instances)
+    }
+
+async def transition_lab_instance(instance_id: str, status: str, event: str, query: Optional[Dict] = None, **fields) -> Optional[Dict]:
+    """Set an instance's status, opening or closing its metered running interval.
+
+    Returns the instance as it was before the update, or None if nothing matched.
+    """
+    now = datetime.now(timezone.utc)
+    update = {"$set": {"status": status, "updated_at": now.isoformat(), **fields}}
+    filter_query = {"instance_id": instance_id, **(query or {})}
+    if status == "running":
+        filter_query.setdefault("status", {"$ne": "running"})
+        update["$set"]["running_since"] = now.isoformat()
+    else:
+        update["$unset"] = {"running_since": ""}
+    if status == "terminated":
+        # Cloud resources are released by LabProvisioningPipeline.release
+        update["$set"]["deprovision_status"] = "pending"
+    
+    before = await db.lab_instances.find_one_and_update(filter_query, update)
+    if not before:
+        return None
+    before.pop("_id", None)
+    await append_lab_usage([before], event, now)
+    return before
+
+
+# === Lab Instance Events ===
+
+LAB_EVENTS_QUEUE_SIZE = 100
+LAB_EVENTS_KEEPALIVE_SECONDS = 15
+LAB_EVENTS_RESYNC_SECONDS = 60  # Picks up transitions published on other API workers
+LAB_EXPIRY_WARNING_MINUTES = 10
+
+class LabEventBus:
+    """In-process fan-out of lab instance events to each user's open event streams"""
+    
+    def __init__(self):
+        self.subscribers: Dict[str, set] = {}
+    
+    def subscribe(self, user_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=LAB_EVENTS_QUEUE_SIZE)
+        self.subscribers.setdefault(user_id, set()).add(queue)
+        return queue
+    
+    def unsubscribe(self, user_id: str, queue: asyncio.Queue):
+        queues = self.subscribers.get(user_id)
+        if queues:
+            queues.discard(queue)
+            if not queues:
+                del self.subscribers[user_id]
+    
+    def publish(self, user_id: str, event: Dict):
+        for queue in self.subscribers.get(user_id, ()):
+            if queue.full():
+                # A stalled client loses its oldest event rather than blocking the publisher
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+lab_events = LabEventBus()
+
+def publish_lab_status(instance: Dict, status: str, **fields):
+    """Tell the instance owner's streams that the instance changed state"""
+    lab_events.publish(instance["user_id"], {
+        "type": "status",
+        "instance_id": instance["instance_id"],
+        "lab_id": instance.get("lab_id"),
+        "status": status,
+        "expires_at": fields.get("expires_at", instance.get("expires_at")),
+        "error_message": fields.get("error_message", instance.get("error_message")),
+        "at": datetime.now(timezone.utc).isoformat()
+    })
+
+def format_sse(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+async def lab_event_stream(request: Request, user_id: str):
+    """Yield a snapshot of the user's instances, then transitions and expiry warnings"""
+    queue = lab_events.subscribe(user_id)
+    known = {}  # instance_id -> last state sent to the client
+    warned = set()  # (instance_id, expires_at) pairs already warned about
+    projection = {"_id": 0, "instance_id": 1, "lab_id": 1, "status": 1, "expires_at": 1, "error_message": 1}
+    
+    async def load_instances() -> List[Dict]:
+        return await db.lab_instances.find(
+            {"user_id": user_id, "$or": [
+                {"status": {"$in": LAB_ACTIVE_STATUSES}},
+                {"instance_id": {"$in": list(known)}}
+            ]},
+            projection
+        ).to_list(100)
+    
+    def remember(state: Dict):
+        if state["status"] in LAB_ACTIVE_STATUSES:
+            known[state["instance_id"]] = state
+        else:
+            known.pop(state["instance_id"], None)
+    
+    def expiry_warnings(now: datetime) -> List[Dict]:
+        warnings = []
+        for state in known.values():
+            if state["status"] == "provisioning" or not state.get("expires_at"):
+                continue
+            key = (state["instance_id"], state["expires_at"])
+            expires_at = parse_timestamp(state["expires_at"])
+            if key not in warned and now >= expires_at - timedelta(minutes=LAB_EXPIRY_WARNING_MINUTES):
+                warned.add(key)
+                warnings.append({
+                    "type": "expiry_warning",
+                    "instance_id": state["instance_id"],
+                    "expires_at": state["expires_at"],
+                    "seconds_remaining": max(0, int((expires_at - now).total_seconds()))
+                })
+        return warnings
+    
+    def seconds_until_warning(now: datetime) -> float:
+        deadlines = [
+            (parse_timestamp(state["expires_at"]) - timedelta(minutes=LAB_EXPIRY_WARNING_MINUTES) - now).total_seconds()
+            for state in known.values()
+            if state["status"] != "provisioning" and state.get("expires_at")
+            and (state["instance_id"], state["expires_at"]) not in warned
+        ]
+        return max(0.0, min(deadlines)) if deadlines else float("inf")
+    
+    try:
+        instances = await load_instances()
+        for inst in instances:
+            remember(inst)
+        yield format_sse("snapshot", {"instances": instances})
+        
+        loop = asyncio.get_running_loop()
+        last_sent = last_sync = loop.time()
+        while not await request.is_disconnected():
+            now = datetime.now(timezone.utc)
+            for warning in expiry_warnings(now):
+                yield format_sse("expiry_warning", warning)
+                last_sent = loop.time()
+            
+            timeout = min(
+                LAB_EVENTS_KEEPALIVE_SECONDS - (loop.time() - last_sent),
+                LAB_EVENTS_RESYNC_SECONDS - (loop.time() - last_sync),
+                seconds_until_warning(now)
+            )
+            try:
+                event = await asyncio.wait_for(queue.get(), timeout=max(0.0, timeout))
+            except asyncio.TimeoutError:
+                event = None
+            
+            if event:
+                remember({k: event[k] for k in projection if k in event})
+                yield format_sse("status", event)
+                last_sent = loop.time()
+                continue
+            
+            if loop.time() - last_sync >= LAB_EVENTS_RESYNC_SECONDS:
+                last_sync = loop.time()
+                for inst in await load_instances():
+                    previous = known.get(inst["instance_id"])
+                    if previous and previous["status"] == inst["status"] and previous.get("expires_at") == inst.get("expires_at"):
+                        continue
+                    if not previous and inst["status"] not in LAB_ACTIVE_STATUSES:
+                        continue
+                    remember(inst)
+                    yield format_sse("status", {"type": "status", **inst, "at": datetime.now(timezone.utc).isoformat()})
+                    last_sent = loop.time()
+            if loop.time() - last_sent >= LAB_EVENTS_KEEPALIVE_SECONDS:
+                yield ": keepalive\n\n"
+                last_sent = loop.time()
+    finally:
+        lab_events.unsubscribe(user_id, queue)
+
+
+# === Lab Instance Lifecycle ===
+
+LAB_ACTIVE_STATUSES = ["provisioning", "running", "suspended"]
+LAB_REAPER_LOCK = "lab_lifecycle"
+LAB_REAPER_LOCK_TTL_SECONDS = 30
+LAB_REAPER_REFRESH_SECONDS = 60  # Reload upcoming expiries written by other workers
+LAB_REAPER_HORIZON_MINUTES = 15
+LAB_REAPER_BATCH_SIZE = 500
+
+def parse_timestamp(value) -> datetime:
+    """Parse a stored ISO timestamp (or datetime) into an aware UTC datetime"""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value
+
+async def terminate_expired_lab_instances(instance_ids: List[str], now: datetime) -> int:
+    """Terminate the given instances if they are still active and past their expiry"""
+    query = {
+        "instance_id": {"$in": instance_ids},
+        "status": {"$in": LAB_ACTIVE_STATUSES},
+        "expires_at": {"$lte": now.isoformat()}
+    }
+    expired = await db.lab_instances.find(
+        query,
+        {"_id": 0, "instance_id": 1, "user_id": 1, "lab_id": 1, "provider": 1,
+         "instance_type": 1, "resources": 1, "expires_at": 1, "running_since": 1}
+    ).to_list(len(instance_ids))
+    if not expired:
+        return 0
+    # Re-check expiry and the open interval per instance: an extend, suspend or resume
+    # landing after the find leaves that instance alone, and the batch id tells us
+    # which instances this update actually terminated
+    batch_id = f"expiry_{uuid.uuid4().hex[:12]}"
+    await db.lab_instances.update_many(
+        {
+            **query,
+            "$or": [
+                {"instance_id": inst["instance_id"], "running_since": inst.get("running_since") or {"$exists": False}}
+                for inst in expired
+            ]
+        },
+        {
+            "$set": {
+                "status": "terminated",
+                "terminated_at": now.isoformat(),
+                "termination_reason": "expired",
+                "expiry_batch_id": batch_id,
+                "deprovision_status": "pending",
+                "updated_at": now.isoformat()
+            },
+            "$unset": {"running_since": ""}
+        }
+    )
+    terminated = {
+        inst["instance_id"] async for inst in db.lab_instances.find({"expiry_batch_id": batch_id}, {"_id": 0, "instance_id": 1})
+    }
+    expired = [inst for inst in expired if inst["instance_id"] in terminated]
+    await append_lab_usage(expired, "expire", now)
+    for inst in expired:
+        publish_lab_status(inst, "terminated")
+        provisioning_pipeline.submit_release(inst["instance_id"])
+    return len(expired)
+
+async def terminate_cascaded_lab_instances(ids: List[Any]):
+    """Cascade hook: terminate active instances through the lifecycle and release their resources"""
+    now = datetime.now(timezone.utc)
+    instances = await db.lab_instances.find(
+        {"_id": {"$in": ids}, "status": {"$ne": "terminated"}}, {"_id": 0}
+    ).to_list(len(ids))
+    for inst in instances:
+        if await transition_lab_instance(
+            inst["instance_id"], "terminated", "terminate", {"status": {"$ne": "terminated"}},
+            terminated_at=now.isoformat(), termination_reason="deleted"
+        ):
+            publish_lab_status(inst, "terminated")
+    # Releases that gave up earlier get another round now that the documents are going away
+    await db.lab_instances.update_many(
+        {"_id": {"$in": ids}, "deprovision_status": "failed"},
+        {"$set": {"deprovision_status": "pending", "deprovision_attempts": 0}, "$unset": {"deprovision_retry_at": ""}}
+    )
+    unreleased = 0
+    async for inst in db.lab_instances.find({"_id": {"$in": ids}, "deprovision_status": "pending"}, {"_id": 0, "instance_id": 1}):
+        if not await provisioning_pipeline.release(inst["instance_id"]):
+            unreleased += 1
+    if unreleased:
+        # Raising requeues the job with backoff; deleting now would leak the resources
+        raise DeprovisionPending(f"{unreleased} lab instance(s) not yet deprovisioned")
+
+CASCADE_DELETE_HOOKS["lab_instances"] = terminate_cascaded_lab_instances
+
+class LabLifecycleScheduler:
+    """Terminates lab instances when they expire.
+
+    Only the worker holding the lab_lifecycle lock runs the reaper. It keeps a
+    min-heap of (expires_at, instance_id) loaded from the (status, expires_at)
+    index and sleeps until the earliest deadline. Extending an instance pushes a
+    new entry; the superseded one is skipped when popped.
+    """
+    
+    def __init__(self):
+        self.heap = []
+        self.deadlines = {}
+        self.wakeup = asyncio.Event()
+        self.is_leader = False
+    
+    def schedule(self, instance_id: str, expires_at):
+        """Record an instance's (new) expiry; a no-op on workers that are not the leader"""
+        if not self.is_leader or not expires_at:
+            return
+        expires_at = parse_timestamp(expires_at)
+        if self.deadlines.get(instance_id) == expires_at:
+            return
+        self.deadlines[instance_id] = expires_at
+        heapq.heappush(self.heap, (expires_at, instance_id))
+        if self.heap[0][1] == instance_id:
+            self.wakeup.set()
+    
+    async def load(self):
+        """Load active instances expiring within the horizon (including overdue ones)"""
+        horizon = datetime.now(timezone.utc) + timedelta(minutes=LAB_REAPER_HORIZON_MINUTES)
+        cursor = db.lab_instances.find(
+            {"status": {"$in": LAB_ACTIVE_STATUSES}, "expires_at": {"$lte": horizon.isoformat()}},
+            {"_id": 0, "instance_id": 1, "expires_at": 1}
+        ).sort("expires_at", 1)
+        async for inst in cursor:
+            self.schedule(inst["instance_id"], inst["expires_at"])
+    
+    async def reap_due(self) -> int:
+        """Terminate one batch of due instances; returns how many heap entries were due"""
+        now = datetime.now(timezone.utc)
+        due = []
+        while self.heap and self.heap[0][0] <= now and len(due) < LAB_REAPER_BATCH_SIZE:
+            expires_at, instance_id = heapq.heappop(self.heap)
+            if self.deadlines.get(instance_id) != expires_at:
+                continue
+            del self.deadlines[instance_id]
+            due.append(instance_id)
+        if due:
+            terminated = await terminate_expired_lab_instances(due, now)
+            if terminated:
+                logger.info(f"Lab reaper terminated {terminated} expired instances")
+        return len(due)
+    
+    def seconds_until_next(self) -> float:
+        if not self.heap:
+            return float(LAB_REAPER_REFRESH_SECONDS)
+        return max(0.0, (self.heap[0][0] - datetime.now(timezone.utc)).total_seconds())
+    
+    async def run(self):
+        last_refresh = None
+        while True:
+            try:
+                if not await acquire_lock(LAB_REAPER_LOCK, LAB_REAPER_LOCK_TTL_SECONDS):
+                    if self.is_leader:
+                        logger.warning("Lab reaper lost leadership")
+                        self.is_leader = False
+                        self.heap.clear()
+                        self.deadlines.clear()
+                    await asyncio.sleep(LAB_REAPER_LOCK_TTL_SECONDS / 3)
+                    continue
+                
+                now = datetime.now(timezone.utc)
+                if not self.is_leader:
+                    logger.info(f"Lab reaper leadership acquired by {WORKER_ID}")
+                    self.is_leader = True
+                    last_refresh = None
+                if last_refresh is None or (now - last_refresh).total_seconds() >= LAB_REAPER_REFRESH_SECONDS:
+                    await self.load()
+                    last_refresh = now
+                
+                while await self.reap_due() >= LAB_REAPER_BATCH_SIZE:
+                    pass
+                
+                timeout = min(self.seconds_until_next(), LAB_REAPER_REFRESH_SECONDS, LAB_REAPER_LOCK_TTL_SECONDS / 3)
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Lab reaper error: {e}")
+                await asyncio.sleep(LAB_REAPER_LOCK_TTL_SECONDS / 3)
+
+lab_scheduler = LabLifecycleScheduler()
+
+
+# === Lab Provisioning Pipeline ===
+
+LAB_SESSION_HOURS = 2
+LAB_PROVISION_WORKERS = int(os.environ.get("LAB_PROVISION_WORKERS", "8"))
+LAB_PROVISION_QUEUE_SIZE = 1000
+LAB_PROVISION_MAX_ATTEMPTS = 3
+LAB_PROVISION_RETRY_BASE_SECONDS = 1.0
+LAB_PROVISION_LEASE_SECONDS = 120
+LAB_PROVISION_RECOVERY_SECONDS = 30  # Sweep for instances whose provisioning worker went away
+LAB_DEPROVISION_MAX_ATTEMPTS = 5
+LAB_DEPROVISION_RETRY_BASE_SECONDS = 30.0
+LAB_SIMULATED_LATENCY_MIN = float(os.environ.get("LAB_SIMULATED_LATENCY_MIN", "1.0"))
+LAB_SIMULATED_LATENCY_MAX = float(os.environ.get("LAB_SIMULATED_LATENCY_MAX", "3.0"))
+LAB_SIMULATED_FAILURE_RATE = float(os.environ.get("LAB_SIMULATED_FAILURE_RATE", "0.0"))
+
+class ProvisioningError(Exception):
+    """Raised by a provider adapter when a provisioning attempt fails"""
+    
+    def __init__(self, message: str, retryable: bool = True):
+        super().__init__(message)
+        self.retryable = retryable
+
+class ProviderAdapter(ABC):
+    """Interface between the provisioning pipeline and one cloud provider"""
+    
+    def __init__(self, provider_id: str):
+        self.provider_id = provider_id
+    
+    @abstractmethod
+    async def provision(self, instance: Dict) -> Dict:
+        """Create the lab environment and return resource fields to store on the instance"""
+    
+    @abstractmethod
+    async def deprovision(self, instance: Dict):
+        """Release whatever provision() created"""
+
+class SimulatedProviderAdapter(ProviderAdapter):
+    """Stand-in for a cloud API with configurable latency and failure rate"""
+    
+    def __init__(
+        self,
+        provider_id: str,
+        min_latency: float = LAB_SIMULATED_LATENCY_MIN,
+        max_latency: float = LAB_SIMULATED_LATENCY_MAX,
+        failure_rate: float = LAB_SIMULATED_FAILURE_RATE
+    ):
+        super().__init__(provider_id)
+        self.min_latency = min_latency
+        self.max_latency = max(min_latency, max_latency)
+        self.failure_rate = failure_rate
+    
+    async def provision(self, instance: Dict) -> Dict:
+        await asyncio.sleep(random.uniform(self.min_latency, self.max_latency))
+        if random.random() < self.failure_rate:
+            raise ProvisioningError(f"Simulated {self.provider_id} capacity error in {instance['region']}")
+        return {
+            "ip_address": f"10.0.{random.randrange(256)}.{random.randrange(256)}",
+            "console_url": f"https://console.skilltrack365.com/lab/{instance['lab_id']}"
+        }
+    
+    async def deprovision(self, instance: Dict):
+        await asyncio.sleep(random.uniform(0, self.min_latency))
+
+PROVIDER_ADAPTERS: Dict[str, ProviderAdapter] = {
+    provider_id: SimulatedProviderAdapter(provider_id) for provider_id in CLOUD_PROVIDERS
+}
+
+def register_provider_adapter(adapter: ProviderAdapter):
+    """Replace the adapter used for a provider (e.g. a real cloud client)"""
+    PROVIDER_ADAPTERS[adapter.provider_id] = adapter
+
+class LabProvisioningPipeline:
+    """Drives lab instances from provisioning to running (or error) off the request path.
+
+    create_lab_instance stores the instance as provisioning, leased to this
+    worker, and submits it to a bounded queue drained by a fixed worker pool.
+    Each attempt holds the provider's semaphore (max_concurrent_provisions) and
+    failed attempts are retried with full-jitter exponential backoff. A recovery
+    sweep re-queues provisioning instances whose lease has lapsed, so work lost
+    to a restart or a full queue is picked up by any worker.
+    
+    Terminating an instance marks it deprovision_status=pending; release() then
+    calls the adapter's deprovision. deprovision_retry_at serves as both the
+    lease and the backoff, and the recovery sweep retries releases left pending.
+    """
+    
+    def __init__(self):
+        self.queue = asyncio.Queue(maxsize=LAB_PROVISION_QUEUE_SIZE)
+        self.pending = set()
+        self.releasing: Dict[str, asyncio.Task] = {}
+        self.semaphores = {}
+    
+    def semaphore(self, provider: str) -> asyncio.Semaphore:
+        if provider not in self.semaphores:
+            limit = provider_registry.get(provider).get("max_concurrent_provisions", 10)
+            self.semaphores[provider] = asyncio.Semaphore(limit)
+        return self.semaphores[provider]
+    
+    def submit(self, instance_id: str) -> bool:
+        """Queue an instance; when the queue is full the recovery sweep takes it later"""
+        if instance_id in self.pending:
+            return True
+        try:
+            self.queue.put_nowait(instance_id)
+        except asyncio.QueueFull:
+            logger.warning(f"Provisioning queue full, deferring {instance_id}")
+            return False
+        self.pending.add(instance_id)
+        return True
+    
+    async def renew_lease(self, instance_id: str) -> bool:
+        """Extend our lease; False if the instance left provisioning or another worker took it"""
+        result = await db.lab_instances.update_one(
+            {"instance_id": instance_id, "status": "provisioning", "provision_worker_id": WORKER_ID},
+            {"$set": {"provision_lease_expires_at": (
+                datetime.now(timezone.utc) + timedelta(seconds=LAB_PROVISION_LEASE_SECONDS)
+            ).isoformat()}}
+        )
+        return result.matched_count > 0
+    
+    async def claim(self, instance_id: str) -> Optional[Dict]:
+        now = datetime.now(timezone.utc)
+        instance = await db.lab_instances.find_one_and_update(
+            {
+                "instance_id": instance_id,
+                "status": "provisioning",
+                "$or": [
+                    {"provision_worker_id": WORKER_ID},
+                    {"provision_lease_expires_at": {"$lt": now.isoformat()}}
+                ]
+            },
+            {"$set": {
+                "provision_worker_id": WORKER_ID,
+                "provision_lease_expires_at": (now + timedelta(seconds=LAB_PROVISION_LEASE_SECONDS)).isoformat()
+            }},
+            return_document=ReturnDocument.AFTER
+        )
+        if instance:
+            instance.pop("_id", None)
+        return instance
+    
+    async def provision(self, instance_id: str):
+        instance = await self.claim(instance_id)
+        if not instance:
+            return
+        adapter = PROVIDER_ADAPTERS.get(instance["provider"])
+        if not adapter:
+            await self.fail(instance, f"No provisioning adapter for provider {instance['provider']}", 0)
+            return
+        
+        error = None
+        for attempt in range(1, LAB_PROVISION_MAX_ATTEMPTS + 1):
+            try:
+                async with self.semaphore(instance["provider"]):
+                    if not await self.renew_lease(instance_id):
+                        return
+                    resources = await adapter.provision(instance)
+                await self.succeed(instance, adapter, resources, attempt)
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                error = str(e)
+                retryable = getattr(e, "retryable", True)
+                logger.warning(f"Provisioning {instance_id} on {instance['provider']} failed (attempt {attempt}): {error}")
+                if not retryable:
+                    break
+                if attempt < LAB_PROVISION_MAX_ATTEMPTS:
+                    await asyncio.sleep(random.uniform(0, LAB_PROVISION_RETRY_BASE_SECONDS * 2 ** (attempt - 1)))
+        await self.fail(instance, error, attempt)
+    
+    async def succeed(self, instance: Dict, adapter: ProviderAdapter, resources: Dict, attempts: int):
+        now = datetime.now(timezone.utc)
+        expires_at = now + timedelta(hours=LAB_SESSION_HOURS)
+        result = await db.lab_instances.update_one(
+            {"instance_id": instance["instance_id"], "status": "provisioning", "provision_worker_id": WORKER_ID},
+            {
+                "$set": {
+                    "status": "running",
+                    "resources": {**instance.get("resources", {}), **resources},
+                    "provisioned_at": now.isoformat(),
+                    "running_since": now.isoformat(),
+                    "expires_at": expires_at.isoformat(),
+                    "provision_attempts": attempts,
+                    "updated_at": now.isoformat()
+                },
+                "$unset": {"provision_worker_id": "", "provision_lease_expires_at": ""}
+            }
+        )
+        if result.matched_count:
+            await append_lab_usage([instance], "start", now)
+            lab_scheduler.schedule(instance["instance_id"], expires_at)
+            publish_lab_status(instance, "running", expires_at=expires_at.isoformat())
+            logger.info(f"Lab instance {instance['instance_id']} running on {instance['provider']} after {attempts} attempt(s)")
+            return
+        # Terminated (or taken over) while the provider call was in flight
+        logger.info(f"Lab instance {instance['instance_id']} left provisioning mid-flight, releasing resources")
+        try:
+            await adapter.deprovision({**instance, "resources": {**instance.get("resources", {}), **resources}})
+        except Exception as e:
+            logger.error(f"Deprovisioning {instance['instance_id']} failed: {e}")
+    
+    async def fail(self, instance: Dict, error: str, attempts: int):
+        result = await db.lab_instances.update_one(
+            {"instance_id": instance["instance_id"], "status": "provisioning", "provision_worker_id": WORKER_ID},
+            {
+                "$set": {
+                    "status": "error",
+                    "error_message": error,
+                    "provision_attempts": attempts,
+                    "failed_at": datetime.now(timezone.utc).isoformat(),
+                    "updated_at": datetime.now(timezone.utc).isoformat()
+                },
+                "$unset": {"provision_worker_id": "", "provision_lease_expires_at": ""}
+            }
+        )
+        if result.matched_count:
+            publish_lab_status(instance, "error", error_message=error)
+            await record_lab_metrics({lab_metrics_hour(datetime.now(timezone.utc)): {"provision_failures": 1}})
+        logger.error(f"Lab instance {instance['instance_id']} failed to provision: {error}")
+    
+    def submit_release(self, instance_id: str):
+        """Release a terminated instance's resources in the background"""
+        if instance_id in self.releasing:
+            return
+        task = asyncio.create_task(self.release(instance_id))
+        self.releasing[instance_id] = task
+        task.add_done_callback(lambda _: self.releasing.pop(instance_id, None))
+    
+    async def release(self, instance_id: str) -> bool:
+        """Deprovision a terminated instance; True once its resources are released"""
+        now = datetime.now(timezone.utc)
+        instance = await db.lab_instances.find_one_and_update(
+            {
+                "instance_id": instance_id,
+                "deprovision_status": "pending",
+                "deprovision_retry_at": {"$not": {"$gt": now.isoformat()}}
+            },
+            {
+                "$set": {"deprovision_retry_at": (now + timedelta(seconds=LAB_PROVISION_LEASE_SECONDS)).isoformat()},
+                "$inc": {"deprovision_attempts": 1}
+            },
+            return_document=ReturnDocument.AFTER
+        )
+        if not instance:
+            return False
+        instance.pop("_id", None)
+        try:
+            # Instances that never finished provisioning hold nothing; succeed() releases mid-flight ones
+            if instance.get("provisioned_at"):
+                adapter = PROVIDER_ADAPTERS.get(instance.get("provider"))
+                if not adapter:
+                    raise ProvisioningError(f"No provisioning adapter for provider {instance.get('provider')}", retryable=False)
+                async with self.semaphore(instance["provider"]):
+                    await adapter.deprovision(instance)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            attempts = instance.get("deprovision_attempts", 1)
+            exhausted = attempts >= LAB_DEPROVISION_MAX_ATTEMPTS or not getattr(e, "retryable", True)
+            retry_at = now + timedelta(seconds=LAB_DEPROVISION_RETRY_BASE_SECONDS * 2 ** (attempts - 1))
+            await db.lab_instances.update_one(
+                {"instance_id": instance_id, "deprovision_status": "pending"},
+                {"$set": {
+                    "deprovision_status": "failed" if exhausted else "pending",
+                    "deprovision_error": str(e),
+                    "deprovision_retry_at": retry_at.isoformat()
+                }}
+            )
+            logger.error(f"Deprovisioning {instance_id} on {instance.get('provider')} failed (attempt {attempts}): {e}")
+            return False
+        await db.lab_instances.update_one(
+            {"instance_id": instance_id, "deprovision_status": "pending"},
+            {
+                "$set": {"deprovision_status": "released", "deprovisioned_at": datetime.now(timezone.utc).isoformat()},
+                "$unset": {"deprovision_retry_at": "", "deprovision_error": ""}
+            }
+        )
+        return True
+    
+    async def worker(self):
+        while True:
+            instance_id = await self.queue.get()
+            try:
+                await self.provision(instance_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Provisioning worker error for {instance_id}: {e}")
+            finally:
+                self.pending.discard(instance_id)
+                self.queue.task_done()
+    
+    async def recover(self):
+        while True:
+            try:
+                free = self.queue.maxsize - self.queue.qsize()
+                if free > 0:
+                    cursor = db.lab_instances.find(
+                        {
+                            "status": "provisioning",
+                            "provision_lease_expires_at": {"$lt": datetime.now(timezone.utc).isoformat()}
+                        },
+                        {"_id": 0, "instance_id": 1}
+                    ).limit(free)
+                    async for inst in cursor:
+                        self.submit(inst["instance_id"])
+                cursor = db.lab_instances.find(
+                    {
+                        "deprovision_status": "pending",
+                        "deprovision_retry_at": {"$not": {"$gt": datetime.now(timezone.utc).isoformat()}}
+                    },
+                    {"_id": 0, "instance_id": 1}
+                ).limit(LAB_PROVISION_QUEUE_SIZE)
+                async for inst in cursor:
+                    self.submit_release(inst["instance_id"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Provisioning recovery error: {e}")
+            await asyncio.sleep(LAB_PROVISION_RECOVERY_SECONDS)
+    
+    def start(self) -> List[asyncio.Task]:
+        tasks = [asyncio.create_task(self.worker()) for _ in range(LAB_PROVISION_WORKERS)]
+        tasks.append(asyncio.create_task(self.recover()))
+        return tasks
+
+provisioning_pipeline = LabProvisioningPipeline()
+
+
+# === Lab Warm Pool ===
+
+LAB_WARM_POOL_LOCK = "lab_warm_pool"
+LAB_WARM_POOL_INTERVAL_SECONDS = 15
+LAB_WARM_POOL_LOCK_SECONDS = LAB_WARM_POOL_INTERVAL_SECONDS * 4  # Renewed every interval while a cycle runs
+LAB_WARM_POOL_DEMAND_WINDOW_MINUTES = 15
+LAB_WARM_POOL_LEAD_MINUTES = 10  # Scheduled windows start filling this far ahead
+LAB_WARM_POOL_BATCH_SIZE = 50  # Max environments started per pool per cycle
+LAB_WARM_POOL_KEYS_TTL_SECONDS = 30
+
+def to_utc_iso(value: datetime) -> str:
+    return (value if value.tzinfo else value.replace(tzinfo=timezone.utc)).astimezone(timezone.utc).isoformat()
+
+class WarmPoolManager:
+    """Keeps pre-provisioned environments ready per (lab_id, provider, instance_type).
+
+    Targets live in lab_warm_pool_targets; the environments themselves in
+    lab_warm_pool (provisioning -> ready). Launches claim a ready environment
+    atomically with find_one_and_delete; the instance keeps its warm_id and
+    resources from then on. Only the worker holding
+    the lab_warm_pool lock replenishes: each cycle sizes every pool from its
+    minimum, any scheduled window starting soon and launches in the last
+    demand window, then provisions the shortfall or retires the surplus.
+    The lock is renewed while a cycle runs; once it is lost, no further
+    environments are started or released in that cycle.
+    """
+    
+    def __init__(self):
+        self.pool_keys = set()
+        self.keys_loaded_at = None
+        self.is_leader = False
+        self.lease_lost = asyncio.Event()
+    
+    async def has_pool(self, lab_id: str, provider: str, instance_type: str) -> bool:
+        loop_time = asyncio.get_running_loop().time()
+        if self.keys_loaded_at is None or loop_time - self.keys_loaded_at >= LAB_WARM_POOL_KEYS_TTL_SECONDS:
+            targets = await db.lab_warm_pool_targets.find(
+                {}, {"_id": 0, "lab_id": 1, "provider": 1, "instance_type": 1}
+            ).to_list(1000)
+            self.pool_keys = {(t["lab_id"], t["provider"], t["instance_type"]) for t in targets}
+            self.keys_loaded_at = loop_time
+        return (lab_id, provider, instance_type) in self.pool_keys
+    
+    def invalidate(self):
+        self.keys_loaded_at = None
+    
+    async def claim(self, lab_id: str, placements: List[Dict], region: Optional[str] = None) -> Optional[Dict]:
+        """Take a ready environment from the first pool along the ranked placements; records a hit or miss"""
+        pools = []
+        for placement in placements:
+            key = (placement["provider"], placement["instance_type"])
+            if key not in pools and await self.has_pool(lab_id, *key):
+                pools.append(key)
+        if not pools:
+            return None
+        warm = None
+        for provider, instance_type in pools:
+            query = {"lab_id": lab_id, "provider": provider, "instance_type": instance_type, "status": "ready"}
+            if region:
+                query["region"] = region
+            warm = await db.lab_warm_pool.find_one_and_delete(query, sort=[("ready_at", 1)])
+            if warm:
+                warm.pop("_id", None)
+                break
+        now = datetime.now(timezone.utc)
+        await record_lab_metrics({lab_metrics_hour(now): {"warm_pool_hits" if warm else "warm_pool_misses": 1}})
+        return warm
+    
+    def desired_size(self, target: Dict, recent_launches: int, now: datetime) -> int:
+        size = target.get("min_size", 0)
+        lead = now + timedelta(minutes=LAB_WARM_POOL_LEAD_MINUTES)
+        for window in target.get("schedule", []):
+            if parse_timestamp(window["start_at"]) <= lead and now < parse_timestamp(window["end_at"]):
+                size = max(size, window["size"])
+        size = max(size, math.ceil(recent_launches * target.get("demand_factor", 1.0)))
+        return min(size, target.get("max_size", size))
+    
+    async def provision_one(self, target: Dict, providers: Dict[str, Dict]):
+        options = rank_placements(
+            providers, await capacity_tracker.snapshot(), [target["provider"]], [target["instance_type"]],
+            provider=target["provider"], instance_type=target["instance_type"]
+        )
+        adapter = PROVIDER_ADAPTERS.get(target["provider"])
+        if not options or not adapter or self.lease_lost.is_set():
+            return
+        placement = options[0]
+        capacity_tracker.reserve(placement["provider"], placement["region"], placement["vcpu"], warm=True)
+        now = datetime.now(timezone.utc)
+        warm = {
+            "warm_id": f"warm_{uuid.uuid4().hex[:12]}",
+            "pool_id": target["pool_id"],
+            "lab_id": target["lab_id"],
+            "provider": target["provider"],
+            "region": placement["region"],
+            "instance_type": target["instance_type"],
+            "status": "provisioning",
+            "resources": {"vcpu": placement["vcpu"], "memory_gb": placement["memory_gb"], "storage_gb": 20},
+            "created_at": now.isoformat()
+        }
+        await db.lab_warm_pool.insert_one(warm)
+        warm.pop("_id", None)
+        try:
+            async with provisioning_pipeline.semaphore(target["provider"]):
+                resources = await adapter.provision(warm)
+        except Exception as e:
+            logger.warning(f"Warm pool {target['pool_id']} provisioning failed: {e}")
+            await db.lab_warm_pool.delete_one({"warm_id": warm["warm_id"]})
+            return
+        result = await db.lab_warm_pool.update_one(
+            {"warm_id": warm["warm_id"], "status": "provisioning"},
+            {"$set": {
+                "status": "ready",
+                "resources": {**warm["resources"], **resources},
+                "ready_at": datetime.now(timezone.utc).isoformat()
+            }}
+        )
+        if not result.matched_count:
+            # reconcile() gave up on it as stale while the provider call was in flight
+            await self.release(adapter, {**warm, "resources": {**warm["resources"], **resources}})
+    
+    async def release(self, adapter: ProviderAdapter, warm: Dict) -> bool:
+        try:
+            await adapter.deprovision(warm)
+            return True
+        except Exception as e:
+            logger.error(f"Deprovisioning warm environment {warm['warm_id']} failed: {e}")
+            return False
+    
+    async def retire(self, lab_id: str, provider: str, instance_type: str, count: int):
+        for _ in range(count):
+            warm = await db.lab_warm_pool.find_one_and_delete(
+                {"lab_id": lab_id, "provider": provider, "instance_type": instance_type, "status": "ready"},
+                sort=[("ready_at", 1)]
+            )
+            if not warm:
+                return
+            adapter = PROVIDER_ADAPTERS.get(provider)
+            if adapter:
+                await self.release(adapter, warm)
+    
+    async def reconcile(self):
+        now = datetime.now(timezone.utc)
+        # Environments a previous leader was still provisioning when it went away;
+        # kept for the next cycle when the provider cannot confirm the release
+        stale = await db.lab_warm_pool.find({
+            "status": "provisioning",
+            "created_at": {"$lt": (now - timedelta(seconds=LAB_PROVISION_LEASE_SECONDS)).isoformat()}
+        }, {"_id": 0}).to_list(LAB_WARM_POOL_BATCH_SIZE * 10)
+        for warm in stale:
+            if self.lease_lost.is_set():
+                return
+            adapter = PROVIDER_ADAPTERS.get(warm["provider"])
+            if not adapter or await self.release(adapter, warm):
+                await db.lab_warm_pool.delete_one({"warm_id": warm["warm_id"], "status": "provisioning"})
+        
+        targets = await db.lab_warm_pool_targets.find({}, {"_id": 0}).to_list(1000)
+        pools = {}
+        async for row in db.lab_warm_pool.aggregate([
+            {"$match": {"status": {"$in": ["provisioning", "ready"]}}},
+            {"$group": {
+                "_id": {"lab_id": "$lab_id", "provider": "$provider", "instance_type": "$instance_type", "status": "$status"},
+                "count": {"$sum": 1}
+            }}
+        ]):
+            key = (row["_id"]["lab_id"], row["_id"]["provider"], row["_id"]["instance_type"])
+            pools.setdefault(key, {"provisioning": 0, "ready": 0})[row["_id"]["status"]] = row["count"]
+        
+        providers = await provider_registry.get_all()
+        demand_since = (now - timedelta(minutes=LAB_WARM_POOL_DEMAND_WINDOW_MINUTES)).isoformat()
+        tasks = []
+        for target in targets:
+            key = (target["lab_id"], target["provider"], target["instance_type"])
+            current = pools.pop(key, {"provisioning": 0, "ready": 0})
+            if not providers.get(target["provider"], {}).get("is_enabled", True):
+                desired = 0
+            else:
+                recent_launches = await db.lab_instances.count_documents({
+                    "lab_id": target["lab_id"],
+                    "provider": target["provider"],
+                    "instance_type": target["instance_type"],
+                    "started_at": {"$gte": demand_since}
+                })
+                desired = self.desired_size(target, recent_launches, now)
+            have = current["provisioning"] + current["ready"]
+            if have < desired:
+                tasks.extend(self.provision_one(target, providers) for _ in range(min(desired - have, LAB_WARM_POOL_BATCH_SIZE)))
+            elif have > desired and current["ready"]:
+                tasks.append(self.retire(*key, min(have - desired, current["ready"])))
+        # Pools whose target was removed are drained
+        for key, current in pools.items():
+            if current["ready"]:
+                tasks.append(self.retire(*key, current["ready"]))
+        if tasks:
+            await asyncio.gather(*tasks)
+    
+    async def hold_lease(self):
+        """Renew the leader lock while a cycle runs; flag lease_lost once another worker has it"""
+        while True:
+            await asyncio.sleep(LAB_WARM_POOL_INTERVAL_SECONDS)
+            try:
+                renewed = await acquire_lock(LAB_WARM_POOL_LOCK, LAB_WARM_POOL_LOCK_SECONDS)
+            except Exception as e:
+                logger.error(f"Warm pool lease renewal failed: {e}")
+                renewed = False
+            if not renewed:
+                self.lease_lost.set()
+                return
+    
+    async def run(self):
+        while True:
+            try:
+                if await acquire_lock(LAB_WARM_POOL_LOCK, LAB_WARM_POOL_LOCK_SECONDS):
+                    if not self.is_leader:
+                        logger.info(f"Warm pool leadership acquired by {WORKER_ID}")
+                        self.is_leader = True
+                    self.lease_lost = asyncio.Event()
+                    renewer = asyncio.create_task(self.hold_lease())
+                    try:
+                        await self.reconcile()
+                    finally:
+                        renewer.cancel()
+                    if self.lease_lost.is_set():
+                        logger.warning("Warm pool manager lost leadership during a cycle")
+                        self.is_leader = False
+                elif self.is_leader:
+                    logger.warning("Warm pool manager lost leadership")
+                    self.is_leader = False
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Warm pool error: {e}")
+            await asyncio.sleep(LAB_WARM_POOL_INTERVAL_SECONDS)
+
+warm_pool = WarmPoolManager()
+
+
 # === User-facing Lab Instance Routes ===
 
 @api_router.get("/lab-instances")
@@ -4092,6 +6352,15 @@ async def get_user_lab_instances(user: Dict = Depends(require_auth)):
     ).to_list(100)
     return instances
 
+@api_router.get("/lab-instances/events")
+async def lab_instance_events(request: Request, user: Dict = Depends(require_auth)):
+    """Server-sent events for the current user's lab instances (state changes, expiry warnings)"""
+    return StreamingResponse(
+        lab_event_stream(request, user["user_id"]),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @api_router.post("/lab-instances")
 async def create_lab_instance(data: LabInstanceCreate, user: Dict = Depends(require_auth)):
     """Create a new lab instance for the current user"""
@@ -4106,52 +6375,110 @@ async def create_lab_instance(data: LabInstanceCreate, user: Dict = Depends(requ
         quota = {**DEFAULT_QUOTA, "user_id": user["user_id"], "current_usage": {}}
     
     # Check concurrent lab limit
-    active_instances = await db.lab_instances.count_documents({
-        "user_id": user["user_id"],
-        "status": {"$in": ["provisioning", "running"]}
-    })
-    if active_instances >= quota.get("max_concurrent_labs", 2):
+    active_instances = await get_active_lab_instances(user["user_id"])
+    concurrent = len([i for i in active_instances if i["status"] in ["provisioning", "running"]])
+    if concurrent >= quota.get("max_concurrent_labs", 2):
         raise HTTPException(status_code=400, detail=f"Maximum concurrent labs ({quota.get('max_concurrent_labs', 2)}) reached")
     
+    # Check daily/monthly lab hours
+    usage = await get_lab_usage(user["user_id"], active_instances, datetime.now(timezone.utc))
+    if usage["daily_lab_hours"] >= quota.get("max_daily_lab_hours", 4.0):
+        raise HTTPException(status_code=400, detail=f"Daily lab hour limit ({quota.get('max_daily_lab_hours', 4.0)}h) reached")
+    if usage["monthly_lab_hours"] >= quota.get("max_monthly_lab_hours", 40.0):
+        raise HTTPException(status_code=400, detail=f"Monthly lab hour limit ({quota.get('max_monthly_lab_hours', 40.0)}h) reached")
+    
+    allowed_providers = quota.get("allowed_providers", ["aws", "gcp", "azure"])
+    if lab.get("providers"):
+        allowed_providers = [p for p in allowed_providers if p in lab["providers"]]
+    
     # Check provider allowed
-    if data.provider not in quota.get("allowed_providers", ["aws", "gcp", "azure"]):
-        raise HTTPException(status_code=400, detail=f"Provider {data.provider} not allowed for your account")
+    providers = await provider_registry.get_all()
+    if data.provider:
+        if data.provider not in providers:
+            raise HTTPException(status_code=400, detail=f"Unknown provider {data.provider}")
+        if data.provider not in allowed_providers:
+            raise HTTPException(status_code=400, detail=f"Provider {data.provider} not allowed for your account")
+        if not providers[data.provider].get("is_enabled", True):
+            raise HTTPException(status_code=400, detail=f"Provider {data.provider} is currently disabled")
     
     # Check instance type allowed
-    if data.instance_type not in quota.get("allowed_instance_types", ["small", "medium"]):
+    if data.instance_type and data.instance_type not in quota.get("allowed_instance_types", ["small", "medium"]):
         raise HTTPException(status_code=400, detail=f"Instance type {data.instance_type} not allowed for your account")
     
-    # Get provider config
-    provider_config = CLOUD_PROVIDERS.get(data.provider, CLOUD_PROVIDERS["aws"])
-    instance_config = provider_config["instance_types"].get(data.instance_type, provider_config["instance_types"]["small"])
+    # Pick provider/region/instance type
+    placements = rank_placements(
+        providers,
+        await capacity_tracker.snapshot(),
+        allowed_providers,
+        quota.get("allowed_instance_types", ["small", "medium"]),
+        provider=data.provider,
+        region=data.region,
+        instance_type=data.instance_type
+    )
+    if not placements:
+        raise HTTPException(status_code=503, detail="No lab capacity available for the requested placement")
+    placement = placements[0]
+    instance_id = f"inst_{uuid.uuid4().hex[:12]}"
+    
+    # Use a pre-provisioned environment when any candidate placement has a warm pool
+    warm = await warm_pool.claim(data.lab_id, placements, region=data.region)
+    if warm:
+        placement = next(
+            p for p in placements
+            if (p["provider"], p["instance_type"]) == (warm["provider"], warm["instance_type"])
+        )
+        placement = {**placement, "region": warm["region"]}
+    else:
+        capacity_tracker.reserve(placement["provider"], placement["region"], placement["vcpu"])
     
-    # Create instance (simulated)
+    # Record the instance as provisioning; the pipeline brings it up in the background
+    now = datetime.now(timezone.utc)
     instance = {
-        "instance_id": f"inst_{uuid.uuid4().hex[:12]}",
+        "instance_id": instance_id,
         "user_id": user["user_id"],
         "lab_id": data.lab_id,
         "cert_id": lab["cert_id"],
-        "provider": data.provider,
-        "region": data.region,
-        "instance_type": data.instance_type,
-        "status": "running",  # Simulated - instant provisioning
+        "provider": placement["provider"],
+        "region": placement["region"],
+        "instance_type": placement["instance_type"],
+        "status": "provisioning",
         "resources": {
-            "vcpu": instance_config["vcpu"],
-            "memory_gb": instance_config["memory_gb"],
-            "storage_gb": 20,
-            "ip_address": f"10.0.{uuid.uuid4().int % 256}.{uuid.uuid4().int % 256}",
-            "console_url": f"https://console.skilltrack365.com/lab/{data.lab_id}"
+            "vcpu": placement["vcpu"],
+            "memory_gb": placement["memory_gb"],
+            "storage_gb": 20
         },
-        "started_at": datetime.now(timezone.utc).isoformat(),
-        "expires_at": (datetime.now(timezone.utc) + timedelta(hours=2)).isoformat(),
-        "cost_estimate": instance_config["cost_per_hour"] * 2,  # 2 hour estimate
-        "error_message": None
+        "started_at": now.isoformat(),
+        "updated_at": now.isoformat(),
+        # Reset when the instance reaches running; bounds how long it can sit in provisioning
+        "expires_at": (now + timedelta(hours=LAB_SESSION_HOURS)).isoformat(),
+        "cost_estimate": placement["cost_per_hour"] * LAB_SESSION_HOURS,
+        "error_message": None,
+        "provision_attempts": 0,
+        "provision_worker_id": WORKER_ID,
+        "provision_lease_expires_at": (now + timedelta(seconds=LAB_PROVISION_LEASE_SECONDS)).isoformat()
     }
     
+    if warm:
+        instance["status"] = "running"
+        instance["resources"] = warm["resources"]
+        instance["warm_id"] = warm["warm_id"]
+        instance["provisioned_at"] = now.isoformat()
+        instance["running_since"] = now.isoformat()
+        for field in ("provision_worker_id", "provision_lease_expires_at"):
+            instance.pop(field)
+    
     await db.lab_instances.insert_one(instance)
     instance.pop("_id", None)
+    lab_scheduler.schedule(instance["instance_id"], instance["expires_at"])
+    publish_lab_status(instance, instance["status"])
+    if warm:
+        # Log the start from the pre-running document so it opens the interval instead of closing it
+        await append_lab_usage([{**instance, "running_since": None}], "start", now)
+    else:
+        provisioning_pipeline.submit(instance["instance_id"])
+    await record_lab_metrics({lab_metrics_hour(now): {"instances_started": 1, f"providers.{placement['provider']}": 1}})
     
-    logger.info(f"User {user['email']} started lab instance: {instance['instance_id']} for lab {data.lab_id}")
+    logger.info(f"User {user['email']} requested lab instance: {instance['instance_id']} for lab {data.lab_id}")
     
     return instance
 
@@ -4168,31 +6495,29 @@ async def lab_instance_action(instance_id: str, data: LabInstanceAction, user: D
     if data.action == "suspend":
         if instance["status"] != "running":
             raise HTTPException(status_code=400, detail="Can only suspend running instances")
-        await db.lab_instances.update_one(
-            {"instance_id": instance_id},
-            {"$set": {"status": "suspended"}}
-        )
+        if not await transition_lab_instance(instance_id, "suspended", "suspend", {"status": "running"}):
+            raise HTTPException(status_code=409, detail="Instance state changed, please retry")
+        publish_lab_status(instance, "suspended")
         return {"message": "Instance suspended", "status": "suspended"}
     
     elif data.action == "resume":
         if instance["status"] != "suspended":
             raise HTTPException(status_code=400, detail="Can only resume suspended instances")
-        await db.lab_instances.update_one(
-            {"instance_id": instance_id},
-            {"$set": {"status": "running"}}
-        )
+        if not await transition_lab_instance(instance_id, "running", "resume", {"status": "suspended"}):
+            raise HTTPException(status_code=409, detail="Instance state changed, please retry")
+        publish_lab_status(instance, "running")
         return {"message": "Instance resumed", "status": "running"}
     
     elif data.action == "terminate":
         if instance["status"] == "terminated":
             raise HTTPException(status_code=400, detail="Instance already terminated")
-        await db.lab_instances.update_one(
-            {"instance_id": instance_id},
-            {"$set": {
-                "status": "terminated",
-                "terminated_at": datetime.now(timezone.utc).isoformat()
-            }}
-        )
+        if not await transition_lab_instance(
+            instance_id, "terminated", "terminate", {"status": {"$ne": "terminated"}},
+            terminated_at=datetime.now(timezone.utc).isoformat()
+        ):
+            raise HTTPException(status_code=400, detail="Instance already terminated")
+        provisioning_pipeline.submit_release(instance_id)
+        publish_lab_status(instance, "terminated")
         return {"message": "Instance terminated", "status": "terminated"}
     
     elif data.action == "extend":
@@ -4201,8 +6526,10 @@ async def lab_instance_action(instance_id: str, data: LabInstanceAction, user: D
         new_expires = datetime.now(timezone.utc) + timedelta(hours=2)
         await db.lab_instances.update_one(
             {"instance_id": instance_id},
-            {"$set": {"expires_at": new_expires.isoformat()}}
+            {"$set": {"expires_at": new_expires.isoformat(), "updated_at": datetime.now(timezone.utc).isoformat()}}
         )
+        lab_scheduler.schedule(instance_id, new_expires)
+        publish_lab_status(instance, instance["status"], expires_at=new_expires.isoformat())
         return {"message": "Instance extended by 2 hours", "expires_at": new_expires.isoformat()}
     
     else:
@@ -4221,10 +6548,12 @@ async def get_lab_instance(instance_id: str, user: Dict = Depends(require_auth))
 
 @api_router.get("/my-quota")
 async def get_my_quota(user: Dict = Depends(require_auth)):
-    """Get current user's resource quota"""
+    """Get current user's resource quota and lab hours used"""
     quota = await db.resource_quotas.find_one({"user_id": user["user_id"]}, {"_id": 0})
     if not quota:
-        return {**DEFAULT_QUOTA, "user_id": user["user_id"], "current_usage": {}}
+        quota = {**DEFAULT_QUOTA, "user_id": user["user_id"]}
+    active_instances = await get_active_lab_instances(user["user_id"])
+    quota["current_usage"] = await get_lab_usage(user["user_id"], active_instances, datetime.now(timezone.utc))
     return quota
 
 
@@ -4233,64 +6562,93 @@ async def get_my_quota(user: Dict = Depends(require_auth)):
 @api_router.get("/admin/lab-orchestration/dashboard")
 async def admin_lab_dashboard(admin: Dict = Depends(get_admin)):
     """Get lab orchestration dashboard stats"""
-    # Count instances by status
-    running_count = await db.lab_instances.count_documents({"status": "running"})
-    suspended_count = await db.lab_instances.count_documents({"status": "suspended"})
-    provisioning_count = await db.lab_instances.count_documents({"status": "provisioning"})
-    terminated_today = await db.lab_instances.count_documents({
-        "status": "terminated",
-        "terminated_at": {"$gte": datetime.now(timezone.utc).replace(hour=0, minute=0, second=0).isoformat()}
-    })
-    
-    # Count by provider
-    provider_stats = {}
-    for provider in ["aws", "gcp", "azure"]:
-        count = await db.lab_instances.count_documents({
-            "provider": provider,
-            "status": {"$in": ["running", "suspended", "provisioning"]}
-        })
-        provider_stats[provider] = count
-    
-    # Calculate total resource usage (simulated)
-    total_vcpu = 0
-    total_memory = 0
-    total_cost = 0.0
-    
-    active_instances = await db.lab_instances.find(
-        {"status": {"$in": ["running", "suspended", "provisioning"]}},
-        {"_id": 0}
-    ).to_list(1000)
+    today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0).isoformat()
+    active = {"status": {"$in": LAB_ACTIVE_STATUSES}}
     
-    for inst in active_instances:
-        resources = inst.get("resources", {})
-        total_vcpu += resources.get("vcpu", 0)
-        total_memory += resources.get("memory_gb", 0)
-        total_cost += inst.get("cost_estimate", 0)
-    
-    # Users with active labs
-    unique_users = len(set(inst["user_id"] for inst in active_instances))
-    
-    # Recent errors
-    error_instances = await db.lab_instances.find(
-        {"status": "error"},
-        {"_id": 0}
-    ).sort("started_at", -1).to_list(5)
+    # One pass over active, terminated-today and errored instances
+    pipeline = [
+        {"$match": {"$or": [
+            active,
+            {"status": "terminated", "terminated_at": {"$gte": today}},
+            {"status": "error"}
+        ]}},
+        {"$facet": {
+            "by_status": [
+                {"$match": active},
+                {"$group": {"_id": "$status", "count": {"$sum": 1}}}
+            ],
+            "by_provider": [
+                {"$match": active},
+                {"$group": {"_id": "$provider", "count": {"$sum": 1}}}
+            ],
+            "resources": [
+                {"$match": active},
+                {"$group": {
+                    "_id": None,
+                    "total_vcpu": {"$sum": "$resources.vcpu"},
+                    "total_memory_gb": {"$sum": "$resources.memory_gb"},
+                    "total_cost": {"$sum": "$cost_estimate"},
+                    "users": {"$addToSet": "$user_id"}
+                }},
+                {"$project": {
+                    "_id": 0,
+                    "total_vcpu": 1,
+                    "total_memory_gb": 1,
+                    "total_cost": 1,
+                    "active_users": {"$size": "$users"}
+                }}
+            ],
+            "terminated_today": [
+                {"$match": {"status": "terminated"}},
+                {"$count": "count"}
+            ],
+            "recent_errors": [
+                {"$match": {"status": "error"}},
+                {"$sort": {"started_at": -1}},
+                {"$limit": 5},
+                {"$project": {"_id": 0}}
+            ]
+        }}
+    ]
+    result = (await db.lab_instances.aggregate(pipeline).to_list(1))[0]
+    
+    status_counts = {row["_id"]: row["count"] for row in result["by_status"]}
+    provider_stats = {provider: 0 for provider in CLOUD_PROVIDERS}
+    provider_stats.update({row["_id"]: row["count"] for row in result["by_provider"] if row["_id"]})
+    totals = result["resources"][0] if result["resources"] else {}
+    terminated_today = result["terminated_today"][0]["count"] if result["terminated_today"] else 0
+    
+    # Warm pool hit rate over the last 24 hours
+    since_hour = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0) - timedelta(hours=23)
+    pool_buckets = await db.lab_metrics_hourly.find(
+        {"_id": {"$gte": since_hour.isoformat()}},
+        {"_id": 0, "warm_pool_hits": 1, "warm_pool_misses": 1}
+    ).to_list(24)
+    pool_hits = sum(b.get("warm_pool_hits", 0) for b in pool_buckets)
+    pool_misses = sum(b.get("warm_pool_misses", 0) for b in pool_buckets)
+    pool_ready = await db.lab_warm_pool.count_documents({"status": "ready"})
     
     return {
         "instances": {
-            "running": running_count,
-            "suspended": suspended_count,
-            "provisioning": provisioning_count,
+            "running": status_counts.get("running", 0),
+            "suspended": status_counts.get("suspended", 0),
+            "provisioning": status_counts.get("provisioning", 0),
             "terminated_today": terminated_today
         },
         "providers": provider_stats,
         "resources": {
-            "total_vcpu": total_vcpu,
-            "total_memory_gb": total_memory,
-            "estimated_daily_cost": round(total_cost * 12, 2)  # Rough daily estimate
+            "total_vcpu": totals.get("total_vcpu", 0),
+            "total_memory_gb": totals.get("total_memory_gb", 0),
+            "estimated_daily_cost": round(totals.get("total_cost", 0) * 12, 2)  # Rough daily estimate
         },
-        "active_users": unique_users,
-        "recent_errors": error_instances
+        "active_users": totals.get("active_users", 0),
+        "recent_errors": result["recent_errors"],
+        "warm_pool": {
+            "ready": pool_ready,
+            "hits_24h": pool_hits,
+            "misses_24h": pool_misses,
+            "hit_rate": round(pool_hits / (pool_hits + pool_misses), 4) if pool_hits + pool_misses else None
+        }
     }
 
 @api_router.get("/admin/lab-orchestration/instances")
@@ -4328,29 +6686,27 @@ async def admin_instance_action(instance_id: str, data: LabInstanceAction, admin
         raise HTTPException(status_code=404, detail="Lab instance not found")
     
     if data.action == "suspend":
-        await db.lab_instances.update_one(
-            {"instance_id": instance_id},
-            {"$set": {"status": "suspended"}}
-        )
+        if not await transition_lab_instance(instance_id, "suspended", "suspend", {"status": "running"}):
+            raise HTTPException(status_code=400, detail="Can only suspend running instances")
+        publish_lab_status(instance, "suspended")
         logger.info(f"Admin {admin['email']} suspended instance {instance_id}")
         return {"message": "Instance suspended by admin", "status": "suspended"}
     
     elif data.action == "resume":
-        await db.lab_instances.update_one(
-            {"instance_id": instance_id},
-            {"$set": {"status": "running"}}
-        )
+        if not await transition_lab_instance(instance_id, "running", "resume", {"status": "suspended"}):
+            raise HTTPException(status_code=400, detail="Can only resume suspended instances")
+        publish_lab_status(instance, "running")
         logger.info(f"Admin {admin['email']} resumed instance {instance_id}")
         return {"message": "Instance resumed by admin", "status": "running"}
     
     elif data.action == "terminate":
-        await db.lab_instances.update_one(
-            {"instance_id": instance_id},
-            {"$set": {
-                "status": "terminated",
-                "terminated_at": datetime.now(timezone.utc).isoformat()
-            }}
-        )
+        if not await transition_lab_instance(
+            instance_id, "terminated", "terminate", {"status": {"$ne": "terminated"}},
+            terminated_at=datetime.now(timezone.utc).isoformat()
+        ):
+            raise HTTPException(status_code=400, detail="Instance already terminated")
+        provisioning_pipeline.submit_release(instance_id)
+        publish_lab_status(instance, "terminated")
         logger.info(f"Admin {admin['email']} terminated instance {instance_id}")
         return {"message": "Instance terminated by admin", "status": "terminated"}
     
@@ -4358,8 +6714,10 @@ async def admin_instance_action(instance_id: str, data: LabInstanceAction, admin
         new_expires = datetime.now(timezone.utc) + timedelta(hours=4)  # Admin gets 4 hour extension
         await db.lab_instances.update_one(
             {"instance_id": instance_id},
-            {"$set": {"expires_at": new_expires.isoformat()}}
+            {"$set": {"expires_at": new_expires.isoformat(), "updated_at": datetime.now(timezone.utc).isoformat()}}
         )
+        lab_scheduler.schedule(instance_id, new_expires)
+        publish_lab_status(instance, instance["status"], expires_at=new_expires.isoformat())
         logger.info(f"Admin {admin['email']} extended instance {instance_id}")
         return {"message": "Instance extended by admin (4 hours)", "expires_at": new_expires.isoformat()}
     
@@ -4403,11 +6761,9 @@ async def admin_get_user_quota(user_id: str, admin: Dict = Depends(get_admin)):
     quota["user"] = {"email": user.get("email"), "name": user.get("name")}
     
     # Calculate current usage
-    active_count = await db.lab_instances.count_documents({
-        "user_id": user_id,
-        "status": {"$in": ["running", "suspended", "provisioning"]}
-    })
-    quota["current_active_labs"] = active_count
+    active_instances = await get_active_lab_instances(user_id)
+    quota["current_active_labs"] = len(active_instances)
+    quota["current_usage"] = await get_lab_usage(user_id, active_instances, datetime.now(timezone.utc))
     
     return quota
 
@@ -4465,20 +6821,8 @@ async def admin_reset_quota(user_id: str, admin: Dict = Depends(get_admin)):
 @api_router.get("/admin/lab-orchestration/providers")
 async def admin_list_providers(admin: Dict = Depends(get_admin)):
     """List all cloud providers with their configurations"""
-    # Check for custom provider settings in DB
-    custom_providers = await db.cloud_providers.find({}, {"_id": 0}).to_list(10)
-    custom_map = {p["provider_id"]: p for p in custom_providers}
-    
-    result = []
-    for pid, provider in CLOUD_PROVIDERS.items():
-        if pid in custom_map:
-            # Merge custom settings
-            merged = {**provider, **custom_map[pid]}
-            result.append(merged)
-        else:
-            result.append(provider)
-    
-    return result
+    providers = await provider_registry.get_all()
+    return list(providers.values())
 
 @api_router.put("/admin/lab-orchestration/providers/{provider_id}")
 async def admin_update_provider(provider_id: str, is_enabled: bool, admin: Dict = Depends(get_admin)):
@@ -4491,6 +6835,7 @@ async def admin_update_provider(provider_id: str, is_enabled: bool, admin: Dict
         {"$set": {"is_enabled": is_enabled, "updated_at": datetime.now(timezone.utc).isoformat()}},
         upsert=True
     )
+    await provider_registry.refresh()
     
     status = "enabled" if is_enabled else "disabled"
     logger.info(f"Admin {admin['email']} {status} provider {provider_id}")
@@ -4501,7 +6846,7 @@ async def admin_update_provider(provider_id: str, is_enabled: bool, admin: Dict
 
 @api_router.get("/admin/lab-orchestration/metrics")
 async def admin_get_metrics(period: str = "24h", admin: Dict = Depends(get_admin)):
-    """Get resource usage metrics (simulated)"""
+    """Get resource usage metrics from the hourly metrics buckets"""
     # Calculate time range
     hours = 24
     if period == "7d":
@@ -4509,49 +6854,216 @@ async def admin_get_metrics(period: str = "24h", admin: Dict = Depends(get_admin
     elif period == "30d":
         hours = 720
     
-    start_time = datetime.now(timezone.utc) - timedelta(hours=hours)
-    
-    # Get all instances in the period
-    all_instances = await db.lab_instances.find(
-        {"started_at": {"$gte": start_time.isoformat()}},
-        {"_id": 0}
-    ).to_list(10000)
-    
-    # Calculate metrics
-    total_instances = len(all_instances)
-    total_hours = sum(
-        2 for inst in all_instances  # Each lab session is ~2 hours
-    )
+    current_hour = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    start_hour = current_hour - timedelta(hours=hours - 1)
     
-    # Provider breakdown
-    provider_usage = {}
-    for provider in ["aws", "gcp", "azure"]:
-        count = len([i for i in all_instances if i.get("provider") == provider])
-        provider_usage[provider] = count
+    buckets = await db.lab_metrics_hourly.find(
+        {"_id": {"$gte": start_hour.isoformat()}}
+    ).to_list(hours + 1)
+    bucket_map = {b["_id"]: b for b in buckets}
     
-    # Cost estimation
-    total_cost = sum(inst.get("cost_estimate", 0.1) for inst in all_instances)
-    
-    # Hourly breakdown (simulated)
     hourly_data = []
-    for h in range(min(24, hours)):
-        hour_time = datetime.now(timezone.utc) - timedelta(hours=h)
+    provider_usage = {provider: 0 for provider in CLOUD_PROVIDERS}
+    totals = {"instances": 0, "lab_hours": 0.0, "vcpu_hours": 0.0, "cost": 0.0, "failures": 0}
+    for h in range(hours):
+        hour = (start_hour + timedelta(hours=h)).isoformat()
+        bucket = bucket_map.get(hour, {})
         hourly_data.append({
-            "hour": hour_time.isoformat(),
-            "instances": max(0, total_instances // 24 + (1 if h < total_instances % 24 else 0)),
-            "cost": round(total_cost / 24, 2)
+            "hour": hour,
+            "instances": bucket.get("instances_started", 0),
+            "lab_hours": round(bucket.get("lab_hours", 0.0), 2),
+            "vcpu_hours": round(bucket.get("vcpu_hours", 0.0), 2),
+            "cost": round(bucket.get("cost", 0.0), 2)
         })
+        totals["instances"] += bucket.get("instances_started", 0)
+        totals["lab_hours"] += bucket.get("lab_hours", 0.0)
+        totals["vcpu_hours"] += bucket.get("vcpu_hours", 0.0)
+        totals["cost"] += bucket.get("cost", 0.0)
+        totals["failures"] += bucket.get("provision_failures", 0)
+        for provider, count in bucket.get("providers", {}).items():
+            provider_usage[provider] = provider_usage.get(provider, 0) + count
     
     return {
         "period": period,
-        "total_instances": total_instances,
-        "total_lab_hours": total_hours,
-        "estimated_cost": round(total_cost, 2),
+        "total_instances": totals["instances"],
+        "total_lab_hours": round(totals["lab_hours"], 2),
+        "total_vcpu_hours": round(totals["vcpu_hours"], 2),
+        "estimated_cost": round(totals["cost"], 2),
+        "provision_failures": totals["failures"],
         "provider_usage": provider_usage,
-        "hourly_breakdown": hourly_data[::-1]  # Oldest first
+        "hourly_breakdown": hourly_data  # Oldest first
     }
 
 
+# === Capacity Planning Routes ===
+
+@api_router.get("/admin/lab-orchestration/capacity")
+async def admin_get_capacity(admin: Dict = Depends(get_admin)):
+    """Current vCPU usage against capacity per provider region"""
+    await capacity_tracker.refresh()
+    providers = await provider_registry.get_all()
+    regions = []
+    for pid, config in providers.items():
+        capacity = config.get("region_vcpu_capacity", 0)
+        for region in config.get("regions", []):
+            used = capacity_tracker.usage.get((pid, region), {"vcpu": 0, "instances": 0, "warm": 0})
+            regions.append({
+                "provider": pid,
+                "region": region,
+                "is_enabled": config.get("is_enabled", True),
+                "capacity_vcpu": capacity,
+                "used_vcpu": used["vcpu"],
+                "instances": used["instances"],
+                "warm_environments": used.get("warm", 0),
+                "utilization": round(used["vcpu"] / capacity, 4) if capacity else None
+            })
+    return {"regions": regions}
+
+@api_router.post("/admin/lab-orchestration/capacity/forecast")
+async def admin_forecast_capacity(data: CapacityForecastRequest, admin: Dict = Depends(get_admin)):
+    """Project where a cohort starting at start_at would be placed and what it would cost"""
+    # expires_at is stored as a UTC ISO string, so compare against start_at in UTC
+    start_at = to_utc_iso(data.start_at)
+    providers = await provider_registry.get_all()
+    allowed_providers = data.providers or list(providers)
+    if data.lab_id:
+        lab = await db.labs.find_one({"lab_id": data.lab_id}, {"_id": 0, "providers": 1})
+        if not lab:
+            raise HTTPException(status_code=404, detail="Lab not found")
+        if lab.get("providers"):
+            allowed_providers = [p for p in allowed_providers if p in lab["providers"]]
+    
+    # Instances still active at the cohort start keep their capacity
+    usage = {}
+    pipeline = [
+        {"$match": {"status": {"$in": LAB_ACTIVE_STATUSES}, "expires_at": {"$gt": start_at}}},
+        {"$group": {
+            "_id": {"provider": "$provider", "region": "$region"},
+            "vcpu": {"$sum": "$resources.vcpu"},
+            "instances": {"$sum": 1}
+        }}
+    ]
+    async for row in db.lab_instances.aggregate(pipeline):
+        usage[(row["_id"]["provider"], row["_id"]["region"])] = {"vcpu": row["vcpu"], "instances": row["instances"]}
+    baseline = {key: dict(value) for key, value in usage.items()}
+    
+    instance_types = [data.instance_type] if data.instance_type else DEFAULT_QUOTA["allowed_instance_types"]
+    allocations = {}
+    placed = 0
+    hourly_cost = 0.0
+    for _ in range(data.instance_count):
+        options = rank_placements(providers, usage, allowed_providers, instance_types, instance_type=data.instance_type)
+        if not options:
+            break
+        best = options[0]
+        slot = usage.setdefault((best["provider"], best["region"]), {"vcpu": 0, "instances": 0})
+        slot["vcpu"] += best["vcpu"]
+        slot["instances"] += 1
+        key = (best["provider"], best["region"], best["instance_type"])
+        if key not in allocations:
+            allocations[key] = {
+                "provider": best["provider"],
+                "region": best["region"],
+                "instance_type": best["instance_type"],
+                "cost_per_hour": best["cost_per_hour"],
+                "instances": 0
+            }
+        allocations[key]["instances"] += 1
+        hourly_cost += best["cost_per_hour"]
+        placed += 1
+    
+    regions = []
+    for (pid, region), used in sorted(usage.items()):
+        if pid not in providers:
+            continue
+        capacity = providers[pid].get("region_vcpu_capacity", 0)
+        regions.append({
+            "provider": pid,
+            "region": region,
+            "capacity_vcpu": capacity,
+            "baseline_vcpu": baseline.get((pid, region), {}).get("vcpu", 0),
+            "projected_vcpu": used["vcpu"],
+            "projected_utilization": round(used["vcpu"] / capacity, 4) if capacity else None
+        })
+    
+    return {
+        "start_at": start_at,
+        "requested": data.instance_count,
+        "placed": placed,
+        "shortfall": data.instance_count - placed,
+        "allocations": sorted(allocations.values(), key=lambda a: -a["instances"]),
+        "estimated_hourly_cost": round(hourly_cost, 2),
+        "estimated_session_cost": round(hourly_cost * LAB_SESSION_HOURS, 2),
+        "regions": regions
+    }
+
+
+# === Warm Pool Routes ===
+
+@api_router.get("/admin/lab-orchestration/warm-pools")
+async def admin_list_warm_pools(admin: Dict = Depends(get_admin)):
+    """List warm pool targets with their ready and provisioning environments"""
+    targets = await db.lab_warm_pool_targets.find({}, {"_id": 0}).to_list(1000)
+    pools = {}
+    async for row in db.lab_warm_pool.aggregate([
+        {"$match": {"status": {"$in": ["provisioning", "ready"]}}},
+        {"$group": {"_id": {"pool_id": "$pool_id", "status": "$status"}, "count": {"$sum": 1}}}
+    ]):
+        pools.setdefault(row["_id"]["pool_id"], {})[row["_id"]["status"]] = row["count"]
+    for target in targets:
+        counts = pools.get(target["pool_id"], {})
+        target["ready"] = counts.get("ready", 0)
+        target["provisioning"] = counts.get("provisioning", 0)
+    return targets
+
+@api_router.put("/admin/lab-orchestration/warm-pools")
+async def admin_upsert_warm_pool(data: WarmPoolTargetUpdate, admin: Dict = Depends(get_admin)):
+    """Create or update the warm pool target for a (lab, provider, instance type)"""
+    if data.provider not in CLOUD_PROVIDERS:
+        raise HTTPException(status_code=400, detail=f"Unknown provider {data.provider}")
+    if data.instance_type not in CLOUD_PROVIDERS[data.provider]["instance_types"]:
+        raise HTTPException(status_code=400, detail=f"Unknown instance type {data.instance_type}")
+    if data.max_size < data.min_size:
+        raise HTTPException(status_code=400, detail="max_size must be at least min_size")
+    if not await db.labs.find_one({"lab_id": data.lab_id}, {"_id": 1}):
+        raise HTTPException(status_code=404, detail="Lab not found")
+    
+    schedule = [
+        {"start_at": to_utc_iso(w.start_at), "end_at": to_utc_iso(w.end_at), "size": w.size}
+        for w in sorted(data.schedule, key=lambda w: to_utc_iso(w.start_at))
+    ]
+    key = {"lab_id": data.lab_id, "provider": data.provider, "instance_type": data.instance_type}
+    target = await db.lab_warm_pool_targets.find_one_and_update(
+        key,
+        {
+            "$set": {
+                "min_size": data.min_size,
+                "max_size": data.max_size,
+                "demand_factor": data.demand_factor,
+                "schedule": schedule,
+                "updated_at": datetime.now(timezone.utc).isoformat()
+            },
+            "$setOnInsert": {**key, "pool_id": f"pool_{uuid.uuid4().hex[:12]}"}
+        },
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    target.pop("_id", None)
+    warm_pool.invalidate()
+    logger.info(f"Admin {admin['email']} updated warm pool {target['pool_id']} for lab {data.lab_id}")
+    return target
+
+@api_router.delete("/admin/lab-orchestration/warm-pools/{pool_id}")
+async def admin_delete_warm_pool(pool_id: str, admin: Dict = Depends(get_admin)):
+    """Remove a warm pool target; its ready environments are retired in the background"""
+    result = await db.lab_warm_pool_targets.delete_one({"pool_id": pool_id})
+    if result.deleted_count == 0:
+        raise HTTPException(status_code=404, detail="Warm pool not found")
+    warm_pool.invalidate()
+    logger.info(f"Admin {admin['email']} removed warm pool {pool_id}")
+    return {"message": "Warm pool removed"}
+
+
 # ============== EXAM & CERTIFICATION ADMIN ROUTES ==============
 
 # Pydantic Models for Exam Admin
@@ -4613,6 +7125,7 @@ class CertificateTemplateCreate(BaseModel):
     include_qr: bool = True
     custom_text: str = ""
     is_default: bool = False
+    version: int = 1
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
@@ -4633,6 +7146,113 @@ class ExamAttemptCreate(BaseModel):
     status: str = "in_progress"  # in_progress, completed, abandoned
 
 
+# === Question Near-Duplicate Index ===
+
+# MinHash over word shingles of question_text + options, bucketed with LSH bands.
+# 16 bands x 8 rows puts the candidate threshold at ~0.7 Jaccard similarity.
+MINHASH_NUM_PERM = 128
+LSH_BANDS = 16
+LSH_ROWS = MINHASH_NUM_PERM // LSH_BANDS
+NEAR_DUPLICATE_THRESHOLD = 0.8
+NEAR_DUPLICATE_MAX_CANDIDATES = 2000
+
+_MINHASH_PRIME = np.uint64((1 << 61) - 1)
+_MINHASH_MASK = np.uint64(0xFFFFFFFF)
+_minhash_rng = np.random.RandomState(365)
+_MINHASH_A = _minhash_rng.randint(1, (1 << 61) - 1, size=MINHASH_NUM_PERM, dtype=np.uint64)
+_MINHASH_B = _minhash_rng.randint(0, (1 << 61) - 1, size=MINHASH_NUM_PERM, dtype=np.uint64)
+
+def question_shingles(question_text: str, options: List[str]) -> set:
+    """Word 3-gram shingles of the question text and each option (option order ignored)"""
+    shingles = set()
+    for part in [question_text or ""] + sorted(options or []):
+        tokens = re.findall(r"[a-z0-9]+", part.lower())
+        if len(tokens) < 3:
+            if tokens:
+                shingles.add(" ".join(tokens))
+            continue
+        for i in range(len(tokens) - 2):
+            shingles.add(" ".join(tokens[i:i + 3]))
+    return shingles
+
+def compute_question_signature(question: Dict) -> Dict:
+    """Build the question_signatures document for a question"""
+    shingles = question_shingles(question.get("question_text", ""), question.get("options", []))
+    bands = []
+    if shingles:
+        hashes = np.fromiter((zlib.crc32(s.encode()) for s in shingles), dtype=np.uint64, count=len(shingles))
+        permuted = (np.outer(_MINHASH_A, hashes) + _MINHASH_B[:, None]) % _MINHASH_PRIME & _MINHASH_MASK
+        signature = permuted.min(axis=1)
+        for band in range(LSH_BANDS):
+            rows = signature[band * LSH_ROWS:(band + 1) * LSH_ROWS]
+            bands.append(f"{band}:{hashlib.blake2b(rows.tobytes(), digest_size=8).hexdigest()}")
+    else:
+        signature = np.full(MINHASH_NUM_PERM, _MINHASH_MASK, dtype=np.uint64)
+    return {
+        "question_id": question["question_id"],
+        "cert_id": question.get("cert_id"),
+        "signature": signature.tolist(),
+        "bands": bands,
+        "indexed_at": datetime.now(timezone.utc).isoformat()
+    }
+
+def signature_similarity(a: List[int], b: List[int]) -> float:
+    """Estimated Jaccard similarity of two MinHash signatures"""
+    return float(np.mean(np.asarray(a, dtype=np.uint64) == np.asarray(b, dtype=np.uint64)))
+
+async def index_question_signatures(signatures: List[Dict]):
+    """Upsert signature documents into the near-duplicate index"""
+    if not signatures:
+        return
+    await db.question_signatures.bulk_write(
+        [ReplaceOne({"question_id": s["question_id"]}, s, upsert=True) for s in signatures],
+        ordered=False
+    )
+
+async def find_near_duplicates(
+    signature: Dict,
+    cert_id: Optional[str] = None,
+    threshold: float = NEAR_DUPLICATE_THRESHOLD,
+    limit: int = 20
+) -> List[Dict]:
+    """Look up questions sharing an LSH band with the signature and above the similarity threshold"""
+    if not signature["bands"]:
+        return []
+    query = {"bands": {"$in": signature["bands"]}, "question_id": {"$ne": signature["question_id"]}}
+    if cert_id:
+        query["cert_id"] = cert_id
+    candidates = await db.question_signatures.find(
+        query, {"_id": 0, "question_id": 1, "signature": 1}
+    ).to_list(NEAR_DUPLICATE_MAX_CANDIDATES)
+    
+    scored = []
+    for candidate in candidates:
+        similarity = signature_similarity(signature["signature"], candidate["signature"])
+        if similarity >= threshold:
+            scored.append((similarity, candidate["question_id"]))
+    scored.sort(reverse=True)
+    scored = scored[:limit]
+    if not scored:
+        return []
+    
+    questions = await db.question_bank.find(
+        {"question_id": {"$in": [qid for _, qid in scored]}},
+        {"_id": 0, "question_id": 1, "cert_id": 1, "domain": 1, "question_text": 1, "options": 1, "is_active": 1}
+    ).to_list(limit)
+    question_map = {q["question_id"]: q for q in questions}
+    return [
+        {**question_map[qid], "similarity": round(similarity, 3)}
+        for similarity, qid in scored if qid in question_map
+    ]
+
+class NearDuplicateQuery(BaseModel):
+    question_text: str
+    options: List[str] = []
+    cert_id: Optional[str] = None
+    threshold: float = NEAR_DUPLICATE_THRESHOLD
+    limit: int = 20
+
+
 # === Admin Question Bank Routes ===
 
 @api_router.get("/admin/question-bank/stats")
@@ -4728,6 +7348,7 @@ async def admin_create_question(question: QuestionCreate, admin: Dict = Depends(
     question_dict["created_by"] = admin["user_id"]
     
     await db.question_bank.insert_one(question_dict)
+    await index_question_signatures([compute_question_signature(question_dict)])
     
     logger.info(f"Admin {admin['email']} created question {question.question_id}")
     return {"message": "Question created", "question_id": question.question_id}
@@ -4750,6 +7371,10 @@ async def admin_update_question(question_id: str, updates: Dict, admin: Dict = D
         {"$set": updates}
     )
     
+    if any(field in updates for field in ("question_text", "options", "cert_id")):
+        updated = await db.question_bank.find_one({"question_id": question_id}, {"_id": 0})
+        await index_question_signatures([compute_question_signature(updated)])
+    
     logger.info(f"Admin {admin['email']} updated question {question_id}")
     return {"message": "Question updated"}
 
@@ -4759,34 +7384,419 @@ async def admin_delete_question(question_id: str, admin: Dict = Depends(get_supe
     result = await db.question_bank.delete_one({"question_id": question_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Question not found")
+    await db.question_signatures.delete_one({"question_id": question_id})
+    
+    logger.info(f"Super admin {admin['email']} deleted question {question_id}")
+    return {"message": "Question deleted"}
+
+QUESTION_IMPORT_BATCH_SIZE = 1000
+QUESTION_IMPORT_MAX_ERRORS = 500
+QUESTION_IMPORT_LIST_FIELDS = ("options", "correct_answers", "tags")
+QUESTION_IMPORT_CSV_PARSE_BATCH = 500  # CSV records parsed per worker-thread call
+
+async def iter_upload_text(request: Request):
+    """Yield decoded text from the request body as it streams in; a body that is not UTF-8 is a 400"""
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()  # Drops a leading BOM
+    consumed = 0
+    try:
+        async for chunk in request.stream():
+            text = decoder.decode(chunk)
+            consumed += len(chunk)
+            if text:
+                yield text
+        text = decoder.decode(b"", final=True)
+        if text:
+            yield text
+    except UnicodeDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"Upload is not valid UTF-8 (byte {consumed + e.start})")
+
+def split_upload_lines(pending: str, text: str) -> tuple:
+    """Complete lines (with their newline) in pending + text, and the unfinished remainder"""
+    *lines, pending = (pending + text).split("\n")
+    return [line + "\n" for line in lines], pending
+
+async def iter_upload_lines(request: Request):
+    """Yield decoded lines from the request body as it streams in"""
+    pending = ""
+    async for text in iter_upload_text(request):
+        lines, pending = split_upload_lines(pending, text)
+        for line in lines:
+            yield line
+    if pending:
+        yield pending
+
+async def iter_ndjson_records(lines):
+    """Parse NDJSON lines into (row, record) pairs; unparseable rows yield a ValueError"""
+    row = 0
+    async for line in lines:
+        if not line.strip():
+            continue
+        row += 1
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            yield row, ValueError(f"Invalid JSON: {e.msg}")
+            continue
+        if not isinstance(record, dict):
+            yield row, ValueError("Each line must be a JSON object")
+            continue
+        yield row, record
+
+async def iter_csv_records(chunks):
+    """Parse streamed CSV text (header row first) into (row, record) pairs.
+
+    List columns (options, correct_answers, tags) are pipe-separated and empty
+    cells fall back to the QuestionCreate defaults. Quoted fields may span lines.
+    csv.reader runs in a worker thread and pulls text chunks back from the loop,
+    so parsing follows the real quoting rules without buffering the upload.
+    """
+    loop = asyncio.get_running_loop()
+    
+    def upload_lines():
+        pending = ""
+        while True:
+            try:
+                text = asyncio.run_coroutine_threadsafe(chunks.__anext__(), loop).result()
+            except StopAsyncIteration:
+                break
+            lines, pending = split_upload_lines(pending, text)
+            yield from lines
+        if pending:
+            yield pending
+    
+    reader = csv.reader(upload_lines(), strict=True)
+    
+    def parse_batch() -> tuple:
+        values, error = [], None
+        try:
+            values.extend(itertools.islice(reader, QUESTION_IMPORT_CSV_PARSE_BATCH))
+        except csv.Error as e:
+            error = e
+        return values, error
+    
+    header = None
+    row = 0
+    while True:
+        batch, error = await asyncio.to_thread(parse_batch)
+        for values in batch:
+            if not any(v.strip() for v in values):
+                continue
+            if header is None:
+                header = [h.strip() for h in values]
+                continue
+            row += 1
+            if len(values) != len(header):
+                yield row, ValueError(f"Expected {len(header)} columns, got {len(values)}")
+                continue
+            record = {}
+            for key, value in zip(header, values):
+                if value == "":
+                    continue
+                if key in QUESTION_IMPORT_LIST_FIELDS:
+                    record[key] = [v.strip() for v in value.split("|") if v.strip()]
+                else:
+                    record[key] = value
+            yield row, record
+        if error:
+            row += 1
+            yield row, ValueError("Unterminated quoted field" if "unexpected end of data" in str(error) else f"Malformed CSV: {error}")
+            continue
+        if len(batch) < QUESTION_IMPORT_CSV_PARSE_BATCH:
+            break
+
+async def run_question_import(
+    records,
+    admin: Dict,
+    import_id: str,
+    source: str,
+    dedup: bool = False,
+    dedup_threshold: float = NEAR_DUPLICATE_THRESHOLD
+) -> Dict:
+    """Validate question records and insert them in unordered insert_many batches.
+
+    Progress is written to question_imports after every batch so large uploads
+    can be followed from GET /admin/question-bank/imports/{import_id}. With
+    dedup enabled, rows that are near-duplicates of an existing question (same
+    certification) or of an earlier row in the upload are skipped.
+    """
+    known_certs = set(await db.certifications.distinct("cert_id"))
+    seen_ids = set()
+    batch = []
+    # LSH band -> signatures of rows already accepted from this upload
+    upload_bands = {}
+    summary = {
+        "import_id": import_id,
+        "source": source,
+        "dedup": dedup,
+        "status": "running",
+        "processed": 0,
+        "imported": 0,
+        "duplicates": 0,
+        "failed": 0,
+        "errors": []
+    }
+    
+    try:
+        await db.question_imports.insert_one({
+            **summary,
+            "created_by": admin["user_id"],
+            "started_at": datetime.now(timezone.utc).isoformat()
+        })
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail="Import ID already exists")
+    
+    def record_error(row: int, error: str, question_id: Optional[str] = None, duplicate: bool = False, **extra):
+        if duplicate:
+            summary["duplicates"] += 1
+        else:
+            summary["failed"] += 1
+        if len(summary["errors"]) < QUESTION_IMPORT_MAX_ERRORS:
+            summary["errors"].append({"row": row, "question_id": question_id, "error": error, **extra})
+    
+    async def drop_near_duplicates(rows: List, signatures: Dict) -> List:
+        all_bands = list({band for sig in signatures.values() for band in sig["bands"]})
+        existing_bands = {}
+        if all_bands:
+            candidates = await db.question_signatures.find(
+                {"bands": {"$in": all_bands}, "cert_id": {"$in": list({doc["cert_id"] for _, doc in rows})}},
+                {"_id": 0, "question_id": 1, "cert_id": 1, "signature": 1, "bands": 1}
+            ).to_list(None)
+            for candidate in candidates:
+                for band in candidate["bands"]:
+                    existing_bands.setdefault(band, []).append(candidate)
+        
+        kept = []
+        for row, doc in rows:
+            sig = signatures[doc["question_id"]]
+            best = None
+            for band in sig["bands"]:
+                for candidate in existing_bands.get(band, []) + upload_bands.get(band, []):
+                    if candidate["cert_id"] != doc["cert_id"]:
+                        continue
+                    similarity = signature_similarity(sig["signature"], candidate["signature"])
+                    if similarity >= dedup_threshold and (best is None or similarity > best[0]):
+                        best = (similarity, candidate["question_id"])
+            if best:
+                record_error(
+                    row, "Near-duplicate question", doc["question_id"], duplicate=True,
+                    near_duplicate_of=best[1], similarity=round(best[0], 3)
+                )
+                continue
+            for band in sig["bands"]:
+                upload_bands.setdefault(band, []).append(sig)
+            kept.append((row, doc))
+        return kept
+    
+    async def save_progress(**extra):
+        await db.question_imports.update_one(
+            {"import_id": import_id},
+            {"$set": {k: v for k, v in {**summary, **extra}.items() if k != "import_id"}}
+        )
+    
+    async def flush():
+        ids = [doc["question_id"] for _, doc in batch]
+        existing = set(await db.question_bank.distinct("question_id", {"question_id": {"$in": ids}}))
+        now = datetime.now(timezone.utc).isoformat()
+        to_insert = []
+        for row, doc in batch:
+            if doc["question_id"] in existing:
+                record_error(row, "Duplicate question_id", doc["question_id"], duplicate=True)
+                continue
+            doc["created_at"] = now
+            doc["updated_at"] = now
+            to_insert.append((row, doc))
+        batch.clear()
+        
+        signatures = {doc["question_id"]: compute_question_signature(doc) for _, doc in to_insert}
+        if dedup and to_insert:
+            to_insert = await drop_near_duplicates(to_insert, signatures)
+        
+        if to_insert:
+            failed_ids = set()
+            try:
+                result = await db.question_bank.insert_many([doc for _, doc in to_insert], ordered=False)
+                summary["imported"] += len(result.inserted_ids)
+            except BulkWriteError as e:
+                summary["imported"] += e.details.get("nInserted", 0)
+                for write_error in e.details.get("writeErrors", []):
+                    row, doc = to_insert[write_error["index"]]
+                    failed_ids.add(doc["question_id"])
+                    if write_error.get("code") == 11000:
+                        record_error(row, "Duplicate question_id", doc["question_id"], duplicate=True)
+                    else:
+                        record_error(row, write_error.get("errmsg", "Write failed"), doc["question_id"])
+            await index_question_signatures([
+                signatures[doc["question_id"]] for _, doc in to_insert if doc["question_id"] not in failed_ids
+            ])
+        await save_progress()
+    
+    try:
+        async for row, record in records:
+            summary["processed"] += 1
+            if isinstance(record, Exception):
+                record_error(row, str(record))
+                continue
+            
+            try:
+                question = QuestionCreate.model_validate(record)
+            except ValidationError as e:
+                message = "; ".join(
+                    f"{'.'.join(str(p) for p in err['loc'])}: {err['msg']}" for err in e.errors()
+                )
+                record_error(row, message, record.get("question_id"))
+                continue
+            
+            if question.cert_id not in known_certs:
+                record_error(row, f"Certification {question.cert_id} not found", question.question_id)
+                continue
+            if question.question_id in seen_ids:
+                record_error(row, "Duplicate question_id in upload", question.question_id, duplicate=True)
+                continue
+            seen_ids.add(question.question_id)
+            
+            question_dict = question.model_dump()
+            question_dict["created_by"] = admin["user_id"]
+            batch.append((row, question_dict))
+            if len(batch) >= QUESTION_IMPORT_BATCH_SIZE:
+                await flush()
+        
+        if batch:
+            await flush()
+    except Exception as e:
+        summary["status"] = "failed"
+        await save_progress(error=str(e), finished_at=datetime.now(timezone.utc).isoformat())
+        raise
     
-    logger.info(f"Super admin {admin['email']} deleted question {question_id}")
-    return {"message": "Question deleted"}
+    summary["status"] = "completed"
+    await save_progress(finished_at=datetime.now(timezone.utc).isoformat())
+    return summary
 
 @api_router.post("/admin/question-bank/bulk-import")
-async def admin_bulk_import_questions(questions: List[QuestionCreate], admin: Dict = Depends(get_admin)):
+async def admin_bulk_import_questions(
+    questions: List[QuestionCreate],
+    dedup: bool = False,
+    dedup_threshold: float = NEAR_DUPLICATE_THRESHOLD,
+    admin: Dict = Depends(get_admin)
+):
     """Bulk import questions"""
-    imported = 0
-    errors = []
+    async def records():
+        for i, question in enumerate(questions):
+            yield i, question.model_dump()
     
-    for i, question in enumerate(questions):
-        try:
-            question_dict = question.model_dump()
-            question_dict["created_at"] = datetime.now(timezone.utc).isoformat()
-            question_dict["updated_at"] = datetime.now(timezone.utc).isoformat()
-            question_dict["created_by"] = admin["user_id"]
-            await db.question_bank.insert_one(question_dict)
-            imported += 1
-        except Exception as e:
-            errors.append({"index": i, "error": str(e)})
+    import_id = f"imp_{uuid.uuid4().hex[:12]}"
+    summary = await run_question_import(
+        records(), admin, import_id, source="json", dedup=dedup, dedup_threshold=dedup_threshold
+    )
     
-    logger.info(f"Admin {admin['email']} bulk imported {imported} questions")
+    logger.info(f"Admin {admin['email']} bulk imported {summary['imported']} questions")
     return {
-        "message": f"Imported {imported} questions",
-        "imported": imported,
-        "errors": errors
+        "message": f"Imported {summary['imported']} questions",
+        **summary,
+        "errors": [{"index": e["row"], **e} for e in summary["errors"]]
     }
 
+@api_router.post("/admin/question-bank/import")
+async def admin_stream_import_questions(
+    request: Request,
+    file_format: Optional[str] = None,  # ndjson, csv (defaults from Content-Type)
+    import_id: Optional[str] = None,
+    dedup: bool = False,
+    dedup_threshold: float = NEAR_DUPLICATE_THRESHOLD,
+    admin: Dict = Depends(get_admin)
+):
+    """Stream-import questions from an NDJSON or CSV request body"""
+    if not file_format:
+        content_type = request.headers.get("content-type", "")
+        file_format = "csv" if "csv" in content_type else "ndjson"
+    file_format = file_format.lower()
+    if file_format not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="file_format must be ndjson or csv")
+    
+    import_id = import_id or f"imp_{uuid.uuid4().hex[:12]}"
+    if await db.question_imports.find_one({"import_id": import_id}):
+        raise HTTPException(status_code=409, detail="Import ID already exists")
+    
+    if file_format == "csv":
+        records = iter_csv_records(iter_upload_text(request))
+    else:
+        records = iter_ndjson_records(iter_upload_lines(request))
+    summary = await run_question_import(
+        records, admin, import_id, source=file_format, dedup=dedup, dedup_threshold=dedup_threshold
+    )
+    
+    logger.info(
+        f"Admin {admin['email']} streamed import {import_id}: "
+        f"{summary['imported']} imported, {summary['duplicates']} duplicates, {summary['failed']} failed"
+    )
+    return summary
+
+@api_router.get("/admin/question-bank/imports/{import_id}")
+async def admin_get_question_import(import_id: str, admin: Dict = Depends(get_admin)):
+    """Get progress of a question import"""
+    progress = await db.question_imports.find_one({"import_id": import_id}, {"_id": 0})
+    if not progress:
+        raise HTTPException(status_code=404, detail="Import not found")
+    return progress
+
+@api_router.post("/admin/question-bank/near-duplicates")
+async def admin_check_near_duplicates(data: NearDuplicateQuery, admin: Dict = Depends(get_admin)):
+    """Find existing questions that are near-duplicates of the given text and options"""
+    signature = compute_question_signature({
+        "question_id": "",
+        "question_text": data.question_text,
+        "options": data.options
+    })
+    matches = await find_near_duplicates(signature, data.cert_id, data.threshold, data.limit)
+    return {"matches": matches, "threshold": data.threshold}
+
+@api_router.get("/admin/question-bank/{question_id}/near-duplicates")
+async def admin_get_near_duplicates(
+    question_id: str,
+    threshold: float = NEAR_DUPLICATE_THRESHOLD,
+    same_cert: bool = True,
+    limit: int = 20,
+    admin: Dict = Depends(get_admin)
+):
+    """Find near-duplicates of an existing question"""
+    question = await db.question_bank.find_one({"question_id": question_id}, {"_id": 0})
+    if not question:
+        raise HTTPException(status_code=404, detail="Question not found")
+    
+    signature = await db.question_signatures.find_one({"question_id": question_id}, {"_id": 0})
+    if not signature:
+        signature = compute_question_signature(question)
+        await index_question_signatures([signature])
+    
+    cert_id = question.get("cert_id") if same_cert else None
+    matches = await find_near_duplicates(signature, cert_id, threshold, limit)
+    return {"question_id": question_id, "matches": matches, "threshold": threshold}
+
+@api_router.post("/admin/question-bank/signatures/rebuild")
+async def admin_rebuild_question_signatures(admin: Dict = Depends(get_super_admin)):
+    """Rebuild the near-duplicate index for the whole question bank (super_admin only)"""
+    started_at = datetime.now(timezone.utc).isoformat()
+    indexed = 0
+    signatures = []
+    
+    cursor = db.question_bank.find(
+        {}, {"_id": 0, "question_id": 1, "cert_id": 1, "question_text": 1, "options": 1}
+    ).batch_size(QUESTION_IMPORT_BATCH_SIZE)
+    async for question in cursor:
+        signatures.append(compute_question_signature(question))
+        if len(signatures) >= QUESTION_IMPORT_BATCH_SIZE:
+            await index_question_signatures(signatures)
+            indexed += len(signatures)
+            signatures = []
+    if signatures:
+        await index_question_signatures(signatures)
+        indexed += len(signatures)
+    
+    # Signatures not touched by this rebuild belong to deleted questions
+    stale = await db.question_signatures.delete_many({"indexed_at": {"$lt": started_at}})
+    
+    logger.info(f"Super admin {admin['email']} rebuilt question signatures ({indexed} indexed)")
+    return {"indexed": indexed, "removed": stale.deleted_count}
+
 
 # === Admin Exam Management Routes ===
 
@@ -4865,7 +7875,7 @@ async def admin_get_exam(exam_id: str, admin: Dict = Depends(get_admin)):
         questions = await db.question_bank.find(
             {"question_id": {"$in": exam["question_ids"]}},
             {"_id": 0}
-        ).to_list(500)
+        ).to_list(len(exam["question_ids"]))
         exam["questions"] = questions
     
     return exam
@@ -4918,51 +7928,58 @@ async def admin_delete_exam(exam_id: str, admin: Dict = Depends(get_super_admin)
     logger.info(f"Super admin {admin['email']} deleted exam {exam_id}")
     return {"message": "Exam deleted"}
 
+async def count_exam_questions(exam_id: str) -> int:
+    """Size of an exam's question_ids array without loading it"""
+    result = await db.admin_exams.aggregate([
+        {"$match": {"exam_id": exam_id}},
+        {"$project": {"_id": 0, "count": {"$size": {"$ifNull": ["$question_ids", []]}}}}
+    ]).to_list(1)
+    return result[0]["count"] if result else 0
+
 @api_router.post("/admin/exams/{exam_id}/add-questions")
 async def admin_add_questions_to_exam(exam_id: str, question_ids: List[str], admin: Dict = Depends(get_admin)):
     """Add questions to an exam (for fixed selection)"""
-    exam = await db.admin_exams.find_one({"exam_id": exam_id})
+    exam = await db.admin_exams.find_one({"exam_id": exam_id}, {"_id": 1})
     if not exam:
         raise HTTPException(status_code=404, detail="Exam not found")
     
-    # Verify questions exist
-    for qid in question_ids:
-        q = await db.question_bank.find_one({"question_id": qid})
-        if not q:
-            raise HTTPException(status_code=404, detail=f"Question {qid} not found")
+    question_ids = list(dict.fromkeys(question_ids))
     
-    current_ids = exam.get("question_ids", [])
-    new_ids = list(set(current_ids + question_ids))
+    # Verify questions exist with a single query
+    found = set(await db.question_bank.distinct("question_id", {"question_id": {"$in": question_ids}}))
+    missing = [qid for qid in question_ids if qid not in found]
+    if missing:
+        shown = ", ".join(missing[:20]) + (f" (+{len(missing) - 20} more)" if len(missing) > 20 else "")
+        raise HTTPException(status_code=404, detail=f"Questions not found: {shown}")
     
-    await db.admin_exams.update_one(
+    result = await db.admin_exams.update_one(
         {"exam_id": exam_id},
-        {"$set": {
-            "question_ids": new_ids,
-            "updated_at": datetime.now(timezone.utc).isoformat()
-        }}
+        {
+            "$addToSet": {"question_ids": {"$each": question_ids}},
+            "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}
+        }
     )
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="Exam not found")
     
-    return {"message": f"Added {len(question_ids)} questions", "total_questions": len(new_ids)}
+    total = await count_exam_questions(exam_id)
+    return {"message": f"Added {len(question_ids)} questions", "total_questions": total}
 
 @api_router.post("/admin/exams/{exam_id}/remove-questions")
 async def admin_remove_questions_from_exam(exam_id: str, question_ids: List[str], admin: Dict = Depends(get_admin)):
     """Remove questions from an exam"""
-    exam = await db.admin_exams.find_one({"exam_id": exam_id})
-    if not exam:
-        raise HTTPException(status_code=404, detail="Exam not found")
-    
-    current_ids = exam.get("question_ids", [])
-    new_ids = [qid for qid in current_ids if qid not in question_ids]
-    
-    await db.admin_exams.update_one(
+    result = await db.admin_exams.update_one(
         {"exam_id": exam_id},
-        {"$set": {
-            "question_ids": new_ids,
-            "updated_at": datetime.now(timezone.utc).isoformat()
-        }}
+        {
+            "$pull": {"question_ids": {"$in": list(set(question_ids))}},
+            "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}
+        }
     )
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="Exam not found")
     
-    return {"message": f"Removed {len(question_ids)} questions", "total_questions": len(new_ids)}
+    total = await count_exam_questions(exam_id)
+    return {"message": f"Removed {len(question_ids)} questions", "total_questions": total}
 
 
 # === Admin Certificate Template Routes ===
@@ -5026,12 +8043,14 @@ async def admin_update_certificate_template(template_id: str, updates: Dict, adm
     
     updates.pop("template_id", None)
     updates.pop("_id", None)
+    updates.pop("version", None)
     updates["updated_at"] = datetime.now(timezone.utc).isoformat()
     updates["updated_by"] = admin["user_id"]
     
+    # A new version invalidates compiled plans and cached PDFs rendered from this template
     await db.certificate_templates.update_one(
         {"template_id": template_id},
-        {"$set": updates}
+        {"$set": updates, "$inc": {"version": 1}}
     )
     
     logger.info(f"Admin {admin['email']} updated template {template_id}")
@@ -5101,6 +8120,202 @@ async def admin_revoke_certificate(certificate_id: str, reason: str = "Administr
     return {"message": "Certificate revoked"}
 
 
+# === Admin Bulk Certificate Issuance ===
+
+BULK_CERTIFICATE_MAX_USERS = 5000
+BULK_CERTIFICATE_RENDER_BATCH = 8  # Certificates per render pool call
+BULK_CERTIFICATE_RENDER_RETRIES = 3
+BULK_CERTIFICATE_MANIFEST_COLUMNS = ["user_id", "user_email", "certificate_id", "status", "readiness_percentage"]
+
+class ZipStreamBuffer:
+    """Write-only sink for zipfile; the streaming response drains it after each entry"""
+    
+    def __init__(self):
+        self.chunks: List[bytes] = []
+    
+    def write(self, data: bytes) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+    
+    def flush(self):
+        pass
+    
+    def take(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+async def certificate_eligibility(cert_id: str, user_ids: List[str]) -> List[Dict]:
+    """Readiness, activity counts, user details and any issued certificate for each learner, in one aggregation"""
+    pipeline = [
+        {"$match": {"cert_id": cert_id, "user_id": {"$in": user_ids}}},
+        {"$lookup": {"from": "users", "localField": "user_id", "foreignField": "user_id", "as": "user"}},
+        {"$lookup": {"from": "user_certificates", "localField": "user_id", "foreignField": "user_id", "as": "issued"}},
+        {"$project": {
+            "_id": 0,
+            "user_id": 1,
+            "readiness_percentage": {"$ifNull": ["$readiness_percentage", 0]},
+            "labs_completed": {"$size": {"$ifNull": ["$labs_completed", []]}},
+            "assessments_passed": {"$size": {"$filter": {
+                "input": {"$ifNull": ["$assessments_completed", []]},
+                "cond": {"$eq": ["$$this.passed", True]}
+            }}},
+            "projects_completed": {"$size": {"$ifNull": ["$projects_completed", []]}},
+            "user": {"$arrayElemAt": ["$user", 0]},
+            "issued": {"$filter": {"input": "$issued", "cond": {"$eq": ["$$this.cert_id", cert_id]}}}
+        }}
+    ]
+    return await db.user_progress.aggregate(pipeline).to_list(None)
+
+async def render_certificate_group(certificates: List[Dict], template: Optional[Dict]) -> List[tuple]:
+    """PDFs for a group of certificates: cached renders are reused, the rest rendered in one pool call"""
+    results, missing = [], []
+    for certificate in certificates:
+        path = certificate_cache_path(certificate["certificate_id"], certificate_render_key(certificate, template))
+        if await asyncio.to_thread(path.exists):
+            results.append((certificate, await asyncio.to_thread(path.read_bytes)))
+        else:
+            missing.append((certificate, path))
+    if missing:
+        for attempt in range(BULK_CERTIFICATE_RENDER_RETRIES):
+            try:
+                pdfs = await certificate_render_pool.run(
+                    render_certificate_batch, [certificate_render_payload(c) for c, _ in missing], template
+                )
+                break
+            except RenderPoolBusy:
+                if attempt == BULK_CERTIFICATE_RENDER_RETRIES - 1:
+                    raise
+                await asyncio.sleep(CERTIFICATE_RENDER_RETRY_AFTER_SECONDS)
+        for (certificate, path), pdf in zip(missing, pdfs):
+            try:
+                await asyncio.to_thread(store_certificate_pdf, path, pdf)
+            except OSError as e:
+                logger.warning(f"Could not cache certificate {certificate['certificate_id']}: {e}")
+            results.append((certificate, pdf))
+    return results
+
+async def stream_certificate_zip(certificates: List[Dict], template: Optional[Dict], manifest: List[Dict]):
+    """Yield a ZIP of certificate PDFs, adding each group as soon as its render finishes.
+
+    A group that cannot be rendered is marked render_failed in the manifest; the
+    manifest is always written last so a partial archive is still complete and readable.
+    """
+    sink = ZipStreamBuffer()
+    archive = zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_STORED)  # PDFs are already compressed
+    entries = {entry["certificate_id"]: entry for entry in manifest if entry.get("certificate_id")}
+    groups = iter([
+        certificates[i:i + BULK_CERTIFICATE_RENDER_BATCH]
+        for i in range(0, len(certificates), BULK_CERTIFICATE_RENDER_BATCH)
+    ])
+    pending: Dict[asyncio.Task, List[Dict]] = {}
+    
+    def launch():
+        group = next(groups, None)
+        if group:
+            pending[asyncio.create_task(render_certificate_group(group, template))] = group
+    
+    try:
+        # Keep every render worker busy without queueing the whole cohort at once
+        for _ in range(certificate_render_pool.workers):
+            launch()
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                group = pending.pop(task)
+                try:
+                    rendered = task.result()
+                except Exception as e:
+                    logger.error(f"Bulk certificate render failed for {len(group)} certificates: {e}")
+                    for certificate in group:
+                        entries[certificate["certificate_id"]]["status"] = "render_failed"
+                    rendered = []
+                for certificate, pdf in rendered:
+                    email = re.sub(r'[^A-Za-z0-9@._-]', '_', certificate.get("user_email") or certificate["user_id"])
+                    archive.writestr(f"{email}_{certificate['certificate_id']}.pdf", pdf)
+                    yield sink.take()
+                launch()
+        header = {c: c for c in BULK_CERTIFICATE_MANIFEST_COLUMNS}
+        archive.writestr("manifest.csv", encode_export_rows([header] + manifest, BULK_CERTIFICATE_MANIFEST_COLUMNS, "csv"))
+        archive.close()
+        yield sink.take()
+    finally:
+        for task in pending:
+            task.cancel()
+        if archive.fp is not None:
+            archive.close()
+
+@api_router.post("/admin/certificates/bulk")
+async def admin_bulk_issue_certificates(data: BulkCertificateRequest, admin: Dict = Depends(get_admin)):
+    """Issue certificates to every eligible learner in a cohort and stream them as a ZIP"""
+    user_ids = list(dict.fromkeys(data.user_ids))
+    if not user_ids:
+        raise HTTPException(status_code=400, detail="No users given")
+    if len(user_ids) > BULK_CERTIFICATE_MAX_USERS:
+        raise HTTPException(status_code=400, detail=f"At most {BULK_CERTIFICATE_MAX_USERS} users per request")
+    
+    cert = await db.certifications.find_one({"cert_id": data.cert_id}, {"_id": 0})
+    if not cert:
+        raise HTTPException(status_code=404, detail="Certification not found")
+    
+    rows = {row["user_id"]: row for row in await certificate_eligibility(data.cert_id, user_ids)}
+    # Learners without progress are ineligible; ids without an account are not_found
+    accounts = await users_by_id([user_id for user_id in user_ids if user_id not in rows], {})
+    certificates, new_certificates, manifest = [], [], []
+    for user_id in user_ids:
+        row = rows.get(user_id)
+        entry = {"user_id": user_id, "readiness_percentage": row["readiness_percentage"] if row else 0}
+        if not row:
+            entry["status"] = "ineligible" if user_id in accounts else "not_found"
+        elif not row.get("user"):
+            entry["status"] = "not_found"
+        elif row["issued"]:
+            certificate = {k: v for k, v in row["issued"][0].items() if k != "_id"}
+            certificates.append(certificate)
+            entry.update(status="existing", certificate_id=certificate["certificate_id"])
+        elif row["readiness_percentage"] >= CERTIFICATE_MIN_READINESS:
+            certificate = build_certificate(
+                row["user"], cert, row["readiness_percentage"],
+                labs=row["labs_completed"], assessments=row["assessments_passed"], projects=row["projects_completed"]
+            )
+            new_certificates.append(certificate)
+            certificates.append(certificate)
+            entry.update(status="issued", certificate_id=certificate["certificate_id"])
+        else:
+            entry["status"] = "ineligible"
+        if row and row.get("user"):
+            entry["user_email"] = row["user"].get("email")
+        manifest.append(entry)
+    
+    if new_certificates:
+        # insert_many adds _id to the dicts; strip it so they render and pickle cleanly
+        await db.user_certificates.insert_many(new_certificates, ordered=False)
+        for certificate in new_certificates:
+            certificate.pop("_id", None)
+    
+    await db.admin_actions.insert_one({
+        "action_id": f"act_{uuid.uuid4().hex[:12]}",
+        "admin_id": admin["user_id"],
+        "action_type": "bulk_certificate_issue",
+        "target_cert_id": data.cert_id,
+        "details": {"requested": len(user_ids), "issued": len(new_certificates), "included": len(certificates)},
+        "created_at": datetime.now(timezone.utc).isoformat()
+    })
+    logger.info(f"Admin {admin['email']} issued {len(new_certificates)} certificates for {data.cert_id} ({len(certificates)} in archive)")
+    
+    template = await get_certificate_template(data.cert_id)
+    filename = f"SkillTrack365_{cert['code']}_certificates_{datetime.now(timezone.utc).strftime('%Y%m%d')}.zip"
+    return StreamingResponse(
+        stream_certificate_zip(certificates, template, manifest),
+        media_type="application/zip",
+        headers={
+            "Content-Disposition": f"attachment; filename={filename}",
+            "X-Certificates-Issued": str(len(new_certificates)),
+            "X-Certificates-Included": str(len(certificates))
+        }
+    )
+
+
 # === Admin Exam Attempts/Analytics Routes ===
 
 @api_router.get("/admin/exam-attempts")
@@ -5125,11 +8340,15 @@ async def admin_get_exam_attempts(
     attempts = await db.exam_attempts.find(query, {"_id": 0}).sort("started_at", -1).skip(skip).limit(limit).to_list(limit)
     
     # Enrich with user and exam info
+    users = await users_by_id([a.get("user_id") for a in attempts], {"name": 1, "email": 1})
+    exam_ids = list({a.get("exam_id") for a in attempts})
+    exams = {
+        exam.pop("exam_id"): exam
+        for exam in await db.admin_exams.find({"exam_id": {"$in": exam_ids}}, {"_id": 0, "exam_id": 1, "title": 1}).to_list(len(exam_ids))
+    }
     for attempt in attempts:
-        user = await db.users.find_one({"user_id": attempt.get("user_id")}, {"_id": 0, "name": 1, "email": 1})
-        exam = await db.admin_exams.find_one({"exam_id": attempt.get("exam_id")}, {"_id": 0, "title": 1})
-        attempt["user"] = user
-        attempt["exam"] = exam
+        attempt["user"] = users.get(attempt.get("user_id"))
+        attempt["exam"] = exams.get(attempt.get("exam_id"))
     
     return {
         "attempts": attempts,
@@ -5246,31 +8465,66 @@ class RefundRequest(BaseModel):
     reason: str
     amount: Optional[float] = None  # Partial refund if specified
 
+# Calendar bucket ($dateTrunc unit) and label format per analytics period; weeks are ISO weeks
+BILLING_PERIODS = {
+    "daily": ("day", "%Y-%m-%d"),
+    "weekly": ("week", "%G-W%V"),
+    "monthly": ("month", "%Y-%m"),
+    "yearly": ("year", "%Y")
+}
+
+def billing_period_stages(date_field: str, period: str, tz: str, sums: Dict) -> List[Dict]:
+    """Pipeline stages grouping a BSON date field into labelled calendar buckets in tz"""
+    unit, label = BILLING_PERIODS[period]
+    trunc = {"date": f"${date_field}", "unit": unit, "timezone": tz}
+    if unit == "week":
+        trunc["startOfWeek"] = "monday"
+    return [
+        {"$group": {"_id": {"$dateTrunc": trunc}, **sums}},
+        {"$sort": {"_id": 1}},
+        {"$project": {
+            "_id": {"$dateToString": {"date": "$_id", "format": label, "timezone": tz}},
+            "period_start": "$_id",
+            **{field: 1 for field in sums}
+        }}
+    ]
+
 # Admin Billing Dashboard
 @api_router.get("/admin/billing/dashboard")
 async def admin_billing_dashboard(admin: Dict = Depends(get_admin)):
     """Get billing dashboard overview"""
-    
-    # Total revenue
-    revenue_pipeline = [
-        {"$match": {"payment_status": "paid"}},
-        {"$group": {"_id": None, "total": {"$sum": "$amount"}}}
-    ]
-    revenue_result = await db.payment_transactions.aggregate(revenue_pipeline).to_list(1)
-    total_revenue = revenue_result[0]["total"] if revenue_result else 0
-    
-    # Monthly revenue (current month)
     now = datetime.now(timezone.utc)
     month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    monthly_pipeline = [
-        {"$match": {
-            "payment_status": "paid",
-            "created_at": {"$gte": month_start.isoformat()}
-        }},
-        {"$group": {"_id": None, "total": {"$sum": "$amount"}}}
-    ]
-    monthly_result = await db.payment_transactions.aggregate(monthly_pipeline).to_list(1)
-    monthly_revenue = monthly_result[0]["total"] if monthly_result else 0
+    six_months_ago = now - timedelta(days=180)
+    
+    # Revenue and transaction counts come from the daily rollups
+    facets = await db.revenue_rollups.aggregate([
+        {"$facet": {
+            "by_status": [
+                {"$group": {"_id": "$status", "count": {"$sum": "$count"}, "total": {"$sum": "$amount"}}}
+            ],
+            "monthly": [
+                {"$match": {"status": "paid", "day": {"$gte": month_start}}},
+                {"$group": {"_id": None, "total": {"$sum": "$amount"}}}
+            ],
+            "by_plan": [
+                {"$match": {"status": "paid"}},
+                {"$group": {"_id": "$plan", "total": {"$sum": "$amount"}, "count": {"$sum": "$count"}}}
+            ],
+            "trend": [
+                {"$match": {"status": "paid", "day": {"$gte": six_months_ago}}},
+                *billing_period_stages("day", "monthly", "UTC", {"total": {"$sum": "$amount"}, "count": {"$sum": "$count"}})
+            ],
+            "refunds": [
+                {"$group": {"_id": None, "count": {"$sum": "$refunds"}, "total": {"$sum": "$refunded_amount"}}}
+            ]
+        }}
+    ]).to_list(1)
+    facets = facets[0]
+    by_status = {row["_id"]: row for row in facets["by_status"]}
+    total_revenue = by_status.get("paid", {}).get("total", 0)
+    monthly_revenue = facets["monthly"][0]["total"] if facets["monthly"] else 0
+    refunds = facets["refunds"][0] if facets["refunds"] else {"count": 0, "total": 0}
     
     # Subscription counts by status
     active_subs = await db.users.count_documents({"subscription_status": "premium"})
@@ -5278,27 +8532,16 @@ async def admin_billing_dashboard(admin: Dict = Depends(get_admin)):
     expired_subs = await db.users.count_documents({"subscription_status": "expired"})
     
     # Transaction counts
-    total_transactions = await db.payment_transactions.count_documents({})
-    successful_transactions = await db.payment_transactions.count_documents({"payment_status": "paid"})
-    pending_transactions = await db.payment_transactions.count_documents({"payment_status": "pending"})
-    failed_transactions = await db.payment_transactions.count_documents({"payment_status": {"$in": ["failed", "cancelled"]}})
+    total_transactions = sum(row["count"] for row in by_status.values())
+    successful_transactions = by_status.get("paid", {}).get("count", 0)
+    pending_transactions = by_status.get("pending", {}).get("count", 0)
+    failed_transactions = sum(by_status.get(status, {}).get("count", 0) for status in ("failed", "cancelled"))
     
     # Revenue by plan
-    plan_revenue_pipeline = [
-        {"$match": {"payment_status": "paid"}},
-        {"$group": {"_id": "$plan", "total": {"$sum": "$amount"}, "count": {"$sum": 1}}}
-    ]
-    plan_revenue = await db.payment_transactions.aggregate(plan_revenue_pipeline).to_list(100)
+    plan_revenue = facets["by_plan"]
     
     # Revenue trend (last 6 months)
-    six_months_ago = now - timedelta(days=180)
-    trend_pipeline = [
-        {"$match": {"payment_status": "paid", "created_at": {"$gte": six_months_ago.isoformat()}}},
-        {"$addFields": {"month": {"$substr": ["$created_at", 0, 7]}}},
-        {"$group": {"_id": "$month", "total": {"$sum": "$amount"}, "count": {"$sum": 1}}},
-        {"$sort": {"_id": 1}}
-    ]
-    revenue_trend = await db.payment_transactions.aggregate(trend_pipeline).to_list(12)
+    revenue_trend = [{**row, "period_start": parse_timestamp(row["period_start"]).isoformat()} for row in facets["trend"]]
     
     # Active plans count
     plans_count = await db.pricing_plans.count_documents({"is_active": True})
@@ -5317,6 +8560,10 @@ async def admin_billing_dashboard(admin: Dict = Depends(get_admin)):
             "pending": pending_transactions,
             "failed": failed_transactions
         },
+        "refunds": {
+            "count": refunds["count"],
+            "amount": refunds["total"]
+        },
         "revenue_by_plan": plan_revenue,
         "revenue_trend": revenue_trend,
         "active_plans": plans_count
@@ -5586,21 +8833,14 @@ async def admin_cancel_subscription(user_id: str, reason: str = "Administrative
     return {"message": "Subscription cancelled"}
 
 # Transactions/Invoices Management
-@api_router.get("/admin/billing/transactions")
-async def admin_get_transactions(
+def transaction_filter(
     status: Optional[str] = None,
     plan: Optional[str] = None,
     user_id: Optional[str] = None,
-    search: Optional[str] = None,
     start_date: Optional[str] = None,
-    end_date: Optional[str] = None,
-    skip: int = 0,
-    limit: int = 50,
-    admin: Dict = Depends(get_admin)
-):
-    """Get all transactions with filters"""
+    end_date: Optional[str] = None
+) -> Dict:
     query = {}
-    
     if status:
         query["payment_status"] = status
     if plan:
@@ -5614,14 +8854,30 @@ async def admin_get_transactions(
             query["created_at"]["$lte"] = end_date
         else:
             query["created_at"] = {"$lte": end_date}
+    return query
+
+@api_router.get("/admin/billing/transactions")
+async def admin_get_transactions(
+    status: Optional[str] = None,
+    plan: Optional[str] = None,
+    user_id: Optional[str] = None,
+    search: Optional[str] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    skip: int = 0,
+    limit: int = 50,
+    admin: Dict = Depends(get_admin)
+):
+    """Get all transactions with filters"""
+    query = transaction_filter(status, plan, user_id, start_date, end_date)
     
     total = await db.payment_transactions.count_documents(query)
     transactions = await db.payment_transactions.find(query, {"_id": 0}).sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
     
     # Enrich with user info
+    users = await users_by_id([txn.get("user_id") for txn in transactions], {"email": 1, "name": 1})
     for txn in transactions:
-        user = await db.users.find_one({"user_id": txn.get("user_id")}, {"_id": 0, "email": 1, "name": 1})
-        txn["user"] = user
+        txn["user"] = users.get(txn.get("user_id"))
     
     return {
         "transactions": transactions,
@@ -5659,16 +8915,21 @@ async def admin_refund_transaction(transaction_id: str, refund: RefundRequest, a
     refund_amount = refund.amount if refund.amount else txn.get("amount")
     
     # Update transaction
-    await db.payment_transactions.update_one(
-        {"transaction_id": transaction_id},
-        {"$set": {
-            "refund_status": "refunded",
-            "refund_amount": refund_amount,
-            "refund_reason": refund.reason,
-            "refunded_at": datetime.now(timezone.utc).isoformat(),
-            "refunded_by": admin["user_id"]
-        }}
+    refunded = {
+        "refund_status": "refunded",
+        "refund_amount": refund_amount,
+        "refund_reason": refund.reason,
+        "refunded_at": datetime.now(timezone.utc).isoformat(),
+        "refunded_by": admin["user_id"]
+    }
+    await wait_for_revenue_rebuild()
+    before = await db.payment_transactions.find_one_and_update(
+        {"transaction_id": transaction_id, "payment_status": "paid", "refund_status": {"$ne": "refunded"}},
+        {"$set": refunded}
     )
+    if not before:
+        raise HTTPException(status_code=409, detail="Transaction was refunded or changed concurrently")
+    await record_revenue_change(before, {**before, **refunded})
     
     # If full refund, update user subscription
     if refund_amount >= txn.get("amount", 0):
@@ -5699,58 +8960,74 @@ async def admin_billing_analytics(
     period: str = "monthly",  # daily, weekly, monthly, yearly
     start_date: Optional[str] = None,
     end_date: Optional[str] = None,
+    tz: str = "UTC",
     admin: Dict = Depends(get_admin)
 ):
-    """Get detailed billing analytics"""
+    """Get detailed billing analytics, bucketed by calendar period in the given IANA timezone"""
+    try:
+        zone = ZoneInfo(tz)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise HTTPException(status_code=400, detail=f"Unknown timezone: {tz}")
+    if period not in BILLING_PERIODS:
+        period = "monthly"
+    
+    def parse_bound(value: str) -> datetime:
+        try:
+            bound = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Invalid date: {value}")
+        return bound if bound.tzinfo else bound.replace(tzinfo=zone)
     
     now = datetime.now(timezone.utc)
     
     # Default date ranges
-    if not start_date:
-        if period == "daily":
-            start_date = (now - timedelta(days=30)).isoformat()
-        elif period == "weekly":
-            start_date = (now - timedelta(weeks=12)).isoformat()
-        elif period == "monthly":
-            start_date = (now - timedelta(days=365)).isoformat()
-        else:
-            start_date = (now - timedelta(days=365*3)).isoformat()
-    
-    if not end_date:
-        end_date = now.isoformat()
-    
-    # Date format for grouping
-    date_format = {
-        "daily": {"$substr": ["$created_at", 0, 10]},
-        "weekly": {"$substr": ["$created_at", 0, 10]},  # Will group by week later
-        "monthly": {"$substr": ["$created_at", 0, 7]},
-        "yearly": {"$substr": ["$created_at", 0, 4]}
-    }
-    
-    # Revenue over time
-    revenue_pipeline = [
-        {"$match": {"payment_status": "paid", "created_at": {"$gte": start_date, "$lte": end_date}}},
-        {"$addFields": {"period": date_format.get(period, date_format["monthly"])}},
-        {"$group": {
-            "_id": "$period",
-            "revenue": {"$sum": "$amount"},
-            "transactions": {"$sum": 1}
-        }},
-        {"$sort": {"_id": 1}}
-    ]
-    revenue_over_time = await db.payment_transactions.aggregate(revenue_pipeline).to_list(365)
-    
-    # Plan performance
-    plan_pipeline = [
-        {"$match": {"payment_status": "paid", "created_at": {"$gte": start_date, "$lte": end_date}}},
-        {"$group": {
-            "_id": "$plan",
-            "revenue": {"$sum": "$amount"},
-            "count": {"$sum": 1}
-        }},
-        {"$sort": {"revenue": -1}}
+    if start_date:
+        start = parse_bound(start_date)
+    elif period == "daily":
+        start = now - timedelta(days=30)
+    elif period == "weekly":
+        start = now - timedelta(weeks=12)
+    elif period == "monthly":
+        start = now - timedelta(days=365)
+    else:
+        start = now - timedelta(days=365*3)
+    end = parse_bound(end_date) if end_date else now
+    start, end = start.astimezone(timezone.utc), end.astimezone(timezone.utc)
+    
+    # UTC buckets come from the daily rollups; other timezones cut days at local
+    # midnight, so they read paid transactions through the (payment_status, created_on) index
+    if tz == "UTC":
+        source = db.revenue_rollups
+        in_range = {"status": "paid", "day": {"$gte": start.replace(hour=0, minute=0, second=0, microsecond=0), "$lte": end}}
+        date_field, count = "day", {"$sum": "$count"}
+    else:
+        source = db.payment_transactions
+        in_range = {"payment_status": "paid", "created_on": {"$gte": start, "$lte": end}}
+        date_field, count = "created_on", {"$sum": 1}
+    
+    facets = await source.aggregate([
+        {"$match": in_range},
+        {"$facet": {
+            "revenue_over_time": billing_period_stages(
+                date_field, period, tz, {"revenue": {"$sum": "$amount"}, "transactions": count}
+            ),
+            "plan_performance": [
+                {"$group": {
+                    "_id": "$plan",
+                    "revenue": {"$sum": "$amount"},
+                    "count": count
+                }},
+                {"$sort": {"revenue": -1}},
+                {"$limit": 20}
+            ]
+        }}
+    ]).to_list(1)
+    facets = facets[0]
+    revenue_over_time = [
+        {**row, "period_start": parse_timestamp(row["period_start"]).astimezone(zone).isoformat()}
+        for row in facets["revenue_over_time"]
     ]
-    plan_performance = await db.payment_transactions.aggregate(plan_pipeline).to_list(20)
+    plan_performance = facets["plan_performance"]
     
     # Conversion rate (free to paid)
     total_users = await db.users.count_documents({})
@@ -5760,12 +9037,12 @@ async def admin_billing_analytics(
     # Churn (expired subscriptions this period)
     churned = await db.users.count_documents({
         "subscription_status": "expired",
-        "subscription_expires_at": {"$gte": start_date, "$lte": end_date}
+        "subscription_expires_at": {"$gte": start.isoformat(), "$lte": end.isoformat()}
     })
     
     # Average revenue per user (ARPU)
-    total_revenue_result = await db.payment_transactions.aggregate([
-        {"$match": {"payment_status": "paid"}},
+    total_revenue_result = await db.revenue_rollups.aggregate([
+        {"$match": {"status": "paid"}},
         {"$group": {"_id": None, "total": {"$sum": "$amount"}}}
     ]).to_list(1)
     total_revenue = total_revenue_result[0]["total"] if total_revenue_result else 0
@@ -5773,8 +9050,9 @@ async def admin_billing_analytics(
     
     return {
         "period": period,
-        "start_date": start_date,
-        "end_date": end_date,
+        "timezone": tz,
+        "start_date": start.astimezone(zone).isoformat(),
+        "end_date": end.astimezone(zone).isoformat(),
         "revenue_over_time": revenue_over_time,
         "plan_performance": plan_performance,
         "metrics": {
@@ -5785,6 +9063,17 @@ async def admin_billing_analytics(
         }
     }
 
+@api_router.post("/admin/billing/rollups/rebuild")
+async def admin_rebuild_revenue_rollups(admin: Dict = Depends(get_super_admin)):
+    """Recompute the daily revenue rollups from payment_transactions in a background job"""
+    job = await enqueue_job(
+        "revenue_rollup_rebuild", {"type": "revenue_rollups"},
+        [{"collection": "revenue_rollups", "filter": {}}],
+        admin
+    )
+    logger.info(f"Super admin {admin['email']} queued revenue rollup rebuild (job {job['job_id']})")
+    return {"message": "Revenue rollup rebuild queued", "job_id": job["job_id"]}
+
 # Seed default pricing plans
 @api_router.post("/admin/billing/seed-plans")
 async def seed_pricing_plans(admin: Dict = Depends(get_admin)):
@@ -5893,6 +9182,426 @@ async def get_public_pricing_plans():
     return plans
 
 
+# ============== ADMIN DATA EXPORTS ==============
+
+EXPORT_CURSOR_BATCH_SIZE = 5000
+EXPORT_CHUNK_ROWS = 1000  # Rows enriched with one lookup and encoded together
+EXPORT_MEDIA_TYPES = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+TRANSACTION_EXPORT_COLUMNS = [
+    "transaction_id", "session_id", "user_id", "user_email", "user_name", "plan", "amount", "currency",
+    "payment_status", "refund_status", "refund_amount", "created_at", "paid_at", "refunded_at"
+]
+USER_EXPORT_COLUMNS = [
+    "user_id", "email", "name", "role", "subscription_status", "subscription_expires_at",
+    "is_suspended", "enrollments_count", "total_xp", "created_at", "last_login"
+]
+ATTEMPT_EXPORT_COLUMNS = [
+    "attempt_id", "exam_id", "exam_title", "user_id", "user_email", "user_name", "status",
+    "score", "passed", "time_spent_seconds", "started_at", "completed_at"
+]
+
+def export_cell(value):
+    """CSV cell for a field; nested values become JSON and formula-like text is neutralised"""
+    if value is None:
+        return ""
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=str)
+    if isinstance(value, str) and value[:1] in ("=", "+", "-", "@", "\t", "\r"):
+        return "'" + value
+    return value
+
+def encode_export_rows(rows: List[Dict], columns: List[str], format: str) -> str:
+    if format == "ndjson":
+        return "".join(json.dumps({c: row.get(c) for c in columns}, default=str) + "\n" for row in rows)
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows([export_cell(row.get(c)) for c in columns] for row in rows)
+    return buffer.getvalue()
+
+async def stream_export(cursor, columns: List[str], format: str, compress: bool, enrich=None):
+    """Encode a cursor chunk by chunk, optionally gzipped, holding at most one chunk in memory"""
+    compressor = zlib.compressobj(wbits=31) if compress else None  # wbits=31 writes a gzip container
+    
+    def encode(text: str) -> bytes:
+        data = text.encode()
+        return compressor.compress(data) if compressor else data
+    
+    async def flush(rows: List[Dict]) -> bytes:
+        if enrich:
+            await enrich(rows)
+        return encode(encode_export_rows(rows, columns, format))
+    
+    if format == "csv":
+        header = io.StringIO()
+        csv.writer(header).writerow(columns)
+        yield encode(header.getvalue())
+    rows = []
+    async for doc in cursor:
+        rows.append(doc)
+        if len(rows) >= EXPORT_CHUNK_ROWS:
+            chunk = await flush(rows)
+            rows = []
+            if chunk:
+                yield chunk
+    if rows:
+        chunk = await flush(rows)
+        if chunk:
+            yield chunk
+    if compressor:
+        yield compressor.flush()
+
+def export_response(name: str, cursor, columns: List[str], format: str, compress: bool, enrich=None) -> StreamingResponse:
+    filename = f"{name}_{datetime.now(timezone.utc).strftime('%Y%m%d_%H%M%S')}.{format}" + (".gz" if compress else "")
+    return StreamingResponse(
+        stream_export(cursor, columns, format, compress, enrich),
+        media_type="application/gzip" if compress else EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
+
+def validate_export_format(format: str):
+    if format not in EXPORT_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"format must be one of: {', '.join(EXPORT_MEDIA_TYPES)}")
+
+async def add_export_user_fields(rows: List[Dict]):
+    users = await users_by_id([row.get("user_id") for row in rows], {"email": 1, "name": 1})
+    for row in rows:
+        user = users.get(row.get("user_id"), {})
+        row["user_email"] = user.get("email")
+        row["user_name"] = user.get("name")
+
+@api_router.get("/admin/exports/transactions")
+async def export_transactions(
+    format: str = "csv",
+    gzip: bool = True,
+    status: Optional[str] = None,
+    plan: Optional[str] = None,
+    user_id: Optional[str] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    admin: Dict = Depends(get_admin)
+):
+    """Stream all matching payment transactions as CSV or NDJSON"""
+    validate_export_format(format)
+    cursor = db.payment_transactions.find(
+        transaction_filter(status, plan, user_id, start_date, end_date),
+        {"_id": 0, **{c: 1 for c in TRANSACTION_EXPORT_COLUMNS if c not in ("user_email", "user_name")}}
+    ).batch_size(EXPORT_CURSOR_BATCH_SIZE)
+    logger.info(f"Admin {admin['email']} exported transactions ({format})")
+    return export_response("transactions", cursor, TRANSACTION_EXPORT_COLUMNS, format, gzip, add_export_user_fields)
+
+@api_router.get("/admin/exports/users")
+async def export_users(
+    format: str = "csv",
+    gzip: bool = True,
+    search: Optional[str] = None,
+    role: Optional[str] = None,
+    status: Optional[str] = None,
+    admin: Dict = Depends(get_admin)
+):
+    """Stream all matching users with enrollment and XP totals as CSV or NDJSON"""
+    validate_export_format(format)
+    
+    async def add_progress_totals(rows: List[Dict]):
+        totals = await db.user_progress.aggregate([
+            {"$match": {"user_id": {"$in": [row["user_id"] for row in rows]}}},
+            {"$group": {"_id": "$user_id", "enrollments_count": {"$sum": 1}, "total_xp": {"$sum": "$total_xp"}}}
+        ]).to_list(None)
+        totals = {t["_id"]: t for t in totals}
+        for row in rows:
+            total = totals.get(row["user_id"], {})
+            row["enrollments_count"] = total.get("enrollments_count", 0)
+            row["total_xp"] = total.get("total_xp", 0)
+    
+    projection = {"_id": 0, **{c: 1 for c in USER_EXPORT_COLUMNS if c not in ("enrollments_count", "total_xp")}}
+    cursor = db.users.find(admin_user_filter(search, role, status), projection).batch_size(EXPORT_CURSOR_BATCH_SIZE)
+    logger.info(f"Admin {admin['email']} exported users ({format})")
+    return export_response("users", cursor, USER_EXPORT_COLUMNS, format, gzip, add_progress_totals)
+
+@api_router.get("/admin/exports/exam-attempts")
+async def export_exam_attempts(
+    format: str = "csv",
+    gzip: bool = True,
+    exam_id: Optional[str] = None,
+    user_id: Optional[str] = None,
+    status: Optional[str] = None,
+    admin: Dict = Depends(get_admin)
+):
+    """Stream all matching exam attempts as CSV or NDJSON"""
+    validate_export_format(format)
+    query = {}
+    if exam_id:
+        query["exam_id"] = exam_id
+    if user_id:
+        query["user_id"] = user_id
+    if status:
+        query["status"] = status
+    
+    exam_titles = {}  # Few exams, many attempts: remember titles across chunks
+    
+    async def add_attempt_fields(rows: List[Dict]):
+        missing = list({row.get("exam_id") for row in rows} - exam_titles.keys())
+        if missing:
+            exams = await db.admin_exams.find({"exam_id": {"$in": missing}}, {"_id": 0, "exam_id": 1, "title": 1}).to_list(len(missing))
+            exam_titles.update({exam_id: None for exam_id in missing})
+            exam_titles.update({exam["exam_id"]: exam.get("title") for exam in exams})
+        for row in rows:
+            row["exam_title"] = exam_titles.get(row.get("exam_id"))
+        await add_export_user_fields(rows)
+    
+    projection = {"_id": 0, **{c: 1 for c in ATTEMPT_EXPORT_COLUMNS if c not in ("exam_title", "user_email", "user_name")}}
+    cursor = db.exam_attempts.find(query, projection).batch_size(EXPORT_CURSOR_BATCH_SIZE)
+    logger.info(f"Admin {admin['email']} exported exam attempts ({format})")
+    return export_response("exam_attempts", cursor, ATTEMPT_EXPORT_COLUMNS, format, gzip, add_attempt_fields)
+
+# === Parquet Analytics Export ===
+# Writes learner activity as Hive-partitioned Parquet (<collection>/dt=YYYY-MM-DD/cert_id=X/)
+# for the data team. Runs are incremental on updated_at, read from secondaries when
+# available, and may repeat a document across part files: readers keep the row with
+# the latest updated_at per key.
+
+PARQUET_EXPORT_URI = os.environ.get('PARQUET_EXPORT_URI', str(ROOT_DIR / "exports" / "parquet"))  # Local path or s3://bucket/prefix
+PARQUET_EXPORT_INTERVAL_MINUTES = int(os.environ.get('PARQUET_EXPORT_INTERVAL_MINUTES', '0'))  # 0 disables scheduled runs
+PARQUET_EXPORT_LOCK = "parquet_export"
+PARQUET_ROW_GROUP_ROWS = 10000
+PARQUET_MAX_BUFFERED_ROWS = 50000
+PARQUET_MAX_OPEN_FILES = 64
+PARQUET_WATERMARK_LAG_SECONDS = 5  # Leaves room for writes whose updated_at precedes their commit
+
+# Column types per collection, the timestamp whose day picks the dt= partition, and
+# the timestamps that mark a document as changed since the last run (default updated_at)
+PARQUET_EXPORTS = {
+    "user_progress": {
+        "key": "progress_id",
+        "partition_field": "updated_at",
+        "columns": {
+            "progress_id": "string", "user_id": "string", "cert_id": "string",
+            "labs_completed": "list", "projects_completed": "list",
+            "assessments_completed": "json", "domain_scores": "json",
+            "readiness_percentage": "float", "total_xp": "int", "updated_at": "timestamp"
+        }
+    },
+    "exam_attempts": {
+        "key": "attempt_id",
+        "partition_field": "started_at",
+        # Attempts are written outside this service and do not reliably carry updated_at
+        "watermark_fields": ["started_at", "completed_at", "updated_at"],
+        "columns": {
+            "attempt_id": "string", "exam_id": "string", "user_id": "string", "cert_id": "string",
+            "status": "string", "score": "float", "passed": "bool", "time_spent_seconds": "int",
+            "started_at": "timestamp", "completed_at": "timestamp", "updated_at": "timestamp"
+        }
+    },
+    "lab_instances": {
+        "key": "instance_id",
+        "partition_field": "started_at",
+        "columns": {
+            "instance_id": "string", "user_id": "string", "lab_id": "string", "cert_id": "string",
+            "provider": "string", "region": "string", "instance_type": "string", "status": "string",
+            "resources": "json", "cost_estimate": "float", "provision_attempts": "int",
+            "error_message": "string", "termination_reason": "string",
+            "started_at": "timestamp", "provisioned_at": "timestamp", "expires_at": "timestamp",
+            "terminated_at": "timestamp", "updated_at": "timestamp"
+        }
+    }
+}
+
+def parquet_schema(columns: Dict[str, str]):
+    types = {
+        "string": pa.string(), "json": pa.string(), "int": pa.int64(), "float": pa.float64(),
+        "bool": pa.bool_(), "timestamp": pa.timestamp("us", tz="UTC"), "list": pa.list_(pa.string())
+    }
+    return pa.schema([(name, types[kind]) for name, kind in columns.items()])
+
+def parquet_value(kind: str, value):
+    """Coerce a stored value to its column type; values that do not fit become null"""
+    if value is None:
+        return None
+    try:
+        if kind == "timestamp":
+            return parse_timestamp(value)
+        if kind == "json":
+            return json.dumps(value, default=str)
+        if kind == "list":
+            return [str(v) for v in value] if isinstance(value, list) else None
+        return {"string": str, "int": int, "float": float, "bool": bool}[kind](value)
+    except (TypeError, ValueError):
+        return None
+
+def parquet_partition_dir(value: str) -> str:
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", value) or "unknown"
+
+class PartitionedParquetWriter:
+    """Buffers rows per (dt, cert_id) partition and writes them as row groups.
+
+    Each partition gets part files named after the run, so a retried run overwrites
+    its own output. At most PARQUET_MAX_OPEN_FILES files stay open; closing the least
+    recently used one means a later row for that partition starts a new part.
+    """
+    
+    def __init__(self, filesystem, base_path: str, collection: str, spec: Dict, run_id: str):
+        self.filesystem = filesystem
+        self.base_path = f"{base_path.rstrip('/')}/{collection}"
+        self.spec = spec
+        self.schema = parquet_schema(spec["columns"])
+        self.run_id = run_id
+        self.writers = OrderedDict()  # partition -> open ParquetWriter
+        self.buffers = {}  # partition -> rows not yet written
+        self.part_numbers = {}
+        self.buffered = 0
+        self.rows = 0
+        self.files = 0
+    
+    def add(self, docs: List[Dict]):
+        for doc in docs:
+            row = {name: parquet_value(kind, doc.get(name)) for name, kind in self.spec["columns"].items()}
+            day = parquet_value("timestamp", doc.get(self.spec["partition_field"]))
+            partition = (day.strftime("%Y-%m-%d") if day else "unknown", parquet_partition_dir(str(doc.get("cert_id") or "")))
+            buffer = self.buffers.setdefault(partition, [])
+            buffer.append(row)
+            self.buffered += 1
+            if len(buffer) >= PARQUET_ROW_GROUP_ROWS:
+                self.flush(partition)
+        if self.buffered >= PARQUET_MAX_BUFFERED_ROWS:
+            for partition in list(self.buffers):
+                self.flush(partition)
+    
+    def flush(self, partition: tuple):
+        rows = self.buffers.pop(partition, None)
+        if not rows:
+            return
+        writer = self.writers.get(partition)
+        if writer is None:
+            if len(self.writers) >= PARQUET_MAX_OPEN_FILES:
+                self.writers.popitem(last=False)[1].close()
+            directory = f"{self.base_path}/dt={partition[0]}/cert_id={partition[1]}"
+            self.filesystem.create_dir(directory, recursive=True)
+            part = self.part_numbers.get(partition, 0)
+            self.part_numbers[partition] = part + 1
+            writer = pq.ParquetWriter(
+                f"{directory}/part-{self.run_id}-{part:04d}.parquet", self.schema,
+                filesystem=self.filesystem, compression="zstd"
+            )
+            self.writers[partition] = writer
+            self.files += 1
+        else:
+            self.writers.move_to_end(partition)
+        writer.write_table(pa.Table.from_pylist(rows, schema=self.schema), row_group_size=PARQUET_ROW_GROUP_ROWS)
+        self.buffered -= len(rows)
+        self.rows += len(rows)
+    
+    def close(self):
+        for partition in list(self.buffers):
+            self.flush(partition)
+        while self.writers:
+            self.writers.popitem()[1].close()
+
+async def export_collection_to_parquet(collection: str, run_id: str, full: bool, lease_lost: asyncio.Event) -> Dict:
+    """Export documents changed since the collection's watermark, then advance it"""
+    spec = PARQUET_EXPORTS[collection]
+    fields = spec.get("watermark_fields", ["updated_at"])
+    state = await db.parquet_export_state.find_one({"_id": collection})
+    upper = (datetime.now(timezone.utc) - timedelta(seconds=PARQUET_WATERMARK_LAG_SECONDS)).isoformat()
+    if state and not full:
+        query = {"$or": [{field: {"$gt": state["watermark"], "$lte": upper}} for field in fields]}
+    else:
+        # Full export; documents without any watermark timestamp are only picked up here
+        query = {"$or": [{field: {"$lte": upper}} for field in fields] + [{field: {"$exists": False} for field in fields}]}
+    
+    filesystem, base_path = pafs.FileSystem.from_uri(PARQUET_EXPORT_URI)
+    writer = PartitionedParquetWriter(filesystem, base_path, collection, spec, run_id)
+    source = db.get_collection(collection, read_preference=ReadPreference.SECONDARY_PREFERRED)
+    cursor = source.find(query, {"_id": 0, **{name: 1 for name in spec["columns"]}}).batch_size(EXPORT_CURSOR_BATCH_SIZE)
+    try:
+        docs = []
+        async for doc in cursor:
+            docs.append(doc)
+            if len(docs) >= EXPORT_CHUNK_ROWS:
+                if lease_lost.is_set():
+                    raise JobLeaseLost(run_id)
+                await asyncio.to_thread(writer.add, docs)
+                docs = []
+        if docs:
+            await asyncio.to_thread(writer.add, docs)
+    finally:
+        await asyncio.to_thread(writer.close)
+    
+    await db.parquet_export_state.update_one(
+        {"_id": collection},
+        {"$set": {
+            "watermark": upper,
+            "last_run_id": run_id,
+            "last_run_full": full or not state,
+            "rows": writer.rows,
+            "files": writer.files,
+            "exported_at": datetime.now(timezone.utc).isoformat()
+        }},
+        upsert=True
+    )
+    logger.info(f"Parquet export {run_id}: {writer.rows} {collection} rows in {writer.files} files")
+    return {"rows": writer.rows, "files": writer.files}
+
+async def run_parquet_export(job: Dict, lease_lost: asyncio.Event):
+    for index, step in enumerate(job["steps"]):
+        if step.get("done"):
+            continue
+        result = await export_collection_to_parquet(step["collection"], job["job_id"], job["target"].get("full", False), lease_lost)
+        await db.background_jobs.update_one(
+            {"job_id": job["job_id"]},
+            {"$set": {f"steps.{index}.total": result["rows"], f"steps.{index}.files": result["files"], f"steps.{index}.done": True}}
+        )
+
+JOB_HANDLERS["parquet_export"] = run_parquet_export
+
+async def enqueue_parquet_export(collections: List[str], full: bool, admin: Dict) -> Optional[Dict]:
+    """Queue an export unless one is already queued or running"""
+    if await db.background_jobs.find_one({"job_type": "parquet_export", "status": {"$in": ["queued", "running"]}}, {"_id": 1}):
+        return None
+    return await enqueue_job(
+        "parquet_export", {"type": "parquet_export", "full": full},
+        [{"collection": collection, "filter": {}} for collection in collections],
+        admin
+    )
+
+async def parquet_export_scheduler():
+    """Leader-elected loop queueing an incremental export every PARQUET_EXPORT_INTERVAL_MINUTES"""
+    interval = PARQUET_EXPORT_INTERVAL_MINUTES * 60
+    while True:
+        try:
+            if await acquire_lock(PARQUET_EXPORT_LOCK, interval * 2):
+                await enqueue_parquet_export(list(PARQUET_EXPORTS), False, {"user_id": "system"})
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Parquet export scheduler error: {e}")
+        await asyncio.sleep(interval)
+
+@api_router.post("/admin/exports/parquet")
+async def start_parquet_export(
+    full: bool = False,
+    collections: Optional[str] = None,  # Comma-separated; defaults to all
+    admin: Dict = Depends(get_super_admin)
+):
+    """Queue a Parquet export of learner analytics collections (incremental unless full)"""
+    selected = [c.strip() for c in collections.split(",")] if collections else list(PARQUET_EXPORTS)
+    unknown = [c for c in selected if c not in PARQUET_EXPORTS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Cannot export: {', '.join(unknown)}")
+    
+    job = await enqueue_parquet_export(selected, full, admin)
+    if not job:
+        raise HTTPException(status_code=409, detail="A Parquet export is already queued or running")
+    logger.info(f"Super admin {admin['email']} queued Parquet export {job['job_id']} ({'full' if full else 'incremental'})")
+    return {"message": "Parquet export queued", "job_id": job["job_id"]}
+
+@api_router.get("/admin/exports/parquet")
+async def get_parquet_export_state(admin: Dict = Depends(get_admin)):
+    """Watermark and last run per exported collection"""
+    state = await db.parquet_export_state.find({}).to_list(len(PARQUET_EXPORTS))
+    return {
+        "destination": PARQUET_EXPORT_URI,
+        "collections": [{"collection": s.pop("_id"), **s} for s in state]
+    }
+
 @api_router.get("/")
 async def root():
     return {"message": "SkillTrack365 API", "version": "1.0.0"}
@@ -5908,6 +9617,97 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# (collection, keys, options) for indexes that bulk and background operations rely on
+INDEX_SPECS = [
+    ("question_bank", [("question_id", 1)], {"unique": True}),
+    ("question_imports", [("import_id", 1)], {"unique": True}),
+    ("question_signatures", [("question_id", 1)], {"unique": True}),
+    ("question_signatures", [("bands", 1)], {}),
+    ("background_jobs", [("job_id", 1)], {"unique": True}),
+    ("certificate_templates", [("cert_id", 1), ("is_default", 1)], {}),
+    ("background_jobs", [("status", 1), ("created_at", 1)], {}),
+    ("lab_instances", [("status", 1), ("expires_at", 1)], {}),
+    ("lab_instances", [("status", 1), ("terminated_at", 1)], {}),
+    ("lab_instances", [("status", 1), ("provision_lease_expires_at", 1)], {}),
+    ("lab_instances", [("deprovision_status", 1), ("deprovision_retry_at", 1)], {}),
+    ("lab_instances", [("expiry_batch_id", 1)], {"sparse": True}),
+    ("lab_instances", [("user_id", 1), ("status", 1)], {}),
+    ("lab_instances", [("lab_id", 1), ("started_at", 1)], {}),
+    ("lab_usage_ledger", [("entry_id", 1)], {"unique": True}),
+    ("stripe_events", [("event_id", 1)], {"unique": True}),
+    ("stripe_events", [("status", 1), ("received_at", 1)], {}),
+    ("payment_transactions", [("session_id", 1)], {"unique": True}),
+    ("revenue_rollups", [("status", 1), ("day", 1)], {}),
+    ("payment_transactions", [("payment_status", 1), ("created_on", 1)], {}),
+    ("lab_warm_pool_targets", [("lab_id", 1), ("provider", 1), ("instance_type", 1)], {"unique": True}),
+    ("lab_warm_pool", [("lab_id", 1), ("provider", 1), ("instance_type", 1), ("status", 1), ("ready_at", 1)], {}),
+    ("lab_usage_ledger", [("user_id", 1), ("at", 1)], {}),
+    ("users", [("subscription_status", 1), ("subscription_expires_at", 1)], {}),
+    ("user_progress", [("updated_at", 1)], {}),
+    ("exam_attempts", [("updated_at", 1)], {}),
+    ("exam_attempts", [("started_at", 1)], {}),
+    ("exam_attempts", [("completed_at", 1)], {}),
+    ("lab_instances", [("updated_at", 1)], {}),
+    ("subscription_events", [("event_id", 1)], {"unique": True}),
+    ("subscription_events", [("type", 1), ("created_at", 1)], {}),
+    ("users", [("user_id", 1)], {}),
+    ("user_progress", [("cert_id", 1), ("user_id", 1)], {}),
+    ("user_certificates", [("user_id", 1), ("cert_id", 1)], {}),
+]
+
+@app.on_event("startup")
+async def ensure_indexes():
+    for collection, keys, options in INDEX_SPECS:
+        try:
+            await db[collection].create_index(keys, **options)
+        except Exception as e:
+            logger.warning(f"Could not create index {keys} on {collection}: {e}")
+
+@app.on_event("startup")
+async def migrate_billing_dates():
+    """Queue a rollup rebuild while transactions lack created_on or rollup rows predate BSON days"""
+    try:
+        legacy = await db.payment_transactions.find_one({"created_on": {"$exists": False}}, {"_id": 1}) \
+            or await db.revenue_rollups.find_one({"day": {"$type": "string"}}, {"_id": 1})
+        pending = await db.background_jobs.find_one(
+            {"job_type": "revenue_rollup_rebuild", "status": {"$in": ["queued", "running"]}}, {"_id": 1}
+        )
+        if legacy and not pending:
+            job = await enqueue_job(
+                "revenue_rollup_rebuild", {"type": "revenue_rollups"},
+                [{"collection": "revenue_rollups", "filter": {}}],
+                {"user_id": "system"}
+            )
+            logger.info(f"Queued revenue rollup rebuild {job['job_id']} to migrate billing dates")
+    except Exception as e:
+        logger.warning(f"Could not check billing date migration: {e}")
+
+@app.on_event("startup")
+async def start_background_workers():
+    for _ in range(JOB_WORKER_COUNT):
+        background_tasks.append(asyncio.create_task(job_worker()))
+    background_tasks.append(asyncio.create_task(lab_scheduler.run()))
+    background_tasks.extend(provisioning_pipeline.start())
+    background_tasks.append(asyncio.create_task(warm_pool.run()))
+    background_tasks.append(asyncio.create_task(stripe_event_worker()))
+    background_tasks.append(asyncio.create_task(subscription_sweeper()))
+    if PARQUET_EXPORT_INTERVAL_MINUTES > 0:
+        background_tasks.append(asyncio.create_task(parquet_export_scheduler()))
+    background_tasks.append(asyncio.create_task(certificate_render_pool.start()))
+
+@app.on_event("shutdown")
+async def stop_background_workers():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    await release_lock(LAB_REAPER_LOCK)
+    await release_lock(LAB_WARM_POOL_LOCK)
+    await release_lock(SUBSCRIPTION_SWEEP_LOCK)
+    await release_lock(PARQUET_EXPORT_LOCK)
+    certificate_render_pool.shutdown()
+    await payment_client.close()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
     client.close()
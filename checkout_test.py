@@ -50,15 +50,12 @@ class CheckoutAPITester:
             return False
 
     def test_stripe_webhook_endpoint(self):
-        """Test Stripe webhook endpoint"""
+        """Test Stripe webhook endpoint rejects unsigned events"""
         try:
-            webhook_data = {"type": "test_event", "data": {}}
+            webhook_data = {"id": "evt_test", "type": "test_event", "data": {}}
             response = requests.post(f"{self.api_url}/webhook/stripe", json=webhook_data, timeout=10)
-            success = response.status_code == 200
-            details = f"Status: {response.status_code}"
-            if success:
-                data = response.json()
-                details += f", Response: {data.get('received', False)}"
+            success = response.status_code in [400, 503]  # Invalid signature / secret not configured
+            details = f"Status: {response.status_code} (Expected: 400 without a valid Stripe-Signature)"
             self.log_test("Stripe Webhook Endpoint", success, details)
             return success
         except Exception as e:
@@ -0,0 +1,38 @@
+"""
+Shared fixtures for in-process backend tests.
+
+Most suites drive the deployed API over HTTP (REACT_APP_BACKEND_URL). Suites
+that exercise backend internals (provider adapters, the provisioning pipeline,
+streamed certificate issuance) import backend/server.py directly and run its
+coroutines against the MongoDB in MONGO_URL, using a throwaway database.
+"""
+
+import asyncio
+import os
+import sys
+import uuid
+
+import pytest
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend")
+
+
+@pytest.fixture(scope="session")
+def backend():
+    """The server module bound to a temporary database, and a runner for its coroutines"""
+    if not os.environ.get("MONGO_URL") or not os.environ.get("DB_NAME"):
+        pytest.skip("MONGO_URL and DB_NAME are required for in-process backend tests")
+    if BACKEND_DIR not in sys.path:
+        sys.path.insert(0, BACKEND_DIR)
+    import server
+
+    loop = asyncio.new_event_loop()
+    original_db = server.db
+    server.db = server.client[f"{os.environ['DB_NAME']}_test_{uuid.uuid4().hex[:8]}"]
+    loop.run_until_complete(server.ensure_indexes())
+    try:
+        yield server, loop.run_until_complete
+    finally:
+        loop.run_until_complete(server.client.drop_database(server.db.name))
+        server.db = original_db
+        loop.close()
@@ -0,0 +1,100 @@
+"""
+Test Suite: Admin data exports
+Runs in-process against MongoDB (see conftest.backend)
+
+Covered:
+- Gzipped CSV and NDJSON exports round-trip across enrichment chunk boundaries
+- Formula-like CSV cells (= + - @ tab CR) are neutralised; NDJSON keeps values as-is
+"""
+
+import csv
+import gzip
+import io
+import json
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+ADMIN = {"user_id": "user_admin", "email": "admin@example.com", "role": "admin"}
+RISKY_NAMES = ["=HYPERLINK(\"http://x\")", "+1", "-2", "@SUM(A1)", "\tcmd", "\r=cmd", "Plain Learner"]
+
+
+@pytest.fixture
+def exports(backend, monkeypatch):
+    server, run = backend
+    monkeypatch.setattr(server, "EXPORT_CHUNK_ROWS", 3)
+    chunk_sizes = []
+    add_user_fields = server.add_export_user_fields
+
+    async def counting_user_fields(rows):
+        chunk_sizes.append(len(rows))
+        await add_user_fields(rows)
+
+    monkeypatch.setattr(server, "add_export_user_fields", counting_user_fields)
+    exam_id = f"exam_{uuid.uuid4().hex[:8]}"
+    run(server.db.admin_exams.insert_one({"exam_id": exam_id, "title": "Cloud Practitioner Mock"}))
+    started = datetime(2026, 6, 1, 9, tzinfo=timezone.utc)
+    attempts = []
+    for index, name in enumerate(RISKY_NAMES):
+        user_id = f"user_{uuid.uuid4().hex[:8]}"
+        run(server.db.users.insert_one({"user_id": user_id, "email": f"{user_id}@example.com", "name": name}))
+        attempt = {
+            "attempt_id": f"att_{uuid.uuid4().hex[:12]}", "exam_id": exam_id, "user_id": user_id,
+            "status": "completed", "score": 60 + index, "passed": index % 2 == 0, "time_spent_seconds": 1800,
+            "started_at": (started + timedelta(minutes=index)).isoformat(),
+            "completed_at": (started + timedelta(minutes=index + 30)).isoformat()
+        }
+        run(server.db.exam_attempts.insert_one(dict(attempt)))
+        attempts.append({**attempt, "user_name": name, "user_email": f"{user_id}@example.com"})
+
+    def export(format):
+        chunk_sizes.clear()
+
+        async def collect():
+            response = await server.export_exam_attempts(
+                format=format, gzip=True, exam_id=exam_id, user_id=None, status=None, admin=ADMIN
+            )
+            assert response.media_type == "application/gzip"
+            return [chunk async for chunk in response.body_iterator]
+
+        text = gzip.decompress(b"".join(run(collect()))).decode()
+        # Seven attempts are enriched and encoded in chunks of 3, 3 and 1
+        assert chunk_sizes == [3, 3, 1]
+        return text
+
+    return server, attempts, export
+
+
+class TestExamAttemptExport:
+    """GET /api/admin/exports/exam-attempts"""
+
+    def test_gzipped_csv_round_trip(self, exports):
+        server, attempts, export = exports
+        text = export("csv")
+        rows = list(csv.DictReader(io.StringIO(text, newline="")))
+        assert list(rows[0]) == server.ATTEMPT_EXPORT_COLUMNS
+        assert len(rows) == len(attempts)
+        by_id = {row["attempt_id"]: row for row in rows}
+        for attempt in attempts:
+            row = by_id[attempt["attempt_id"]]
+            assert row["exam_title"] == "Cloud Practitioner Mock"
+            assert row["user_email"] == attempt["user_email"]
+            assert row["score"] == str(attempt["score"])
+            expected = attempt["user_name"]
+            assert row["user_name"] == (expected if expected == "Plain Learner" else "'" + expected)
+        print("✓ Gzipped CSV export round-trips with neutralised formula cells")
+
+    def test_gzipped_ndjson_round_trip(self, exports):
+        server, attempts, export = exports
+        text = export("ndjson")
+        rows = [json.loads(line) for line in text.splitlines()]
+        assert len(rows) == len(attempts)
+        by_id = {row["attempt_id"]: row for row in rows}
+        for attempt in attempts:
+            row = by_id[attempt["attempt_id"]]
+            assert list(row) == server.ATTEMPT_EXPORT_COLUMNS
+            assert row["user_name"] == attempt["user_name"]
+            assert row["passed"] is attempt["passed"]
+            assert row["exam_title"] == "Cloud Practitioner Mock"
+        print("✓ Gzipped NDJSON export round-trips across chunks")
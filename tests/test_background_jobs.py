@@ -0,0 +1,271 @@
+"""
+Test Suite: Background jobs
+Runs in-process against MongoDB (see conftest.backend)
+
+Covered:
+- Failed attempts are requeued with backoff (not_before) and not claimed early
+- Cascade deletes terminate lab instances through the lifecycle before deleting them
+- Cascade deletes of payment transactions keep revenue rollups in step
+- Revenue rollup rebuilds hold off transaction writes that land mid-rebuild
+"""
+
+import asyncio
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+
+class RecordingAdapter:
+    def __init__(self, provider_id):
+        self.provider_id = provider_id
+        self.deprovisioned = []
+
+    async def provision(self, instance):
+        return {}
+
+    async def deprovision(self, instance):
+        self.deprovisioned.append(instance["instance_id"])
+
+
+@pytest.fixture
+def jobs(backend):
+    server, run = backend
+    run(server.db.background_jobs.delete_many({}))
+    admin = {"user_id": "user_admin", "email": "admin@example.com"}
+    return server, run, admin
+
+
+class TestJobRetryBackoff:
+    """run_job requeues failures with an attempt-based delay"""
+
+    def test_failed_attempt_waits_before_retry(self, jobs, monkeypatch):
+        server, run, admin = jobs
+
+        async def failing(job, lease_lost):
+            raise RuntimeError("downstream unavailable")
+
+        monkeypatch.setitem(server.JOB_HANDLERS, "always_fails", failing)
+        job = run(server.enqueue_job("always_fails", {"type": "test", "id": "x"}, [], admin))
+
+        claimed = run(server.claim_job())
+        assert claimed["job_id"] == job["job_id"]
+        run(server.run_job(claimed))
+
+        stored = run(server.db.background_jobs.find_one({"job_id": job["job_id"]}, {"_id": 0}))
+        assert stored["status"] == "queued"
+        assert stored["error"] == "downstream unavailable"
+        delay = datetime.fromisoformat(stored["not_before"]) - datetime.now(timezone.utc)
+        assert timedelta(seconds=server.JOB_RETRY_BASE_SECONDS - 5) < delay <= timedelta(seconds=server.JOB_RETRY_BASE_SECONDS)
+        assert run(server.claim_job()) is None
+
+        # Due again once not_before has passed; the next delay doubles
+        run(server.db.background_jobs.update_one(
+            {"job_id": job["job_id"]},
+            {"$set": {"not_before": (datetime.now(timezone.utc) - timedelta(seconds=1)).isoformat()}}
+        ))
+        claimed = run(server.claim_job())
+        assert claimed["attempts"] == 2
+        run(server.run_job(claimed))
+        stored = run(server.db.background_jobs.find_one({"job_id": job["job_id"]}, {"_id": 0}))
+        delay = datetime.fromisoformat(stored["not_before"]) - datetime.now(timezone.utc)
+        assert delay > timedelta(seconds=2 * server.JOB_RETRY_BASE_SECONDS - 5)
+
+    def test_last_attempt_fails_the_job(self, jobs, monkeypatch):
+        server, run, admin = jobs
+
+        async def failing(job, lease_lost):
+            raise RuntimeError("still broken")
+
+        monkeypatch.setitem(server.JOB_HANDLERS, "always_fails", failing)
+        job = run(server.enqueue_job("always_fails", {"type": "test", "id": "y"}, [], admin))
+        run(server.db.background_jobs.update_one(
+            {"job_id": job["job_id"]}, {"$set": {"attempts": server.JOB_MAX_ATTEMPTS - 1}}
+        ))
+        run(server.run_job(run(server.claim_job())))
+
+        stored = run(server.db.background_jobs.find_one({"job_id": job["job_id"]}, {"_id": 0}))
+        assert stored["status"] == "failed"
+        assert stored["finished_at"]
+
+
+class TestCascadeLabInstances:
+    """Cascade deletes close usage and release cloud resources for lab instances"""
+
+    def test_certification_cascade_terminates_running_instances(self, jobs, monkeypatch):
+        server, run, admin = jobs
+        adapter = RecordingAdapter("aws")
+        monkeypatch.setitem(server.PROVIDER_ADAPTERS, "aws", adapter)
+        monkeypatch.setattr(server, "provisioning_pipeline", server.LabProvisioningPipeline())
+        cert_id = f"cert_{uuid.uuid4().hex[:8]}"
+        user_id = f"user_{uuid.uuid4().hex[:8]}"
+        now = datetime.now(timezone.utc)
+        instance_id = f"inst_{uuid.uuid4().hex[:12]}"
+        run(server.db.lab_instances.insert_one({
+            "instance_id": instance_id, "user_id": user_id, "lab_id": "lab_x", "cert_id": cert_id,
+            "provider": "aws", "region": "us-east-1", "instance_type": "small", "status": "running",
+            "resources": {"vcpu": 2, "memory_gb": 4, "storage_gb": 20},
+            "provisioned_at": now.isoformat(), "running_since": (now - timedelta(hours=2)).isoformat(),
+            "expires_at": (now + timedelta(hours=2)).isoformat()
+        }))
+
+        job = run(server.enqueue_cascade_delete(
+            "certification", cert_id,
+            [{"collection": "lab_instances", "filter": {"cert_id": cert_id}}], admin
+        ))
+        run(server.run_job(run(server.claim_job())))
+
+        stored = run(server.db.background_jobs.find_one({"job_id": job["job_id"]}, {"_id": 0}))
+        assert stored["status"] == "completed", stored["error"]
+        assert adapter.deprovisioned == [instance_id]
+        assert run(server.db.lab_instances.count_documents({"instance_id": instance_id})) == 0
+        closing = run(server.db.lab_usage_ledger.find_one({"instance_id": instance_id, "event": "terminate"}))
+        assert closing["hours"] == pytest.approx(2.0, abs=0.01)
+
+    def test_cascade_waits_for_deprovisioning(self, jobs, monkeypatch, caplog):
+        server, run, admin = jobs
+
+        class Failing(RecordingAdapter):
+            async def deprovision(self, instance):
+                raise server.ProvisioningError("api timeout")
+
+        monkeypatch.setitem(server.PROVIDER_ADAPTERS, "aws", Failing("aws"))
+        monkeypatch.setattr(server, "provisioning_pipeline", server.LabProvisioningPipeline())
+        cert_id = f"cert_{uuid.uuid4().hex[:8]}"
+        now = datetime.now(timezone.utc)
+        instance_id = f"inst_{uuid.uuid4().hex[:12]}"
+        run(server.db.lab_instances.insert_one({
+            "instance_id": instance_id, "user_id": "user_x", "lab_id": "lab_x", "cert_id": cert_id,
+            "provider": "aws", "region": "us-east-1", "instance_type": "small", "status": "suspended",
+            "resources": {"vcpu": 2}, "provisioned_at": now.isoformat(),
+            "expires_at": (now + timedelta(hours=2)).isoformat()
+        }))
+
+        job = run(server.enqueue_cascade_delete(
+            "certification", cert_id,
+            [{"collection": "lab_instances", "filter": {"cert_id": cert_id}}], admin
+        ))
+        run(server.run_job(run(server.claim_job())))
+
+        stored = run(server.db.background_jobs.find_one({"job_id": job["job_id"]}, {"_id": 0}))
+        assert stored["status"] == "queued"
+        assert "not yet deprovisioned" in stored["error"]
+        # An expected retry is logged as a warning, not a job failure
+        assert [r.levelname for r in caplog.records if "not yet deprovisioned" in r.getMessage()] == ["WARNING"]
+        instance = run(server.db.lab_instances.find_one({"instance_id": instance_id}, {"_id": 0}))
+        assert instance["status"] == "terminated"
+        assert instance["deprovision_status"] == "pending"
+
+
+class TestCascadeRevenueRollups:
+    """Deleting a user's transactions takes them out of the revenue rollups"""
+
+    def test_user_cascade_decrements_rollups(self, jobs):
+        server, run, admin = jobs
+        user_id = f"user_{uuid.uuid4().hex[:8]}"
+        other_id = f"user_{uuid.uuid4().hex[:8]}"
+        day = datetime(2026, 3, 14, 12, tzinfo=timezone.utc)
+        transactions = [
+            {"user_id": user_id, "plan": "monthly", "payment_status": "paid", "amount": 29.99},
+            {"user_id": user_id, "plan": "monthly", "payment_status": "paid", "amount": 29.99,
+             "refund_status": "refunded", "refund_amount": 29.99},
+            {"user_id": other_id, "plan": "monthly", "payment_status": "paid", "amount": 29.99},
+        ]
+        for transaction in transactions:
+            transaction.update(
+                transaction_id=f"txn_{uuid.uuid4().hex[:12]}", session_id=f"cs_test_{uuid.uuid4().hex}",
+                currency="eur", created_at=day.isoformat(), created_on=day
+            )
+            run(server.db.payment_transactions.insert_one(dict(transaction)))
+            run(server.record_revenue_change(None, transaction))
+        row_id = "2026-03-14|monthly|paid|eur"
+        row = run(server.db.revenue_rollups.find_one({"_id": row_id}))
+        assert (row["count"], row["refunds"]) == (3, 1)
+
+        job = run(server.enqueue_cascade_delete(
+            "user", user_id, [{"collection": "payment_transactions", "filter": {"user_id": user_id}}], admin
+        ))
+        run(server.run_job(run(server.claim_job())))
+
+        stored = run(server.db.background_jobs.find_one({"job_id": job["job_id"]}, {"_id": 0}))
+        assert stored["status"] == "completed", stored["error"]
+        row = run(server.db.revenue_rollups.find_one({"_id": row_id}))
+        assert row["count"] == 1
+        assert row["amount"] == pytest.approx(29.99)
+        assert row["refunds"] == 0
+        assert row["refunded_amount"] == pytest.approx(0)
+
+
+class TestRevenueRollupRebuild:
+    """A rebuild running alongside payment traffic leaves correct totals"""
+
+    class WriteDuringAggregate:
+        """Database proxy that starts transaction writes between the rebuild's aggregate and its row writes"""
+
+        def __init__(self, db, writes):
+            self.db = db
+            self.writes = writes
+            self.tasks = []
+
+        def __getattr__(self, name):
+            collection = getattr(self.db, name)
+            if name != "payment_transactions":
+                return collection
+            proxy = self
+
+            class Cursor:
+                def __init__(self, cursor):
+                    self.cursor = cursor
+
+                async def to_list(self, length):
+                    groups = await self.cursor.to_list(length)
+                    proxy.tasks = [asyncio.ensure_future(write()) for write in proxy.writes]
+                    await asyncio.sleep(0.3)
+                    return groups
+
+            class Collection:
+                def __getattr__(self, attr):
+                    return getattr(collection, attr)
+
+                def aggregate(self, *args, **kwargs):
+                    return Cursor(collection.aggregate(*args, **kwargs))
+
+            return Collection()
+
+    def test_payments_during_rebuild_are_counted(self, jobs, monkeypatch):
+        server, run, admin = jobs
+        monkeypatch.setattr(server, "REVENUE_ROLLUP_SETTLE_SECONDS", 0)
+        monkeypatch.setattr(server, "REVENUE_ROLLUP_WAIT_POLL_SECONDS", 0.05)
+        run(server.db.revenue_rollups.delete_many({}))
+        run(server.db.payment_transactions.delete_many({}))
+        day = datetime(2026, 5, 2, 9, tzinfo=timezone.utc)
+        sessions = [f"cs_test_{uuid.uuid4().hex}" for _ in range(3)]
+        for session_id in sessions:
+            transaction = {
+                "transaction_id": f"txn_{uuid.uuid4().hex[:12]}", "user_id": f"user_{uuid.uuid4().hex[:8]}",
+                "session_id": session_id, "amount": 29.99, "currency": "usd", "plan": "monthly",
+                "payment_status": "pending", "created_at": day.isoformat(), "created_on": day
+            }
+            run(server.db.payment_transactions.insert_one(dict(transaction)))
+            run(server.record_revenue_change(None, transaction))
+
+        # One session is paid (creating the paid row) and one expires while the rebuild runs
+        proxy = self.WriteDuringAggregate(server.db, [
+            lambda: server.fulfill_checkout_session(sessions[0], "webhook"),
+            lambda: server.close_checkout_session(sessions[1], "expired"),
+        ])
+        monkeypatch.setattr(server, "db", proxy)
+        job = run(server.enqueue_job(
+            "revenue_rollup_rebuild", {"type": "revenue_rollups"}, [{"collection": "revenue_rollups", "filter": {}}], admin
+        ))
+        run(server.run_job(run(server.claim_job())))
+        run(asyncio.wait(proxy.tasks))
+        assert all(task.exception() is None for task in proxy.tasks)
+
+        stored = run(server.db.background_jobs.find_one({"job_id": job["job_id"]}, {"_id": 0}))
+        assert stored["status"] == "completed", stored["error"]
+        rows = {row["status"]: row for row in run(server.db.revenue_rollups.find({}, {"_id": 0}).to_list(None))}
+        assert {status: row["count"] for status, row in rows.items()} == {"pending": 1, "paid": 1, "expired": 1}
+        assert rows["paid"]["amount"] == pytest.approx(29.99)
+        assert not run(server.db.scheduler_locks.find_one({"_id": server.REVENUE_ROLLUP_LOCK}))
+        print("✓ Payments landing mid-rebuild are counted once")
@@ -0,0 +1,218 @@
+"""
+Test Suite: Certificate rendering and downloads
+Runs in-process against MongoDB (see conftest.backend); renders go through the real worker pool
+
+Covered:
+- Template image URLs: unsupported schemes and failed fetches
+- Downloads answer 503 (and cache nothing) while template images are unavailable
+- QR verification links require an absolute CERTIFICATE_VERIFY_BASE_URL
+- Bulk issuance: manifest statuses, ZIP contents, groups that fail to render
+"""
+
+import csv
+import io
+import uuid
+import zipfile
+from datetime import datetime, timezone
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+
+@pytest.fixture
+def certs(backend, monkeypatch, tmp_path):
+    server, run = backend
+    monkeypatch.setattr(server, "CERTIFICATE_CACHE_DIR", tmp_path)
+    monkeypatch.setattr(server, "CERTIFICATE_VERIFY_BASE_URL", "https://skilltrack365.test")
+
+    def insert_certificate(user, **fields):
+        certificate = {
+            "certificate_id": f"ST365-{uuid.uuid4().hex[:8].upper()}",
+            "user_id": user["user_id"],
+            "user_name": user["name"],
+            "user_email": user["email"],
+            "cert_id": f"cert_{uuid.uuid4().hex[:8]}",
+            "cert_code": "SAA-C03",
+            "cert_name": "Solutions Architect Associate",
+            "vendor": "AWS",
+            "readiness_percentage": 92,
+            "labs_completed": 4,
+            "assessments_passed": 3,
+            "projects_completed": 1,
+            "issued_at": datetime.now(timezone.utc).isoformat(),
+            **fields
+        }
+        run(server.db.user_certificates.insert_one(certificate))
+        certificate.pop("_id", None)
+        return certificate
+
+    def insert_template(cert_id, **fields):
+        template = {
+            "template_id": f"tmpl_{uuid.uuid4().hex[:8]}",
+            "cert_id": cert_id,
+            "name": "Test template",
+            "version": 1,
+            "is_default": True,
+            **fields
+        }
+        run(server.db.certificate_templates.insert_one(template))
+        return template
+
+    yield server, run, insert_certificate, insert_template, tmp_path
+    server.certificate_render_pool.shutdown()
+
+
+def make_user():
+    user_id = f"user_{uuid.uuid4().hex[:8]}"
+    return {"user_id": user_id, "name": "Test Learner", "email": f"{user_id}@example.com", "role": "learner"}
+
+
+def download_request():
+    return Request({"type": "http", "method": "GET", "path": "/", "headers": []})
+
+
+class TestTemplateImages:
+    """Logo and signature URLs are fetched by the renderer"""
+
+    def test_unsupported_scheme_is_rejected(self, backend):
+        from certificate_render import TemplateAssetError, fetch_image
+
+        for url in ("file:///etc/passwd", "ftp://example.com/logo.png"):
+            with pytest.raises(TemplateAssetError):
+                fetch_image(url)
+        assert fetch_image("") is None
+        print("✓ Only http(s) and data: template images are fetched")
+
+    def test_failed_fetch_is_not_cached(self, backend):
+        import certificate_render
+
+        template = {"template_id": f"tmpl_{uuid.uuid4().hex[:8]}", "version": 1, "logo_url": "http://127.0.0.1:9/logo.png"}
+        with pytest.raises(certificate_render.TemplateAssetError):
+            certificate_render.certificate_plan(template)
+        assert (template["template_id"], 1) not in certificate_render._plans
+        print("✓ Template plan with an unreachable logo is not cached")
+
+
+class TestCertificateDownload:
+    """GET /api/certificates/{id}/download"""
+
+    def test_unavailable_template_image_returns_503(self, certs):
+        server, run, insert_certificate, insert_template, cache_dir = certs
+        user = make_user()
+        certificate = insert_certificate(user)
+        insert_template(certificate["cert_id"], logo_url="http://127.0.0.1:9/logo.png")
+
+        with pytest.raises(HTTPException) as error:
+            run(server.download_certificate(certificate["certificate_id"], download_request(), user))
+        assert error.value.status_code == 503
+        assert error.value.headers["Retry-After"] == str(server.CERTIFICATE_RENDER_RETRY_AFTER_SECONDS)
+        assert list(cache_dir.iterdir()) == []
+        print("✓ Unavailable template image returns 503 without caching a PDF")
+
+    def test_download_renders_and_caches(self, certs):
+        server, run, insert_certificate, insert_template, cache_dir = certs
+        user = make_user()
+        certificate = insert_certificate(user)
+
+        response = run(server.download_certificate(certificate["certificate_id"], download_request(), user))
+        assert response.status_code == 200
+        assert len(list(cache_dir.iterdir())) == 1
+        assert open(response.path, "rb").read().startswith(b"%PDF")
+        print("✓ Certificate rendered and cached")
+
+
+class TestVerifyUrl:
+    """QR verification links"""
+
+    def test_verify_url_uses_base_url(self, certs):
+        server, run, insert_certificate, insert_template, cache_dir = certs
+        certificate = insert_certificate(make_user())
+        payload = server.certificate_render_payload(certificate)
+        assert payload["verify_url"] == f"https://skilltrack365.test/certificate/{certificate['certificate_id']}"
+        print("✓ Verify URL is absolute")
+
+    def test_no_qr_without_base_url(self, certs, monkeypatch):
+        server, run, insert_certificate, insert_template, cache_dir = certs
+        certificate = insert_certificate(make_user())
+        with_qr = server.certificate_render_key(certificate, None)
+        monkeypatch.setattr(server, "CERTIFICATE_VERIFY_BASE_URL", "")
+        assert server.certificate_render_payload(certificate)["verify_url"] is None
+        assert server.certificate_render_key(certificate, None) != with_qr
+        print("✓ No verify URL (and no QR) without CERTIFICATE_VERIFY_BASE_URL")
+
+
+class TestBulkCertificateIssue:
+    """POST /api/admin/certificates/bulk"""
+
+    ADMIN = {"user_id": "admin_test", "email": "admin@example.com", "role": "admin"}
+
+    def setup_cohort(self, certs):
+        server, run, insert_certificate, insert_template, cache_dir = certs
+        cert = {
+            "cert_id": f"cert_{uuid.uuid4().hex[:8]}", "code": "SAA-C03",
+            "name": "Solutions Architect Associate", "vendor": "AWS"
+        }
+        run(server.db.certifications.insert_one(dict(cert)))
+        users = {name: make_user() for name in ("ready", "holder", "behind", "no_progress")}
+        run(server.db.users.insert_many([dict(user) for user in users.values()]))
+        for name, readiness in (("ready", 92), ("holder", 85), ("behind", 40)):
+            run(server.db.user_progress.insert_one({
+                "user_id": users[name]["user_id"],
+                "cert_id": cert["cert_id"],
+                "readiness_percentage": readiness,
+                "labs_completed": ["lab_1", "lab_2"],
+                "assessments_completed": [{"assessment_id": "a1", "passed": True}, {"assessment_id": "a2", "passed": False}],
+                "projects_completed": []
+            }))
+        existing = insert_certificate(users["holder"], cert_id=cert["cert_id"])
+        return cert, users, existing
+
+    def issue(self, server, run, cert_id, user_ids):
+        async def collect():
+            response = await server.admin_bulk_issue_certificates(
+                server.BulkCertificateRequest(cert_id=cert_id, user_ids=user_ids), self.ADMIN
+            )
+            return b"".join([chunk async for chunk in response.body_iterator])
+
+        archive = zipfile.ZipFile(io.BytesIO(run(collect())))
+        manifest = {row["user_id"]: row for row in csv.DictReader(io.StringIO(archive.read("manifest.csv").decode()))}
+        return archive, manifest
+
+    def test_manifest_and_archive(self, certs):
+        server, run, insert_certificate, insert_template, cache_dir = certs
+        cert, users, existing = self.setup_cohort(certs)
+        unknown = f"user_{uuid.uuid4().hex[:8]}"
+
+        archive, manifest = self.issue(server, run, cert["cert_id"], [u["user_id"] for u in users.values()] + [unknown])
+        assert manifest[users["ready"]["user_id"]]["status"] == "issued"
+        assert manifest[users["holder"]["user_id"]]["status"] == "existing"
+        assert manifest[users["holder"]["user_id"]]["certificate_id"] == existing["certificate_id"]
+        assert manifest[users["behind"]["user_id"]]["status"] == "ineligible"
+        assert manifest[users["no_progress"]["user_id"]]["status"] == "ineligible"
+        assert manifest[unknown]["status"] == "not_found"
+
+        issued = run(server.db.user_certificates.find_one({"user_id": users["ready"]["user_id"]}, {"_id": 0}))
+        assert issued["certificate_id"] == manifest[users["ready"]["user_id"]]["certificate_id"]
+        assert issued["labs_completed"] == 2 and issued["assessments_passed"] == 1
+        pdfs = sorted(name for name in archive.namelist() if name.endswith(".pdf"))
+        assert len(pdfs) == 2
+        assert all(archive.read(name).startswith(b"%PDF") for name in pdfs)
+        print("✓ Bulk issue manifest lists issued, existing, ineligible and not_found learners")
+
+    def test_render_failure_is_reported_in_manifest(self, certs, monkeypatch):
+        server, run, insert_certificate, insert_template, cache_dir = certs
+        cert, users, existing = self.setup_cohort(certs)
+
+        async def busy(*args):
+            raise server.RenderPoolBusy("Render pool is full")
+
+        monkeypatch.setattr(server.certificate_render_pool, "run", busy)
+        monkeypatch.setattr(server, "BULK_CERTIFICATE_RENDER_RETRIES", 1)
+        archive, manifest = self.issue(server, run, cert["cert_id"], [users["ready"]["user_id"], users["holder"]["user_id"]])
+        assert archive.namelist() == ["manifest.csv"]
+        assert manifest[users["ready"]["user_id"]]["status"] == "render_failed"
+        assert manifest[users["holder"]["user_id"]]["status"] == "render_failed"
+        # The certificate stays issued and is included as existing on the next run
+        assert run(server.db.user_certificates.count_documents({"user_id": users["ready"]["user_id"]})) == 1
+        print("✓ Groups that cannot be rendered are marked render_failed and the archive is complete")
@@ -0,0 +1,540 @@
+"""
+Test Suite: Lab provisioning internals
+Runs in-process against MongoDB (see conftest.backend)
+
+Covered:
+- SimulatedProviderAdapter provision/deprovision
+- LabProvisioningPipeline retries, non-retryable errors, leases, mid-flight termination
+- Releasing cloud resources when instances are terminated or expire
+- Capacity forecasts for cohorts starting at a non-UTC time
+- Warm pool claims, capacity accounting, stale environment cleanup and leader lease renewal
+"""
+
+import asyncio
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+
+class ScriptedAdapter:
+    """Provider adapter that replays a list of outcomes and records its calls"""
+
+    def __init__(self, provider_id, outcomes=(), deprovision_error=None, on_provision=None):
+        self.provider_id = provider_id
+        self.outcomes = list(outcomes)
+        self.deprovision_error = deprovision_error
+        self.on_provision = on_provision
+        self.provisioned = []
+        self.deprovisioned = []
+
+    async def provision(self, instance):
+        self.provisioned.append(instance.get("instance_id") or instance["warm_id"])
+        if self.on_provision:
+            await self.on_provision(instance)
+        outcome = self.outcomes.pop(0) if self.outcomes else {"ip_address": "10.0.0.1"}
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    async def deprovision(self, instance):
+        self.deprovisioned.append(instance)
+        if self.deprovision_error:
+            raise self.deprovision_error
+
+
+@pytest.fixture
+def lab(backend, monkeypatch):
+    server, run = backend
+    monkeypatch.setattr(server, "LAB_PROVISION_RETRY_BASE_SECONDS", 0)
+    pipeline = server.LabProvisioningPipeline()
+
+    def use_adapter(**kwargs):
+        scripted = ScriptedAdapter("aws", **kwargs)
+        monkeypatch.setitem(server.PROVIDER_ADAPTERS, "aws", scripted)
+        return scripted
+
+    def insert_instance(**fields):
+        now = datetime.now(timezone.utc)
+        instance = {
+            "instance_id": f"inst_{uuid.uuid4().hex[:12]}",
+            "user_id": f"user_{uuid.uuid4().hex[:8]}",
+            "lab_id": "lab_test",
+            "cert_id": "cert_test",
+            "provider": "aws",
+            "region": "us-east-1",
+            "instance_type": "small",
+            "status": "provisioning",
+            "resources": {"vcpu": 2, "memory_gb": 4, "storage_gb": 20},
+            "started_at": now.isoformat(),
+            "updated_at": now.isoformat(),
+            "expires_at": (now + timedelta(hours=4)).isoformat(),
+            "provision_attempts": 0,
+            "provision_worker_id": server.WORKER_ID,
+            "provision_lease_expires_at": (now + timedelta(seconds=120)).isoformat(),
+            **fields
+        }
+        run(server.db.lab_instances.insert_one(instance))
+        instance.pop("_id", None)
+        return instance
+
+    def get_instance(instance_id):
+        return run(server.db.lab_instances.find_one({"instance_id": instance_id}, {"_id": 0}))
+
+    return server, run, pipeline, use_adapter, insert_instance, get_instance
+
+
+class TestSimulatedProviderAdapter:
+    """SimulatedProviderAdapter stands in for a cloud API"""
+
+    def test_provision_returns_resources(self, backend):
+        server, run = backend
+        adapter = server.SimulatedProviderAdapter("aws", min_latency=0, max_latency=0, failure_rate=0)
+        resources = run(adapter.provision({"instance_id": "inst_x", "lab_id": "lab_x", "region": "us-east-1"}))
+        assert resources["ip_address"].startswith("10.0.")
+        assert resources["console_url"].endswith("/lab/lab_x")
+
+    def test_provision_failure_is_retryable(self, backend):
+        server, run = backend
+        adapter = server.SimulatedProviderAdapter("gcp", min_latency=0, max_latency=0, failure_rate=1.0)
+        with pytest.raises(server.ProvisioningError) as exc:
+            run(adapter.provision({"instance_id": "inst_x", "lab_id": "lab_x", "region": "us-central1"}))
+        assert exc.value.retryable
+        assert "us-central1" in str(exc.value)
+
+    def test_deprovision_completes(self, backend):
+        server, run = backend
+        adapter = server.SimulatedProviderAdapter("azure", min_latency=0, max_latency=0)
+        assert run(adapter.deprovision({"instance_id": "inst_x"})) is None
+
+    def test_incomplete_adapter_cannot_be_created(self, backend):
+        server, run = backend
+
+        class ProvisionOnly(server.ProviderAdapter):
+            async def provision(self, instance):
+                return {}
+
+        with pytest.raises(TypeError):
+            ProvisionOnly("aws")
+
+
+class TestProvisioningPipeline:
+    """Retries, leases and mid-flight termination in LabProvisioningPipeline.provision"""
+
+    def test_transient_failure_is_retried(self, lab):
+        server, run, pipeline, use_adapter, insert_instance, get_instance = lab
+        scripted = use_adapter(outcomes=[server.ProvisioningError("capacity"), {"ip_address": "10.0.0.9"}])
+        instance = insert_instance()
+        run(pipeline.provision(instance["instance_id"]))
+
+        stored = get_instance(instance["instance_id"])
+        assert stored["status"] == "running"
+        assert stored["provision_attempts"] == 2
+        assert stored["resources"]["ip_address"] == "10.0.0.9"
+        assert stored["running_since"] and stored["provisioned_at"]
+        assert "provision_worker_id" not in stored
+        assert scripted.provisioned == [instance["instance_id"]] * 2
+
+    def test_non_retryable_failure_is_not_retried(self, lab):
+        server, run, pipeline, use_adapter, insert_instance, get_instance = lab
+        scripted = use_adapter(outcomes=[server.ProvisioningError("bad image", retryable=False)])
+        instance = insert_instance()
+        run(pipeline.provision(instance["instance_id"]))
+
+        stored = get_instance(instance["instance_id"])
+        assert stored["status"] == "error"
+        assert stored["provision_attempts"] == 1
+        assert stored["error_message"] == "bad image"
+        assert len(scripted.provisioned) == 1
+
+    def test_gives_up_after_max_attempts(self, lab):
+        server, run, pipeline, use_adapter, insert_instance, get_instance = lab
+        use_adapter(outcomes=[server.ProvisioningError("capacity")] * server.LAB_PROVISION_MAX_ATTEMPTS)
+        instance = insert_instance()
+        run(pipeline.provision(instance["instance_id"]))
+
+        stored = get_instance(instance["instance_id"])
+        assert stored["status"] == "error"
+        assert stored["provision_attempts"] == server.LAB_PROVISION_MAX_ATTEMPTS
+
+    def test_lease_held_by_another_worker_is_respected(self, lab):
+        server, run, pipeline, use_adapter, insert_instance, get_instance = lab
+        scripted = use_adapter()
+        instance = insert_instance(provision_worker_id="other-worker")
+        run(pipeline.provision(instance["instance_id"]))
+
+        assert scripted.provisioned == []
+        stored = get_instance(instance["instance_id"])
+        assert stored["status"] == "provisioning"
+        assert stored["provision_worker_id"] == "other-worker"
+
+    def test_lapsed_lease_is_taken_over(self, lab):
+        server, run, pipeline, use_adapter, insert_instance, get_instance = lab
+        scripted = use_adapter()
+        lapsed = (datetime.now(timezone.utc) - timedelta(seconds=1)).isoformat()
+        instance = insert_instance(provision_worker_id="other-worker", provision_lease_expires_at=lapsed)
+        run(pipeline.provision(instance["instance_id"]))
+
+        assert scripted.provisioned == [instance["instance_id"]]
+        assert get_instance(instance["instance_id"])["status"] == "running"
+
+    def test_terminated_mid_flight_releases_resources(self, lab):
+        server, run, pipeline, use_adapter, insert_instance, get_instance = lab
+
+        async def terminate(instance):
+            await server.transition_lab_instance(instance["instance_id"], "terminated", "terminate")
+
+        scripted = use_adapter(outcomes=[{"ip_address": "10.0.0.7"}], on_provision=terminate)
+        instance = insert_instance()
+        run(pipeline.provision(instance["instance_id"]))
+
+        assert get_instance(instance["instance_id"])["status"] == "terminated"
+        assert len(scripted.deprovisioned) == 1
+        assert scripted.deprovisioned[0]["resources"]["ip_address"] == "10.0.0.7"
+
+        # The terminate-side release has nothing left to do for an instance that never ran
+        assert run(pipeline.release(instance["instance_id"]))
+        assert len(scripted.deprovisioned) == 1
+        assert get_instance(instance["instance_id"])["deprovision_status"] == "released"
+
+
+class TestLabRelease:
+    """Terminal transitions release the instance's cloud resources"""
+
+    def running_instance(self, insert_instance):
+        now = datetime.now(timezone.utc)
+        return insert_instance(
+            status="running",
+            provisioned_at=now.isoformat(),
+            running_since=(now - timedelta(hours=1)).isoformat(),
+            provision_worker_id=None,
+            provision_lease_expires_at=None
+        )
+
+    def test_user_terminate_deprovisions(self, lab, monkeypatch):
+        server, run, pipeline, use_adapter, insert_instance, get_instance = lab
+        monkeypatch.setattr(server, "provisioning_pipeline", pipeline)
+        scripted = use_adapter()
+        instance = self.running_instance(insert_instance)
+        user = {"user_id": instance["user_id"], "email": "learner@example.com"}
+
+        run(server.lab_instance_action(instance["instance_id"], server.LabInstanceAction(action="terminate"), user))
+        run(asyncio.gather(*pipeline.releasing.values()))
+
+        stored = get_instance(instance["instance_id"])
+        assert stored["status"] == "terminated"
+        assert stored["deprovision_status"] == "released"
+        assert stored["deprovisioned_at"]
+        assert [i["instance_id"] for i in scripted.deprovisioned] == [instance["instance_id"]]
+
+    def test_admin_terminate_deprovisions(self, lab, monkeypatch):
+        server, run, pipeline, use_adapter, insert_instance, get_instance = lab
+        monkeypatch.setattr(server, "provisioning_pipeline", pipeline)
+        scripted = use_adapter()
+        instance = self.running_instance(insert_instance)
+        admin = {"user_id": "user_admin", "email": "admin@example.com"}
+
+        run(server.admin_instance_action(instance["instance_id"], server.LabInstanceAction(action="terminate"), admin))
+        run(asyncio.gather(*pipeline.releasing.values()))
+
+        assert get_instance(instance["instance_id"])["deprovision_status"] == "released"
+        assert len(scripted.deprovisioned) == 1
+
+    def test_expired_instances_are_deprovisioned(self, lab, monkeypatch):
+        server, run, pipeline, use_adapter, insert_instance, get_instance = lab
+        monkeypatch.setattr(server, "provisioning_pipeline", pipeline)
+        scripted = use_adapter()
+        instance = self.running_instance(insert_instance)
+        now = datetime.now(timezone.utc)
+        run(server.db.lab_instances.update_one(
+            {"instance_id": instance["instance_id"]}, {"$set": {"expires_at": (now - timedelta(minutes=1)).isoformat()}}
+        ))
+
+        assert run(server.terminate_expired_lab_instances([instance["instance_id"]], now)) == 1
+        run(asyncio.gather(*pipeline.releasing.values()))
+
+        stored = get_instance(instance["instance_id"])
+        assert stored["termination_reason"] == "expired"
+        assert stored["deprovision_status"] == "released"
+        assert len(scripted.deprovisioned) == 1
+
+    def test_failed_deprovision_backs_off_then_gives_up(self, lab, monkeypatch):
+        server, run, pipeline, use_adapter, insert_instance, get_instance = lab
+        use_adapter(deprovision_error=server.ProvisioningError("api timeout"))
+        instance = self.running_instance(insert_instance)
+        run(server.transition_lab_instance(instance["instance_id"], "terminated", "terminate"))
+
+        assert not run(pipeline.release(instance["instance_id"]))
+        stored = get_instance(instance["instance_id"])
+        assert stored["deprovision_status"] == "pending"
+        assert stored["deprovision_error"] == "api timeout"
+        assert stored["deprovision_retry_at"] > datetime.now(timezone.utc).isoformat()
+        # Still backing off: a second release is a no-op
+        assert not run(pipeline.release(instance["instance_id"]))
+        assert get_instance(instance["instance_id"])["deprovision_attempts"] == 1
+
+        monkeypatch.setattr(server, "LAB_DEPROVISION_RETRY_BASE_SECONDS", 0)
+        for _ in range(server.LAB_DEPROVISION_MAX_ATTEMPTS - 1):
+            run(server.db.lab_instances.update_one(
+                {"instance_id": instance["instance_id"]}, {"$unset": {"deprovision_retry_at": ""}}
+            ))
+            run(pipeline.release(instance["instance_id"]))
+        stored = get_instance(instance["instance_id"])
+        assert stored["deprovision_status"] == "failed"
+        assert stored["deprovision_attempts"] == server.LAB_DEPROVISION_MAX_ATTEMPTS
+
+
+class TestExpiryRace:
+    """terminate_expired_lab_instances only closes what its update actually terminated"""
+
+    class ExtendBeforeUpdate:
+        """Database proxy that extends one instance between the reaper's find and update_many"""
+
+        def __init__(self, db, instance_id, expires_at):
+            self.db = db
+            self.instance_id = instance_id
+            self.expires_at = expires_at
+
+        def __getattr__(self, name):
+            collection = getattr(self.db, name)
+            if name != "lab_instances":
+                return collection
+            proxy = self
+
+            class Collection:
+                def __getattr__(self, attr):
+                    return getattr(collection, attr)
+
+                async def update_many(self, *args, **kwargs):
+                    await collection.update_one(
+                        {"instance_id": proxy.instance_id}, {"$set": {"expires_at": proxy.expires_at}}
+                    )
+                    return await collection.update_many(*args, **kwargs)
+
+            return Collection()
+
+    def test_extend_between_find_and_update_is_left_running(self, lab, monkeypatch):
+        server, run, pipeline, use_adapter, insert_instance, get_instance = lab
+        monkeypatch.setattr(server, "provisioning_pipeline", pipeline)
+        scripted = use_adapter()
+        now = datetime.now(timezone.utc)
+        running = dict(
+            status="running",
+            provisioned_at=now.isoformat(),
+            running_since=(now - timedelta(hours=2)).isoformat(),
+            expires_at=(now - timedelta(minutes=1)).isoformat(),
+            provision_worker_id=None,
+            provision_lease_expires_at=None
+        )
+        extended = insert_instance(**running)
+        expired = insert_instance(**running)
+
+        real_db = server.db
+        monkeypatch.setattr(server, "db", self.ExtendBeforeUpdate(
+            real_db, extended["instance_id"], (now + timedelta(hours=1)).isoformat()
+        ))
+        terminated = run(server.terminate_expired_lab_instances(
+            [extended["instance_id"], expired["instance_id"]], now
+        ))
+        monkeypatch.setattr(server, "db", real_db)
+        run(asyncio.gather(*pipeline.releasing.values()))
+
+        assert terminated == 1
+        assert get_instance(extended["instance_id"])["status"] == "running"
+        assert get_instance(expired["instance_id"])["status"] == "terminated"
+        ledger = run(server.db.lab_usage_ledger.find(
+            {"instance_id": {"$in": [extended["instance_id"], expired["instance_id"]]}}, {"_id": 0}
+        ).to_list(10))
+        assert [(e["instance_id"], e["event"]) for e in ledger] == [(expired["instance_id"], "expire")]
+        assert [i["instance_id"] for i in scripted.deprovisioned] == [expired["instance_id"]]
+
+
+class TestAdminInstanceActions:
+    """Admin suspend/resume only apply to running/suspended instances"""
+
+    def test_resume_terminated_instance_is_rejected(self, lab):
+        server, run, pipeline, use_adapter, insert_instance, get_instance = lab
+        instance = insert_instance(status="terminated", provision_worker_id=None, provision_lease_expires_at=None)
+        admin = {"user_id": "user_admin", "email": "admin@example.com"}
+
+        with pytest.raises(server.HTTPException) as exc:
+            run(server.admin_instance_action(instance["instance_id"], server.LabInstanceAction(action="resume"), admin))
+        assert exc.value.status_code == 400
+        stored = get_instance(instance["instance_id"])
+        assert stored["status"] == "terminated"
+        assert "running_since" not in stored
+
+    def test_suspend_errored_instance_is_rejected(self, lab):
+        server, run, pipeline, use_adapter, insert_instance, get_instance = lab
+        instance = insert_instance(status="error", provision_worker_id=None, provision_lease_expires_at=None)
+        admin = {"user_id": "user_admin", "email": "admin@example.com"}
+
+        with pytest.raises(server.HTTPException) as exc:
+            run(server.admin_instance_action(instance["instance_id"], server.LabInstanceAction(action="suspend"), admin))
+        assert exc.value.status_code == 400
+        assert get_instance(instance["instance_id"])["status"] == "error"
+
+    def test_suspend_then_resume(self, lab):
+        server, run, pipeline, use_adapter, insert_instance, get_instance = lab
+        instance = insert_instance(
+            status="running", running_since=datetime.now(timezone.utc).isoformat(),
+            provision_worker_id=None, provision_lease_expires_at=None
+        )
+        admin = {"user_id": "user_admin", "email": "admin@example.com"}
+
+        run(server.admin_instance_action(instance["instance_id"], server.LabInstanceAction(action="suspend"), admin))
+        assert get_instance(instance["instance_id"])["status"] == "suspended"
+        run(server.admin_instance_action(instance["instance_id"], server.LabInstanceAction(action="resume"), admin))
+        stored = get_instance(instance["instance_id"])
+        assert stored["status"] == "running"
+        assert stored["running_since"]
+
+
+class TestCapacityForecast:
+    """Capacity forecasts count instances still active at the cohort start"""
+
+    def test_start_at_with_utc_offset(self, lab):
+        server, run, pipeline, use_adapter, insert_instance, get_instance = lab
+        admin = {"user_id": "user_admin", "email": "admin@example.com"}
+        ist = timezone(timedelta(hours=5, minutes=30))
+        start_at = (datetime.now(timezone.utc) + timedelta(days=2)).replace(microsecond=0).astimezone(ist)
+
+        def baseline():
+            forecast = run(server.admin_forecast_capacity(
+                server.CapacityForecastRequest(start_at=start_at, instance_count=1), admin
+            ))
+            assert forecast["start_at"] == start_at.astimezone(timezone.utc).isoformat()
+            return next((r["baseline_vcpu"] for r in forecast["regions"]
+                         if (r["provider"], r["region"]) == ("azure", "eastus")), 0)
+
+        before = baseline()
+        # Still running 90 minutes after the cohort starts
+        insert_instance(
+            status="running", provider="azure", region="eastus",
+            expires_at=(start_at + timedelta(minutes=90)).astimezone(timezone.utc).isoformat(),
+            provision_worker_id=None, provision_lease_expires_at=None
+        )
+        assert baseline() - before == 2
+
+
+class TestWarmPool:
+    """Launches served from warm pools"""
+
+    @pytest.fixture
+    def warm(self, lab, monkeypatch):
+        server, run, pipeline, use_adapter, insert_instance, get_instance = lab
+        manager = server.WarmPoolManager()
+        monkeypatch.setattr(server, "warm_pool", manager)
+        monkeypatch.setattr(server, "provisioning_pipeline", pipeline)
+        lab_id = f"lab_{uuid.uuid4().hex[:8]}"
+        run(server.db.labs.insert_one({"lab_id": lab_id, "cert_id": "cert_test", "title": "Warm lab"}))
+        # AWS is not the cheapest small instance, so placement ranks GCP first
+        run(server.db.lab_warm_pool_targets.insert_one({
+            "pool_id": f"pool_{uuid.uuid4().hex[:8]}", "lab_id": lab_id, "provider": "aws",
+            "instance_type": "small", "min_size": 1, "max_size": 2
+        }))
+
+        def insert_warm(**fields):
+            now = datetime.now(timezone.utc)
+            doc = {
+                "warm_id": f"warm_{uuid.uuid4().hex[:12]}", "pool_id": "pool_test", "lab_id": lab_id,
+                "provider": "aws", "region": "us-west-2", "instance_type": "small", "status": "ready",
+                "resources": {"vcpu": 2, "memory_gb": 4, "storage_gb": 20, "ip_address": "10.0.5.5"},
+                "created_at": now.isoformat(), "ready_at": now.isoformat(), **fields
+            }
+            run(server.db.lab_warm_pool.insert_one(doc))
+            doc.pop("_id", None)
+            return doc
+
+        return lab_id, manager, insert_warm
+
+    def test_claim_follows_ranked_placements_and_meters_hours(self, lab, warm):
+        server, run, pipeline, use_adapter, insert_instance, get_instance = lab
+        lab_id, manager, insert_warm = warm
+        use_adapter()
+        environment = insert_warm()
+        user = {"user_id": f"user_{uuid.uuid4().hex[:8]}", "email": "learner@example.com"}
+
+        instance = run(server.create_lab_instance(server.LabInstanceCreate(lab_id=lab_id), user))
+        assert instance["status"] == "running"
+        assert instance["warm_id"] == environment["warm_id"]
+        assert (instance["provider"], instance["region"]) == ("aws", "us-west-2")
+        assert run(server.db.lab_warm_pool.find_one({"warm_id": environment["warm_id"]})) is None
+
+        # Run for an hour, then terminate: the whole hour must reach the counters
+        started = datetime.now(timezone.utc) - timedelta(hours=1)
+        run(server.db.lab_instances.update_one(
+            {"instance_id": instance["instance_id"]}, {"$set": {"running_since": started.isoformat()}}
+        ))
+        run(server.lab_instance_action(instance["instance_id"], server.LabInstanceAction(action="terminate"), user))
+        run(asyncio.gather(*pipeline.releasing.values()))
+
+        ledger = run(server.db.lab_usage_ledger.find({"instance_id": instance["instance_id"]}, {"_id": 0}).to_list(10))
+        assert sorted(e["event"] for e in ledger) == ["start", "terminate"]
+        closing = next(e for e in ledger if e["event"] == "terminate")
+        assert closing["hours"] == pytest.approx(1.0, abs=0.01)
+        counters = run(server.db.lab_usage_counters.find({"user_id": user["user_id"], "period": "day"}).to_list(10))
+        assert sum(c["lab_hours"] for c in counters) == pytest.approx(1.0, abs=0.01)
+
+    def test_capacity_counts_unclaimed_warm_environments(self, lab, warm):
+        server, run, pipeline, use_adapter, insert_instance, get_instance = lab
+        lab_id, manager, insert_warm = warm
+        tracker = server.CapacityTracker()
+        run(tracker.refresh())
+        before = tracker.usage.get(("aws", "ap-southeast-1"), {"vcpu": 0, "warm": 0})
+        insert_warm(region="ap-southeast-1")
+        insert_warm(region="ap-southeast-1", status="provisioning")
+        run(tracker.refresh())
+        after = tracker.usage[("aws", "ap-southeast-1")]
+        assert after["vcpu"] - before["vcpu"] == 4
+        assert after["warm"] - before["warm"] == 2
+
+    def test_leader_lease_is_renewed_until_taken_over(self, lab, warm, monkeypatch):
+        server, run, pipeline, use_adapter, insert_instance, get_instance = lab
+        lab_id, manager, insert_warm = warm
+        monkeypatch.setattr(server, "LAB_WARM_POOL_INTERVAL_SECONDS", 0.05)
+        locks = server.db.scheduler_locks
+        run(locks.delete_many({"_id": server.LAB_WARM_POOL_LOCK}))
+        assert run(server.acquire_lock(server.LAB_WARM_POOL_LOCK, 1))
+        first_expiry = run(locks.find_one({"_id": server.LAB_WARM_POOL_LOCK}))["expires_at"]
+
+        async def renew_then_lose():
+            renewer = asyncio.create_task(manager.hold_lease())
+            await asyncio.sleep(0.2)
+            assert not manager.lease_lost.is_set()
+            renewed = await locks.find_one({"_id": server.LAB_WARM_POOL_LOCK})
+            assert renewed["owner"] == server.WORKER_ID and renewed["expires_at"] > first_expiry
+            # Another worker takes the lock over (e.g. after a stalled renewal)
+            await locks.update_one({"_id": server.LAB_WARM_POOL_LOCK}, {"$set": {
+                "owner": "worker_other",
+                "expires_at": (datetime.now(timezone.utc) + timedelta(minutes=5)).isoformat()
+            }})
+            await asyncio.wait_for(renewer, timeout=2)
+
+        run(renew_then_lose())
+        assert manager.lease_lost.is_set()
+        scripted = use_adapter()
+        run(manager.reconcile())
+        assert scripted.provisioned == []
+        manager.lease_lost.clear()
+        run(manager.reconcile())
+        ready = run(server.db.lab_warm_pool.find({"lab_id": lab_id, "status": "ready"}, {"_id": 0}).to_list(10))
+        assert ready and all(w["warm_id"] in scripted.provisioned for w in ready)
+        run(locks.delete_many({"_id": server.LAB_WARM_POOL_LOCK}))
+
+    def test_stale_provisioning_environments_are_deprovisioned(self, lab, warm):
+        server, run, pipeline, use_adapter, insert_instance, get_instance = lab
+        lab_id, manager, insert_warm = warm
+        stale_at = (datetime.now(timezone.utc) - timedelta(seconds=server.LAB_PROVISION_LEASE_SECONDS + 60)).isoformat()
+        failing = use_adapter(deprovision_error=server.ProvisioningError("api timeout"))
+        environment = insert_warm(status="provisioning", created_at=stale_at, ready_at=None)
+
+        run(manager.reconcile())
+        assert environment["warm_id"] in [w["warm_id"] for w in failing.deprovisioned]
+        # Kept until the provider confirms the release
+        assert run(server.db.lab_warm_pool.find_one({"warm_id": environment["warm_id"]}))
+
+        scripted = use_adapter()
+        run(manager.reconcile())
+        assert environment["warm_id"] in [w["warm_id"] for w in scripted.deprovisioned]
+        assert run(server.db.lab_warm_pool.find_one({"warm_id": environment["warm_id"]})) is None
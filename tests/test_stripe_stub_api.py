@@ -0,0 +1,214 @@
+"""
+Test suite for Stripe webhooks and checkout fulfilment, driven by the local Stripe stub
+Requires the backend to run with STRIPE_STUB=true; the fulfilment tests also need
+MONGO_URL/DB_NAME (the backend's database) to create a signed-in learner.
+
+Endpoints tested:
+- POST /api/webhook/stripe
+- POST /api/stripe-stub/sessions/{session_id}/complete
+- POST /api/checkout/create, GET /api/checkout/status/{session_id}
+"""
+import hashlib
+import hmac
+import json
+import os
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pytest
+import requests
+
+BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', '').rstrip('/')
+WEBHOOK_SECRET = os.environ.get('STRIPE_WEBHOOK_SECRET', 'whsec_local_stub')
+
+
+def stub_enabled() -> bool:
+    try:
+        response = requests.post(f"{BASE_URL}/api/stripe-stub/sessions/cs_test_probe/complete", timeout=10)
+    except requests.RequestException:
+        return False
+    return response.status_code == 404 and response.json().get("detail") == "Checkout session not found"
+
+
+pytestmark = pytest.mark.skipif(not BASE_URL or not stub_enabled(), reason="backend is not running with STRIPE_STUB")
+
+
+def signed(payload: bytes, secret: str = WEBHOOK_SECRET) -> dict:
+    timestamp = int(time.time())
+    digest = hmac.new(secret.encode(), f"{timestamp}.".encode() + payload, hashlib.sha256).hexdigest()
+    return {"Stripe-Signature": f"t={timestamp},v1={digest}", "Content-Type": "application/json"}
+
+
+def event_payload(event_type: str = "customer.created", event_id: str = None) -> bytes:
+    return json.dumps({
+        "id": event_id or f"evt_test_{uuid.uuid4().hex}",
+        "object": "event",
+        "type": event_type,
+        "data": {"object": {"id": f"cus_{uuid.uuid4().hex[:12]}", "object": "customer"}}
+    }).encode()
+
+
+class TestStripeWebhook:
+    """Signature verification and event de-duplication"""
+
+    def test_signed_webhook_is_accepted(self):
+        """A correctly signed event is stored"""
+        payload = event_payload()
+        response = requests.post(f"{BASE_URL}/api/webhook/stripe", data=payload, headers=signed(payload))
+        assert response.status_code == 200, f"Expected 200, got {response.status_code}: {response.text}"
+        assert response.json() == {"received": True}
+        print("✓ Signed webhook accepted")
+
+    def test_bad_signature_is_rejected(self):
+        """An event signed with the wrong secret is rejected"""
+        payload = event_payload()
+        response = requests.post(f"{BASE_URL}/api/webhook/stripe", data=payload, headers=signed(payload, "whsec_wrong"))
+        assert response.status_code == 400, f"Expected 400, got {response.status_code}"
+        print("✓ Bad signature rejected (400)")
+
+    def test_tampered_payload_is_rejected(self):
+        """A valid signature for a different body is rejected"""
+        headers = signed(event_payload())
+        response = requests.post(f"{BASE_URL}/api/webhook/stripe", data=event_payload(), headers=headers)
+        assert response.status_code == 400, f"Expected 400, got {response.status_code}"
+        print("✓ Tampered payload rejected (400)")
+
+    def test_missing_signature_is_rejected(self):
+        """An unsigned event is rejected"""
+        response = requests.post(f"{BASE_URL}/api/webhook/stripe", data=event_payload())
+        assert response.status_code == 400, f"Expected 400, got {response.status_code}"
+        print("✓ Missing signature rejected (400)")
+
+    def test_duplicate_event_is_ignored(self):
+        """Redelivering an event id is acknowledged but not stored again"""
+        payload = event_payload(event_id=f"evt_test_{uuid.uuid4().hex}")
+        first = requests.post(f"{BASE_URL}/api/webhook/stripe", data=payload, headers=signed(payload))
+        second = requests.post(f"{BASE_URL}/api/webhook/stripe", data=payload, headers=signed(payload))
+        assert first.status_code == 200 and second.status_code == 200
+        assert "duplicate" not in first.json()
+        assert second.json() == {"received": True, "duplicate": True}
+        print("✓ Duplicate event id ignored")
+
+
+@pytest.fixture(scope="module")
+def learner():
+    """A signed-in learner created directly in the backend's database"""
+    if not os.environ.get("MONGO_URL") or not os.environ.get("DB_NAME"):
+        pytest.skip("MONGO_URL and DB_NAME are required to create a signed-in learner")
+    from pymongo import MongoClient
+
+    db = MongoClient(os.environ["MONGO_URL"])[os.environ["DB_NAME"]]
+    user_id = f"user_test_{uuid.uuid4().hex[:12]}"
+    token = f"test_session_{uuid.uuid4().hex}"
+    now = datetime.now(timezone.utc)
+    db.users.insert_one({
+        "user_id": user_id,
+        "email": f"{user_id}@example.com",
+        "name": "Stripe Stub Learner",
+        "role": "learner",
+        "subscription_status": "free",
+        "created_at": now.isoformat()
+    })
+    db.user_sessions.insert_one({
+        "user_id": user_id,
+        "session_token": token,
+        "expires_at": (now + timedelta(hours=1)).isoformat(),
+        "created_at": now.isoformat()
+    })
+    yield {"user_id": user_id, "headers": {"Authorization": f"Bearer {token}"}, "db": db}
+    db.user_sessions.delete_many({"user_id": user_id})
+    db.payment_transactions.delete_many({"user_id": user_id})
+    db.users.delete_many({"user_id": user_id})
+
+
+def wait_for(check, timeout: float = 15.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        result = check()
+        if result:
+            return result
+        time.sleep(0.25)
+    return check()
+
+
+class TestStubCheckoutFulfilment:
+    """Checkout sessions settled through the stub are fulfilled exactly once"""
+
+    def create_session(self, learner) -> str:
+        response = requests.post(
+            f"{BASE_URL}/api/checkout/create",
+            json={"plan": "monthly", "origin_url": BASE_URL},
+            headers=learner["headers"]
+        )
+        assert response.status_code == 200, f"Expected 200, got {response.status_code}: {response.text}"
+        return response.json()["session_id"]
+
+    def test_completion_fulfils_once(self, learner):
+        """Completing a session twice (two webhooks) grants the subscription once"""
+        session_id = self.create_session(learner)
+        status = requests.get(f"{BASE_URL}/api/checkout/status/{session_id}", headers=learner["headers"])
+        assert status.json()["payment_status"] == "unpaid"
+
+        first = requests.post(f"{BASE_URL}/api/stripe-stub/sessions/{session_id}/complete")
+        assert first.status_code == 200
+        assert first.json()["event_type"] == "checkout.session.completed"
+        transaction = wait_for(lambda: learner["db"].payment_transactions.find_one(
+            {"session_id": session_id, "payment_status": "paid", "subscription_applied": True}
+        ))
+        assert transaction, "Webhook did not fulfil the checkout session"
+        assert transaction["fulfilled_by"] == "webhook"
+        user = learner["db"].users.find_one({"user_id": learner["user_id"]})
+        assert user["subscription_status"] == "premium"
+        expires_at = user["subscription_expires_at"]
+
+        # A second delivery (new event id) and a status poll find the session already fulfilled
+        second = requests.post(f"{BASE_URL}/api/stripe-stub/sessions/{session_id}/complete")
+        assert second.status_code == 200
+        assert wait_for(lambda: learner["db"].stripe_events.count_documents(
+            {"object.id": session_id, "status": "processed"}
+        ) == 2), "Second webhook was not processed"
+        status = requests.get(f"{BASE_URL}/api/checkout/status/{session_id}", headers=learner["headers"])
+        assert status.json()["payment_status"] == "paid"
+
+        assert learner["db"].payment_transactions.count_documents({"session_id": session_id}) == 1
+        assert learner["db"].payment_transactions.find_one({"session_id": session_id})["paid_at"] == transaction["paid_at"]
+        assert learner["db"].users.find_one({"user_id": learner["user_id"]})["subscription_expires_at"] == expires_at
+        print("✓ Checkout fulfilled once across repeated webhooks")
+
+    def test_status_poll_fulfils_before_webhook(self, learner):
+        """A paid session seen by the status poll is fulfilled there; the webhook then finds it done"""
+        session_id = self.create_session(learner)
+        events = learner["db"].stripe_events
+        completed = requests.post(f"{BASE_URL}/api/stripe-stub/sessions/{session_id}/complete")
+        assert completed.status_code == 200
+        status = requests.get(f"{BASE_URL}/api/checkout/status/{session_id}", headers=learner["headers"])
+        assert status.status_code == 200
+        assert status.json()["payment_status"] == "paid"
+
+        assert wait_for(lambda: events.count_documents({"object.id": session_id, "status": "processed"}) == 1)
+        transaction = learner["db"].payment_transactions.find_one({"session_id": session_id})
+        assert transaction["payment_status"] == "paid"
+        assert transaction["subscription_applied"] is True
+        print("✓ Status poll and webhook fulfil the same session once")
+
+    def test_expired_session_is_cancelled(self, learner):
+        """An expired session is recorded as cancelled without a subscription grant"""
+        session_id = self.create_session(learner)
+        response = requests.post(
+            f"{BASE_URL}/api/stripe-stub/sessions/{session_id}/complete", params={"payment_status": "expired"}
+        )
+        assert response.status_code == 200
+        assert response.json()["event_type"] == "checkout.session.expired"
+        transaction = wait_for(lambda: learner["db"].payment_transactions.find_one(
+            {"session_id": session_id, "payment_status": "cancelled"}
+        ))
+        assert transaction, "Expired session was not cancelled"
+        assert not transaction.get("subscription_applied")
+        print("✓ Expired session cancelled")
+
+    def test_unknown_stub_session_is_404(self):
+        """Completing an unknown session through the stub returns 404"""
+        response = requests.post(f"{BASE_URL}/api/stripe-stub/sessions/cs_test_{uuid.uuid4().hex}/complete")
+        assert response.status_code == 404, f"Expected 404, got {response.status_code}"
+        print("✓ Unknown stub session returns 404")